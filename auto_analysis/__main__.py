@@ -1,80 +1,192 @@
 #!/usr/bin/env python
 
 import argparse
+import contextlib
 import datetime
 import json
 import logging
 import os
+import signal
 import time
 
+import auto_analysis.claims
 import auto_analysis.config
 import auto_analysis.core as core
+import auto_analysis.janitor
+import auto_analysis.ledger as ledger
+import auto_analysis.log
+import auto_analysis.metrics
+import auto_analysis.outbox
+import auto_analysis.profiling
+import auto_analysis.scheduler
+import auto_analysis.simulate
+import auto_analysis.watch as watch
+import auto_analysis.warmup
 
 DEFAULT_SCAN_INTERVAL_SECONDS = 3600.0
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-c', '--config')
+    parser.add_argument('-c', '--config', required=True)
     parser.add_argument('--log-level')
+    parser.add_argument('--watch', action='store_true', help="Watch for runs becoming ready between scans, rather than waiting for the next scan.")
+    parser.add_argument('--import-ledger', action='store_true', help="Seed the analysis ledger from existing analysis output directories, then exit.")
+    parser.add_argument('--profile', action='store_true', help="Profile each scan cycle with cProfile.")
+    parser.add_argument('--profile-dir', default='auto-analysis-profiles', help="Directory to write scan cycle profiles to (default: auto-analysis-profiles).")
+    parser.add_argument('--max-profiles', type=int, default=auto_analysis.profiling.DEFAULT_MAX_PROFILES, help="Number of most recent profiles to keep (default: %(default)s).")
+    parser.add_argument('--simulate', action='store_true', help="Model a period of run arrivals, scans and analysis slots on a virtual clock (see the 'simulation' config section), print a capacity report, then exit. Stage costs are fixed by the config, not measured.")
     args = parser.parse_args()
 
-    config = {}
-
     try:
         log_level = getattr(logging, args.log_level.upper())
     except AttributeError as e:
         log_level = logging.INFO
 
-    logging.basicConfig(
-        format='{"timestamp": "%(asctime)s.%(msecs)03d", "level": "%(levelname)s", "module": "%(module)s", "function_name": "%(funcName)s", "line_num": %(lineno)d, "message": %(message)s}',
-        datefmt='%Y-%m-%dT%H:%M:%S',
-        encoding='utf-8',
-        level=log_level,
-    )
+    auto_analysis.log.configure_logging(log_level)
     logging.debug(json.dumps({"event_type": "debug_logging_enabled"}))
 
-    quit_when_safe = False
-    scan_interval = DEFAULT_SCAN_INTERVAL_SECONDS
+    if args.import_ledger:
+        config = auto_analysis.config.load_config(args.config)
+        ledger.import_analysis_output_dirs(config)
+        exit(0)
 
-    while(True):
+    if args.simulate:
+        config = auto_analysis.config.load_config(args.config)
         try:
-            if args.config:
-                try:
-                    config = auto_analysis.config.load_config(args.config)
-                    logging.info(json.dumps({"event_type": "config_loaded", "config_file": os.path.abspath(args.config)}))
-                except json.decoder.JSONDecodeError as e:
-                    # If we fail to load the config file, we continue on with the
-                    # last valid config that was loaded.
-                    logging.error(json.dumps({"event_type": "load_config_failed", "config_file": os.path.abspath(args.config)}))
+            scan_interval = float(str(config.get('scan_interval_seconds', DEFAULT_SCAN_INTERVAL_SECONDS)))
+        except ValueError as e:
+            scan_interval = DEFAULT_SCAN_INTERVAL_SECONDS
+        report = auto_analysis.simulate.simulate(config, scan_interval, watch=args.watch)
+        auto_analysis.log.stop_logging()
+        print(json.dumps(report, indent=2))
+        exit(0)
 
-            scan_start_timestamp = datetime.datetime.now()
-            for run in core.scan(config):
-
-                if run is not None:
-                    try:
-                        config = auto_analysis.config.load_config(args.config)
-                        logging.info(json.dumps({"event_type": "config_loaded", "config_file": os.path.abspath(args.config)}))
-                    except json.decoder.JSONDecodeError as e:
-                        logging.error(json.dumps({"event_type": "load_config_failed", "config_file": os.path.abspath(args.config)}))
+    try:
+        cached_config = auto_analysis.config.CachedConfig(args.config)
+    except ValueError as e:
+        exit(1)
+    # Reload the config on SIGHUP, even if the file hasn't changed.
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: cached_config.request_reload())
 
-                    core.analyze_run(config, run)
+    # Analyses that were in progress when we last stopped will never finish, so they're analyzed again.
+    ledger.reset_interrupted_analyses(cached_config.get())
 
-                if quit_when_safe:
-                    exit(0)
-            scan_complete_timestamp = datetime.datetime.now()
-            scan_duration_delta = scan_complete_timestamp - scan_start_timestamp
-            scan_duration_seconds = scan_duration_delta.total_seconds()
-            logging.info(json.dumps({"event_type": "scan_complete", "scan_duration_seconds": scan_duration_seconds}))
+    quit_when_safe = False
+    scan_interval = DEFAULT_SCAN_INTERVAL_SECONDS
+    run_dir_watcher = None
+    analysis_scheduler = None
+    work_dir_janitor = None
+    notification_outbox = None
+    run_claims = None
+    pipeline_warmer = None
+    metrics_exporter = None
+    scan_profiler = None
+    if args.profile:
+        scan_profiler = auto_analysis.profiling.ScanProfiler(args.profile_dir, args.max_profiles)
 
+    while(True):
+        try:
             if quit_when_safe:
+                # Closed first, so that analyses waiting for a warm-up don't hold up the drain.
+                if pipeline_warmer is not None:
+                    pipeline_warmer.close()
+                if analysis_scheduler is not None:
+                    analysis_scheduler.drain()
+                if work_dir_janitor is not None:
+                    work_dir_janitor.close()
+                if notification_outbox is not None:
+                    notification_outbox.close()
+                if run_claims is not None:
+                    run_claims.close()
+                if metrics_exporter is not None:
+                    metrics_exporter.close()
                 exit(0)
 
+            # Each scan cycle is timed (and profiled, with `--profile`) as a whole.
+            with contextlib.ExitStack() as scan_cycle:
+                if scan_profiler is not None:
+                    scan_cycle.enter_context(scan_profiler.profile('scan'))
+                scan_cycle.enter_context(auto_analysis.profiling.trace('scan_cycle'))
+
+                # The config is only reloaded if it has changed. If it fails to load, we
+                # continue on with the last valid config that was loaded.
+                with auto_analysis.profiling.span('load_config'):
+                    config = cached_config.get()
+                auto_analysis.log.update_rate_limits(config.get('log_rate_limits', None))
+
+                if run_claims is None:
+                    run_claims = auto_analysis.claims.RunClaims(config)
+                else:
+                    run_claims.update_config(config)
+
+                if work_dir_janitor is None:
+                    work_dir_janitor = auto_analysis.janitor.WorkDirJanitor(config, claims=run_claims)
+                else:
+                    work_dir_janitor.update_config(config)
+                work_dir_janitor.check_free_space()
+
+                if notification_outbox is None:
+                    notification_outbox = auto_analysis.outbox.NotificationOutbox(config)
+                else:
+                    notification_outbox.update_config(config)
+
+                if pipeline_warmer is None:
+                    pipeline_warmer = auto_analysis.warmup.PipelineWarmer(config)
+                else:
+                    pipeline_warmer.update_config(config)
+
+                if analysis_scheduler is None:
+                    analysis_scheduler = auto_analysis.scheduler.AnalysisScheduler(config, janitor=work_dir_janitor, outbox=notification_outbox, claims=run_claims, warmer=pipeline_warmer)
+                else:
+                    analysis_scheduler.update_config(config)
+
+                if metrics_exporter is None:
+                    metrics_exporter = auto_analysis.metrics.MetricsExporter(config, scheduler=analysis_scheduler, janitor=work_dir_janitor, outbox=notification_outbox, claims=run_claims, warmer=pipeline_warmer)
+                else:
+                    metrics_exporter.update_config(config)
+
+                # Start watching before scanning, so that runs that become ready during the scan aren't missed.
+                if args.watch and (run_dir_watcher is None or run_dir_watcher.fastq_by_run_dir != os.path.abspath(config['fastq_by_run_dir'])):
+                    if run_dir_watcher is not None:
+                        run_dir_watcher.close()
+                    run_dir_watcher = watch.RunDirWatcher(config)
+
+                scan_start_timestamp = datetime.datetime.now()
+                for run in core.scan(config):
+
+                    if run is not None:
+                        with auto_analysis.profiling.span('submit_run'):
+                            config = cached_config.get()
+                            analysis_scheduler.submit(config, run)
+
+                    if quit_when_safe:
+                        break
+                scan_complete_timestamp = datetime.datetime.now()
+                scan_duration_delta = scan_complete_timestamp - scan_start_timestamp
+                scan_duration_seconds = scan_duration_delta.total_seconds()
+                logging.info(json.dumps({"event_type": "scan_complete", "scan_duration_seconds": scan_duration_seconds}))
+
+            if quit_when_safe:
+                continue
+
             if "scan_interval_seconds" in config:
                 try:
                     scan_interval = float(str(config['scan_interval_seconds']))
                 except ValueError as e:
                     scan_interval = DEFAULT_SCAN_INTERVAL_SECONDS
-            time.sleep(scan_interval)
+
+            if not args.watch:
+                time.sleep(scan_interval)
+                continue
+
+            # In watch mode, runs are analyzed as soon as they become ready. The
+            # regular scan still happens every `scan_interval` to catch anything missed.
+            for run in run_dir_watcher.wait_for_runs(scan_interval):
+                config = cached_config.get()
+                analysis_scheduler.submit(config, run)
+                if quit_when_safe:
+                    break
         except KeyboardInterrupt as e:
             logging.info(json.dumps({"event_type": "quit_when_safe_enabled"}))
             quit_when_safe = True
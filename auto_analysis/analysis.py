@@ -3,7 +3,51 @@ import json
 import logging
 import os
 import shutil
-import subprocess
+
+from . import executors
+from . import ledger
+from . import profiling
+
+
+DEFAULT_NEXTFLOW_OUTPUT_TAIL_LINES = 50
+
+DEFAULT_NEXTFLOW_PROFILE = 'conda'
+
+# Pipeline parameters that are passed to nextflow as options, rather than to the pipeline itself.
+NEXTFLOW_OPTION_PARAMETERS = ['log_path', 'work_dir', 'report_path', 'trace_path', 'timeline_path']
+
+# Exit codes are grouped into classes, so that retry policies can refer to kinds of failure.
+EXIT_CODE_CLASSES = {
+    # nextflow exits with 1 when a pipeline fails for any reason, including task failures.
+    "pipeline_error": [1],
+    # Killed by a signal (negative codes are signals reported by subprocess), eg. by the OOM killer or a scheduler.
+    "killed": [-9, -15, 130, 137, 143],
+    # The executor couldn't run nextflow, eg. a batch job couldn't be submitted (see `executors.EXECUTOR_ERROR_EXIT_CODE`).
+    "executor_error": [executors.EXECUTOR_ERROR_EXIT_CODE],
+}
+
+DEFAULT_RETRY_POLICY = {
+    "max_attempts": 1,
+    "backoff_seconds": 60,
+    "backoff_multiplier": 2.0,
+    "retryable_exit_code_classes": ["killed"],
+    "retryable_exit_codes": [],
+}
+
+
+def get_nextflow_profile(config, pipeline):
+    """
+    Get the nextflow profile to run a pipeline with. The pipeline's own `profile` takes precedence over
+    the top-level `nextflow_profile`, which takes precedence over the default ('conda').
+
+    :param config: The config dictionary
+    :type config: dict
+    :param pipeline: The pipeline dictionary
+    :type pipeline: dict
+    :return: nextflow profile (may be a comma-separated list of profiles)
+    :rtype: str
+    """
+    return pipeline.get('profile', None) or config.get('nextflow_profile', None) or DEFAULT_NEXTFLOW_PROFILE
 
 
 def build_pipeline_command(config, pipeline):
@@ -24,42 +68,134 @@ def build_pipeline_command(config, pipeline):
         'run',
         pipeline['name'],
         '-r', pipeline['version'],
-        '-profile', 'conda',
+        '-profile', get_nextflow_profile(config, pipeline),
         '--cache', config['conda_cache_dir'],
         '-work-dir', pipeline['parameters']['work_dir'],
         '-with-report', pipeline['parameters']['report_path'],
         '-with-trace', pipeline['parameters']['trace_path'],
         '-with-timeline', pipeline['parameters']['timeline_path'],
+        '-ansi-log', 'false',
     ]
-    pipeline['parameters'].pop('log_path', None)
-    work_dir = pipeline['parameters'].pop('work_dir', None)
-    pipeline['parameters'].pop('report_path', None)
-    pipeline['parameters'].pop('trace_path', None)
-    pipeline['parameters'].pop('timeline_path', None)
+    if pipeline.get('resume', False):
+        pipeline_command += ['-resume']
 
     for flag, value in pipeline['parameters'].items():
+        if flag in NEXTFLOW_OPTION_PARAMETERS:
+            continue
         if value is None:
             pipeline_command += ['--' + flag]
         else:
             pipeline_command += ['--' + flag, value]
 
-    pipeline['parameters']['work_dir'] = work_dir
-    
     return pipeline_command
 
 
-def run_pipeline(config, pipeline, run):
+def get_retry_policy(config, pipeline):
+    """
+    Get the retry policy for a pipeline. The pipeline's own `retry` config takes precedence over
+    the top-level `retry` config, which takes precedence over the defaults (no retries).
+
+    :param config: The config dictionary
+    :type config: dict
+    :param pipeline: The pipeline dictionary
+    :type pipeline: dict
+    :return: Retry policy. Keys: ['max_attempts', 'backoff_seconds', 'backoff_multiplier', 'retryable_exit_code_classes', 'retryable_exit_codes']
+    :rtype: dict
+    """
+    retry_policy = dict(DEFAULT_RETRY_POLICY)
+    retry_policy.update(config.get('retry', None) or {})
+    retry_policy.update(pipeline.get('retry', None) or {})
+
+    return retry_policy
+
+
+def should_retry(retry_policy, exit_code, attempts):
+    """
+    Decide whether a failed analysis should be retried.
+
+    :param retry_policy: Retry policy, from `get_retry_policy`
+    :type retry_policy: dict
+    :param exit_code: Exit code of the failed attempt
+    :type exit_code: int
+    :param attempts: Number of attempts made so far
+    :type attempts: int
+    :return: Whether to retry
+    :rtype: bool
+    """
+    if attempts >= int(retry_policy['max_attempts']):
+        return False
+
+    retryable_exit_codes = set(retry_policy['retryable_exit_codes'])
+    for exit_code_class in retry_policy['retryable_exit_code_classes']:
+        retryable_exit_codes.update(EXIT_CODE_CLASSES.get(exit_code_class, []))
+
+    return exit_code in retryable_exit_codes
+
+
+def get_retry_delay_seconds(retry_policy, attempts):
+    """
+    Get how long to wait before the next attempt, with exponential backoff.
+
+    :param retry_policy: Retry policy, from `get_retry_policy`
+    :type retry_policy: dict
+    :param attempts: Number of attempts made so far
+    :type attempts: int
+    :return: Delay before the next attempt, in seconds
+    :rtype: float
+    """
+    backoff_seconds = float(retry_policy['backoff_seconds'])
+    backoff_multiplier = float(retry_policy['backoff_multiplier'])
+
+    return backoff_seconds * (backoff_multiplier ** max(0, attempts - 1))
+
+
+def _archive_previous_attempt_outputs(pipeline, attempt):
+    """
+    nextflow won't overwrite an existing report, trace or timeline file, so move the files
+    from a previous attempt out of the way before resuming.
+
+    :param pipeline: The pipeline dictionary
+    :type pipeline: dict
+    :param attempt: The attempt that the files belong to
+    :type attempt: int
+    :return: None
+    :rtype: None
+    """
+    for parameter in ['report_path', 'trace_path', 'timeline_path']:
+        path = pipeline['parameters'][parameter]
+        if os.path.exists(path):
+            os.replace(path, path + '.attempt-' + str(attempt))
+
+
+def run_pipeline(config, pipeline, run, attempt=1, stop_event=None):
     """
     Run a pipeline.
 
+    If `pipeline['resume']` is set, nextflow is run with `-resume`, so that tasks that completed
+    in a previous attempt using the same work dir are not repeated.
+
+    nextflow is run by the pipeline's executor (see `executors.get_executor_config`): either as a local
+    child process, or as a job submitted to a batch scheduler.
+
+    nextflow's stdout and stderr are written to `<run>_<pipeline>_nextflow_stdout.txt` and
+    `<run>_<pipeline>_nextflow_stderr.txt` in the pipeline output directory
+    (with an `.attempt-<n>` suffix for retries).
+    The last `nextflow_output_tail_lines` lines (default: 50) of each are included in the
+    `analysis_failed` event if the pipeline fails. If `log_nextflow_progress` is set in the config,
+    an `analysis_progress` event is logged for each process task that nextflow submits.
+
     :param config: The config dictionary
     :type config: dict
     :param run: The run dictionary
     :type run: dict
     :param pipeline: The pipeline dictionary
     :type pipeline: dict
-    :return: None
-    :rtype: None
+    :param attempt: Which attempt at the analysis this is, starting from 1
+    :type attempt: int
+    :param stop_event: If set while nextflow is running as a batch job, the job is cancelled.
+    :type stop_event: Optional[threading.Event]
+    :return: nextflow's exit code. Zero if the analysis completed successfully.
+    :rtype: int
     """
 
     analysis_tracking = {
@@ -69,28 +205,75 @@ def run_pipeline(config, pipeline, run):
     pipeline_command_str = list(map(str, pipeline_command))
 
     sequencing_run_id = run['sequencing_run_id']
+    pipeline_short_name = pipeline['name'].split('/')[1]
     analysis_work_dir = pipeline['parameters']['work_dir']
-    try:
-        os.makedirs(analysis_work_dir)
-        logging.info(json.dumps({
-            "event_type": "analysis_started",
-            "sequencing_run_id": sequencing_run_id,
-            "pipeline_command": pipeline_command_str
-        }))
-        analysis_result = subprocess.run(pipeline_command_str, capture_output=True, check=True, cwd=analysis_work_dir)
-        analysis_tracking["timestamp_analysis_complete"] = datetime.datetime.now().isoformat()
-        analysis_complete_path = os.path.join(pipeline['parameters']['outdir'], 'analysis_complete.json')
-        with open(analysis_complete_path, 'w') as f:
-                json.dump(analysis_tracking, f, indent=2)
-                f.write('\n')
-        logging.info(json.dumps({
-            "event_type": "analysis_complete",
-            "sequencing_run_id": sequencing_run_id,
-            "pipeline_command": pipeline_command_str,
-        }))
-    except subprocess.CalledProcessError as e:
+    analysis_outdir = pipeline['parameters']['outdir']
+    attempt_suffix = '.attempt-' + str(attempt) if attempt > 1 else ''
+    stdout_log_path = os.path.join(analysis_outdir, sequencing_run_id + '_' + pipeline_short_name + '_nextflow_stdout' + attempt_suffix + '.txt')
+    stderr_log_path = os.path.join(analysis_outdir, sequencing_run_id + '_' + pipeline_short_name + '_nextflow_stderr' + attempt_suffix + '.txt')
+    num_tail_lines = int(config.get('nextflow_output_tail_lines', DEFAULT_NEXTFLOW_OUTPUT_TAIL_LINES))
+    log_progress = bool(config.get('log_nextflow_progress', False))
+    executor_config = executors.get_executor_config(config, pipeline)
+
+    os.makedirs(analysis_work_dir, exist_ok=True)
+    os.makedirs(analysis_outdir, exist_ok=True)
+    if pipeline.get('resume', False):
+        with profiling.span('archive_previous_attempt_outputs'):
+            _archive_previous_attempt_outputs(pipeline, attempt - 1)
+    ledger.set_analysis_state(
+        config, sequencing_run_id, pipeline['name'], pipeline['version'], 'running',
+        work_dir=analysis_work_dir,
+        outdir=analysis_outdir,
+    )
+    logging.info(json.dumps({
+        "event_type": "analysis_started",
+        "sequencing_run_id": sequencing_run_id,
+        "attempt": attempt,
+        "executor": executor_config['type'],
+        "pipeline_command": pipeline_command_str
+    }))
+    job = {
+        'sequencing_run_id': sequencing_run_id,
+        'pipeline': pipeline,
+        'job_name': sequencing_run_id + '_' + pipeline_short_name,
+        'work_dir': analysis_work_dir,
+        'outdir': analysis_outdir,
+        'stdout_path': stdout_log_path,
+        'stderr_path': stderr_log_path,
+        'num_tail_lines': num_tail_lines,
+        'log_progress': log_progress,
+        'stop_event': stop_event,
+    }
+    with profiling.span('nextflow'):
+        job_result = executors.execute(executor_config, pipeline_command_str, job)
+    exit_code = job_result['exit_code']
+
+    if exit_code != 0:
+        ledger.set_analysis_state(config, sequencing_run_id, pipeline['name'], pipeline['version'], 'failed', exit_code=exit_code)
         logging.error(json.dumps({
             "event_type": "analysis_failed",
             "sequencing_run_id": sequencing_run_id,
-            "pipeline_command": pipeline_command_str
+            "attempt": attempt,
+            "pipeline_command": pipeline_command_str,
+            "exit_code": exit_code,
+            "stdout_log_path": stdout_log_path,
+            "stderr_log_path": stderr_log_path,
+            "stdout_tail": job_result['stdout_tail'],
+            "stderr_tail": job_result['stderr_tail'],
         }))
+        return exit_code
+
+    analysis_tracking["timestamp_analysis_complete"] = datetime.datetime.now().isoformat()
+    analysis_complete_path = os.path.join(analysis_outdir, 'analysis_complete.json')
+    with open(analysis_complete_path, 'w') as f:
+            json.dump(analysis_tracking, f, indent=2)
+            f.write('\n')
+    ledger.set_analysis_state(config, sequencing_run_id, pipeline['name'], pipeline['version'], 'complete', exit_code=exit_code)
+    logging.info(json.dumps({
+        "event_type": "analysis_complete",
+        "sequencing_run_id": sequencing_run_id,
+        "attempt": attempt,
+        "pipeline_command": pipeline_command_str,
+    }))
+
+    return exit_code
@@ -0,0 +1,422 @@
+import datetime
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from typing import Optional
+
+import auto_analysis.ledger as ledger
+import auto_analysis.metrics as metrics
+
+
+DEFAULT_CLAIMS_CONFIG = {
+    # Directory on a filesystem shared by all instances. Claims are disabled if this isn't set.
+    "claims_dir": None,
+    # Identifies this instance in claim files and in `instances`. Defaults to the hostname.
+    "instance_id": None,
+    # A claim whose holder hasn't renewed it for this long is considered abandoned, and can be taken over.
+    "lease_seconds": 600,
+    "heartbeat_interval_seconds": 60,
+    # If set, each run is assigned to one of these instances (by rendezvous hashing of its run ID).
+    # Other instances only claim it once it has been ready for `partition_grace_seconds`.
+    "instances": [],
+    "partition_grace_seconds": 7200,
+}
+
+CLAIM_FILENAME_SUFFIX = '.claim'
+ANALYZED_FILENAME_SUFFIX = '.analyzed.json'
+TAKEOVER_LOCK_FILENAME = '.takeover.lock'
+
+# Outcomes of `RunClaims.acquire` for which the run should be analyzed.
+ACQUIRED_OUTCOMES = {'acquired', 'taken_over', 'claims_disabled'}
+
+# Analysis outcomes that are final. Pipelines with other outcomes may be tried again by any instance.
+FINAL_ANALYSIS_OUTCOMES = {'complete', 'failed'}
+
+
+def get_claims_config(config: dict[str, object]) -> dict[str, object]:
+    """
+    Get the 'claims' section of the config, with defaults filled in.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Claims config (see `DEFAULT_CLAIMS_CONFIG`)
+    :rtype: dict[str, object]
+    """
+    claims_config = dict(DEFAULT_CLAIMS_CONFIG)
+    claims_config.update(config.get('claims', None) or {})
+    if claims_config['claims_dir']:
+        claims_config['claims_dir'] = os.path.abspath(claims_config['claims_dir'])
+    if not claims_config['instance_id']:
+        claims_config['instance_id'] = socket.gethostname()
+    for key in ['lease_seconds', 'heartbeat_interval_seconds', 'partition_grace_seconds']:
+        claims_config[key] = float(claims_config[key])
+    claims_config['instances'] = [str(instance_id) for instance_id in claims_config['instances'] or []]
+
+    return claims_config
+
+
+def get_assigned_instance(instances: list[str], sequencing_run_id: str) -> Optional[str]:
+    """
+    Assign a run to one of a list of instances by rendezvous (highest random weight) hashing. Each instance
+    keeps its runs when instances are added or removed, apart from those that move to a new instance.
+
+    :param instances: Instance IDs
+    :type instances: list[str]
+    :param sequencing_run_id: Sequencing run ID
+    :type sequencing_run_id: str
+    :return: The ID of the instance the run is assigned to, or None if there are no instances.
+    :rtype: Optional[str]
+    """
+    def weight(instance_id):
+        return hashlib.sha256((instance_id + '\n' + sequencing_run_id).encode('utf-8')).digest()
+
+    return max(instances, key=weight, default=None)
+
+
+def _read_json(path: str) -> Optional[dict[str, object]]:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        return None
+
+
+class RunClaims:
+    """
+    Claim runs on a filesystem shared between auto-analysis instances, so that each run is analyzed by
+    only one of them at a time.
+
+    A run is claimed by creating `<claims_dir>/<sequencing_run_id>.claim` with O_EXCL, which succeeds for only
+    one instance. The holder keeps the file open, and a background thread renews its modification time every
+    `heartbeat_interval_seconds`. A claim that hasn't been renewed for `lease_seconds` (eg. because its holder
+    crashed) is taken over by the next instance that tries to claim the run. Takeovers are serialized by an
+    fcntl lock on `<claims_dir>/.takeover.lock`, which is released by the OS if its holder dies. Lease ages are
+    measured against the local clock, so the clocks of the instances should agree to well within `lease_seconds`.
+
+    Claims are renewed through the file descriptor opened when they were created, and a holder whose claim file
+    has been replaced (because its lease lapsed and the claim was taken over) logs a 'run_claim_lost' event.
+
+    When a run's analysis finishes, the final outcome of each pipeline is recorded in
+    `<claims_dir>/<sequencing_run_id>.analyzed.json`, so that other instances don't re-prepare the same analyses
+    just to find that they have already been started.
+    """
+
+    def __init__(self, config: dict[str, object]):
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._held = {}
+        self.update_config(config)
+        self._thread = threading.Thread(target=self._heartbeat, name='run-claims-heartbeat', daemon=True)
+        self._thread.start()
+
+
+    def update_config(self, config: dict[str, object]):
+        """
+        Update the claims settings from a (re)loaded config. Claims that are already held are kept, even if the
+        claims dir changes.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :return: None
+        :rtype: NoneType
+        """
+        claims_config = get_claims_config(config)
+        if claims_config['claims_dir']:
+            os.makedirs(claims_config['claims_dir'], exist_ok=True)
+        if claims_config['instances'] and claims_config['instance_id'] not in claims_config['instances']:
+            logging.warning(json.dumps({
+                "event_type": "instance_not_in_partition",
+                "instance_id": claims_config['instance_id'],
+                "instances": claims_config['instances'],
+            }))
+        with self._lock:
+            self._config = config
+            self._claims_config = claims_config
+
+
+    def _get_path(self, sequencing_run_id: str, suffix: str) -> str:
+        return os.path.join(self._claims_config['claims_dir'], sequencing_run_id + suffix)
+
+
+    def _get_seconds_since_ready(self, run: dict[str, object]) -> float:
+        ready_path = os.path.join(run['fastq_directory'], 'symlinks_complete.json')
+        for path in [ready_path, run['fastq_directory']]:
+            try:
+                return time.time() - os.stat(path).st_mtime
+            except OSError as e:
+                continue
+
+        return 0.0
+
+
+    def _all_pipelines_analyzed(self, config: dict[str, object], sequencing_run_id: str) -> bool:
+        """
+        Check whether another instance has recorded a final outcome for every configured pipeline. If it has,
+        the outcomes are copied into the ledger, so that later scans skip the run without checking again.
+        """
+        analyzed = _read_json(self._get_path(sequencing_run_id, ANALYZED_FILENAME_SUFFIX))
+        if analyzed is None:
+            return False
+        outcomes = {(a['pipeline_name'], a['pipeline_version']): a['outcome'] for a in analyzed.get('analyses', [])}
+        pipelines = [pipeline for pipeline in config['pipelines'] if pipeline is not None]
+        if not all(outcomes.get((pipeline['name'], pipeline['version']), None) in FINAL_ANALYSIS_OUTCOMES for pipeline in pipelines):
+            return False
+        for pipeline in pipelines:
+            ledger.set_analysis_state(config, sequencing_run_id, pipeline['name'], pipeline['version'], outcomes[(pipeline['name'], pipeline['version'])])
+
+        return True
+
+
+    def _create_claim(self, sequencing_run_id: str, claim_path: str) -> bool:
+        try:
+            fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError as e:
+            return False
+        claim = {
+            "sequencing_run_id": sequencing_run_id,
+            "instance_id": self._claims_config['instance_id'],
+            "hostname": socket.gethostname(),
+            "pid": os.getpid(),
+            "timestamp_claimed": datetime.datetime.now().isoformat(),
+        }
+        os.write(fd, (json.dumps(claim) + '\n').encode('utf-8'))
+        with self._lock:
+            self._held[sequencing_run_id] = (fd, claim_path)
+
+        return True
+
+
+    def _take_over_expired_claim(self, sequencing_run_id: str, claim_path: str) -> str:
+        lease_seconds = self._claims_config['lease_seconds']
+        lock_path = os.path.join(self._claims_config['claims_dir'], TAKEOVER_LOCK_FILENAME)
+        with open(lock_path, 'a') as lock_file:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX)
+            try:
+                # Checked again under the lock, in case another instance has already taken it over.
+                try:
+                    lease_age_seconds = time.time() - os.stat(claim_path).st_mtime
+                except FileNotFoundError as e:
+                    # Released since we tried to claim it.
+                    return 'acquired' if self._create_claim(sequencing_run_id, claim_path) else 'held_by_another_instance'
+                if lease_age_seconds <= lease_seconds:
+                    return 'held_by_another_instance'
+                previous_claim = _read_json(claim_path)
+                os.unlink(claim_path)
+                if not self._create_claim(sequencing_run_id, claim_path):
+                    return 'held_by_another_instance'
+            finally:
+                fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+        logging.warning(json.dumps({
+            "event_type": "run_claim_taken_over",
+            "sequencing_run_id": sequencing_run_id,
+            "instance_id": self._claims_config['instance_id'],
+            "previous_claim": previous_claim,
+            "lease_age_seconds": lease_age_seconds,
+        }))
+
+        return 'taken_over'
+
+
+    def acquire(self, run: dict[str, object]) -> str:
+        """
+        Try to claim a run for analysis by this instance.
+
+        :param run: The run to claim.
+        :type run: dict[str, object]
+        :return: Outcome. The run should only be analyzed if this is in `ACQUIRED_OUTCOMES`. One of:
+                 ['acquired', 'taken_over', 'claims_disabled', 'held_by_another_instance',
+                  'assigned_to_another_instance', 'analyzed_by_another_instance', 'claim_failed']
+        :rtype: str
+        """
+        with self._lock:
+            config = self._config
+            claims_config = self._claims_config
+        if not claims_config['claims_dir']:
+            return 'claims_disabled'
+
+        sequencing_run_id = run['sequencing_run_id']
+        outcome = 'acquired'
+        assigned_instance = get_assigned_instance(claims_config['instances'], sequencing_run_id)
+        if assigned_instance is not None and assigned_instance != claims_config['instance_id']:
+            if self._get_seconds_since_ready(run) < claims_config['partition_grace_seconds']:
+                outcome = 'assigned_to_another_instance'
+        if outcome == 'acquired' and self._all_pipelines_analyzed(config, sequencing_run_id):
+            outcome = 'analyzed_by_another_instance'
+        if outcome == 'acquired':
+            claim_path = self._get_path(sequencing_run_id, CLAIM_FILENAME_SUFFIX)
+            try:
+                if not self._create_claim(sequencing_run_id, claim_path):
+                    outcome = self._take_over_expired_claim(sequencing_run_id, claim_path)
+            except OSError as e:
+                logging.error(json.dumps({
+                    "event_type": "run_claim_failed",
+                    "sequencing_run_id": sequencing_run_id,
+                    "claim_path": claim_path,
+                    "error": str(e),
+                }))
+                outcome = 'claim_failed'
+        metrics.inc("auto_analysis_run_claims_total", {"outcome": outcome})
+
+        return outcome
+
+
+    def release(self, sequencing_run_id: str, analysis_outcomes: Optional[list[dict[str, str]]]=None):
+        """
+        Release this instance's claim on a run, so that it can be claimed again by any instance.
+
+        :param sequencing_run_id: Sequencing run ID
+        :type sequencing_run_id: str
+        :param analysis_outcomes: Outcome of each pipeline, if the run's analysis finished (see `core.analyze_run`).
+                                  Final outcomes are recorded alongside those already recorded for the run.
+        :type analysis_outcomes: Optional[list[dict[str, str]]]
+        :return: None
+        :rtype: NoneType
+        """
+        with self._lock:
+            held = self._held.pop(sequencing_run_id, None)
+        if held is None:
+            return
+        fd, claim_path = held
+
+        try:
+            if analysis_outcomes is not None:
+                self._record_analysis_outcomes(sequencing_run_id, analysis_outcomes)
+            if self._is_current_claim(fd, claim_path):
+                os.unlink(claim_path)
+        except OSError as e:
+            logging.error(json.dumps({
+                "event_type": "run_claim_release_failed",
+                "sequencing_run_id": sequencing_run_id,
+                "claim_path": claim_path,
+                "error": str(e),
+            }))
+        finally:
+            os.close(fd)
+
+
+    def _record_analysis_outcomes(self, sequencing_run_id: str, analysis_outcomes: list[dict[str, str]]):
+        analyzed_path = self._get_path(sequencing_run_id, ANALYZED_FILENAME_SUFFIX)
+        analyzed = _read_json(analyzed_path) or {}
+        outcomes = {(a['pipeline_name'], a['pipeline_version']): a for a in analyzed.get('analyses', [])}
+        for analysis_outcome in analysis_outcomes:
+            analysis_key = (analysis_outcome['pipeline_name'], analysis_outcome['pipeline_version'])
+            if analysis_outcome['outcome'] in FINAL_ANALYSIS_OUTCOMES or analysis_key not in outcomes:
+                outcomes[analysis_key] = analysis_outcome
+        analyzed = {
+            "sequencing_run_id": sequencing_run_id,
+            "instance_id": self._claims_config['instance_id'],
+            "timestamp_analyzed": datetime.datetime.now().isoformat(),
+            "analyses": list(outcomes.values()),
+        }
+        tmp_analyzed_path = analyzed_path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_analyzed_path, 'w') as f:
+            json.dump(analyzed, f, indent=2)
+            f.write('\n')
+        os.replace(tmp_analyzed_path, analyzed_path)
+
+
+    def _is_current_claim(self, fd: int, claim_path: str) -> bool:
+        try:
+            return os.stat(claim_path).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError as e:
+            return False
+
+
+    def _heartbeat(self):
+        while True:
+            with self._lock:
+                heartbeat_interval_seconds = self._claims_config['heartbeat_interval_seconds']
+            if self._stopping.wait(timeout=heartbeat_interval_seconds):
+                return
+            self.renew()
+
+
+    def renew(self):
+        """
+        Renew the leases on all claims held by this instance. Called periodically by the heartbeat thread.
+
+        :return: None
+        :rtype: NoneType
+        """
+        with self._lock:
+            held = list(self._held.items())
+        for sequencing_run_id, (fd, claim_path) in held:
+            try:
+                os.utime(fd)
+                claim_lost = not self._is_current_claim(fd, claim_path)
+            except OSError as e:
+                claim_lost = True
+            if not claim_lost:
+                continue
+            # The analysis carries on, but another instance may now be analyzing the same run.
+            logging.error(json.dumps({
+                "event_type": "run_claim_lost",
+                "sequencing_run_id": sequencing_run_id,
+                "claim_path": claim_path,
+                "current_claim": _read_json(claim_path),
+            }))
+            metrics.inc("auto_analysis_run_claims_total", {"outcome": "lost"})
+            with self._lock:
+                if self._held.get(sequencing_run_id, None) == (fd, claim_path):
+                    self._held.pop(sequencing_run_id)
+                    os.close(fd)
+
+
+    def get_claimed_run_ids(self) -> set[str]:
+        """
+        Get the runs that are claimed by any instance (including this one), with leases that haven't expired.
+        Their work dirs may be in use, even if this instance's ledger doesn't know about them.
+
+        :return: Sequencing run IDs. Empty if claims are disabled.
+        :rtype: set[str]
+        """
+        with self._lock:
+            claims_dir = self._claims_config['claims_dir']
+            lease_seconds = self._claims_config['lease_seconds']
+        claimed_run_ids = set()
+        if not claims_dir:
+            return claimed_run_ids
+
+        now = time.time()
+        with os.scandir(claims_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(CLAIM_FILENAME_SUFFIX):
+                    continue
+                try:
+                    if now - entry.stat().st_mtime <= lease_seconds:
+                        claimed_run_ids.add(entry.name[:-len(CLAIM_FILENAME_SUFFIX)])
+                except FileNotFoundError as e:
+                    continue
+
+        return claimed_run_ids
+
+
+    def num_held(self) -> int:
+        """
+        :return: The number of runs currently claimed by this instance.
+        :rtype: int
+        """
+        with self._lock:
+            return len(self._held)
+
+
+    def close(self):
+        """
+        Stop the heartbeat thread, and release any claims that are still held.
+
+        :return: None
+        :rtype: NoneType
+        """
+        self._stopping.set()
+        self._thread.join()
+        with self._lock:
+            sequencing_run_ids = list(self._held)
+        for sequencing_run_id in sequencing_run_ids:
+            self.release(sequencing_run_id)
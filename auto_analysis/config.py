@@ -1,15 +1,269 @@
 import json
+import logging
 import os
+import re
 
 from pathlib import Path
+from typing import Optional
+
+import auto_analysis.executors as executors
+
+
+REQUIRED_CONFIG_KEYS = [
+    'fastq_by_run_dir',
+    'analysis_output_dir',
+    'analysis_work_dir',
+    'conda_cache_dir',
+    'notification',
+    'pipelines',
+]
+
+REQUIRED_PIPELINE_KEYS = ['name', 'version', 'parameters']
+
+
+def build_pipeline_dependency_graph(pipelines: list[dict[str, object]]) -> dict[int, set[int]]:
+    """
+    Compile the `dependencies` of each pipeline into a dependency graph.
+
+    Nodes are indexes into the `pipelines` list. A dependency on a pipeline that isn't in the list
+    adds no edge; it is still checked before the pipeline is run, in
+    `pre_analysis.check_analysis_dependencies_complete`.
+
+    :param pipelines: Pipelines from the application config.
+    :type pipelines: list[dict[str, object]]
+    :raises ValueError: If the same pipeline version is configured more than once, or the dependencies contain a cycle.
+    :return: Indexes of the upstream pipelines of each pipeline, indexed by pipeline index. `None` entries in `pipelines` are left out.
+    :rtype: dict[int, set[int]]
+    """
+    pipeline_indexes_by_name_and_version = {}
+    for pipeline_index, pipeline in enumerate(pipelines):
+        if pipeline is None:
+            continue
+        pipeline_key = (pipeline['name'], pipeline['version'])
+        if pipeline_key in pipeline_indexes_by_name_and_version:
+            raise ValueError(f"Pipeline configured more than once: {pipeline['name']} {pipeline['version']}")
+        pipeline_indexes_by_name_and_version[pipeline_key] = pipeline_index
+
+    upstream_pipeline_indexes = {}
+    for pipeline_index, pipeline in enumerate(pipelines):
+        if pipeline is None:
+            continue
+        upstream_pipeline_indexes[pipeline_index] = set()
+        for dependency in pipeline.get('dependencies', None) or []:
+            dependency_key = (dependency['pipeline_name'], dependency['pipeline_version'])
+            dependency_index = pipeline_indexes_by_name_and_version.get(dependency_key, None)
+            if dependency_index is not None:
+                upstream_pipeline_indexes[pipeline_index].add(dependency_index)
+
+    # Kahn's algorithm. Anything that can't be ordered is part of (or downstream of) a cycle.
+    num_unordered_upstream = {i: len(upstream) for i, upstream in upstream_pipeline_indexes.items()}
+    ready = [i for i, n in num_unordered_upstream.items() if n == 0]
+    num_ordered = 0
+    while ready:
+        pipeline_index = ready.pop()
+        num_ordered += 1
+        for downstream_index, upstream in upstream_pipeline_indexes.items():
+            if pipeline_index in upstream:
+                num_unordered_upstream[downstream_index] -= 1
+                if num_unordered_upstream[downstream_index] == 0:
+                    ready.append(downstream_index)
+
+    if num_ordered < len(upstream_pipeline_indexes):
+        unordered_pipelines = [
+            pipelines[i]['name'] + ' ' + pipelines[i]['version']
+            for i, n in num_unordered_upstream.items() if n > 0
+        ]
+        raise ValueError(f"Pipeline dependencies contain a cycle, involving: {', '.join(unordered_pipelines)}")
+
+    return upstream_pipeline_indexes
+
+
+def _check_number(errors: list[str], name: str, value: object, minimum: float, integer: bool=False):
+    """
+    Check that a numeric config value (which may be given as a string) is a number no smaller than `minimum`.
+    Problems are appended to `errors`.
+    """
+    try:
+        number = float(str(value))
+    except ValueError as e:
+        errors.append(f"{name} must be a number, not {value!r}")
+        return
+    if integer and not number.is_integer():
+        errors.append(f"{name} must be a whole number, not {value!r}")
+    elif number < minimum:
+        errors.append(f"{name} must be at least {minimum}, not {value!r}")
+
+
+def _check_executor(errors: list[str], name: str, executor_config: object):
+    """
+    Check an `executor` config (see `executors.DEFAULT_EXECUTOR_CONFIG`). Problems are appended to `errors`.
+    """
+    if not isinstance(executor_config, dict):
+        errors.append(f"{name} must be an object")
+        return
+    if 'type' in executor_config and executor_config['type'] not in executors.EXECUTORS:
+        errors.append(f"{name}.type must be one of {list(executors.EXECUTORS)}, not {executor_config['type']!r}")
+    for key in ['poll_interval_seconds', 'command_timeout_seconds']:
+        if key in executor_config:
+            _check_number(errors, name + '.' + key, executor_config[key], 0)
+    if 'max_status_failures' in executor_config:
+        _check_number(errors, name + '.max_status_failures', executor_config['max_status_failures'], 1, integer=True)
+    for key in ['submit_command', 'status_command', 'cancel_command']:
+        if key in executor_config and not isinstance(executor_config[key], list):
+            errors.append(f"{name}.{key} must be a list of arguments")
+    for key, group in [('job_id_regex', 'job_id'), ('status_regex', 'state')]:
+        if key not in executor_config:
+            continue
+        try:
+            regex = re.compile(executor_config[key])
+        except (re.error, TypeError) as e:
+            errors.append(f"{name}.{key} is not a valid regex: {e}")
+            continue
+        if group not in regex.groupindex:
+            errors.append(f"{name}.{key} must have a named group '{group}'")
+
+
+def validate_config(config: dict[str, object]):
+    """
+    Check that a config has the required keys, that its numeric settings are valid numbers,
+    and that its pipelines are well-formed and have a valid dependency graph.
+
+    :param config: Parsed auto-analysis config.
+    :type config: dict[str, object]
+    :raises ValueError: Describing every problem found, if the config is invalid.
+    :return: None
+    :rtype: NoneType
+    """
+    if not isinstance(config, dict):
+        raise ValueError("Config must be a JSON object")
+
+    errors = []
+    for key in REQUIRED_CONFIG_KEYS:
+        if key not in config:
+            errors.append(f"Missing required key: {key}")
+
+    if 'scan_interval_seconds' in config:
+        _check_number(errors, 'scan_interval_seconds', config['scan_interval_seconds'], 0)
+    if 'max_concurrent_analyses' in config:
+        _check_number(errors, 'max_concurrent_analyses', config['max_concurrent_analyses'], 1, integer=True)
+    retry = config.get('retry', None) or {}
+    for key, minimum, integer in [('max_attempts', 1, True), ('backoff_seconds', 0, False), ('backoff_multiplier', 1, False)]:
+        if key in retry:
+            _check_number(errors, 'retry.' + key, retry[key], minimum, integer)
+    janitor = config.get('janitor', None) or {}
+    if janitor.get('max_workers', None) is not None:
+        _check_number(errors, 'janitor.max_workers', janitor['max_workers'], 1, integer=True)
+    for key in ['min_free_percent', 'target_free_percent']:
+        if janitor.get(key, None) is not None:
+            _check_number(errors, 'janitor.' + key, janitor[key], 0)
+    metrics_config = config.get('metrics', None) or {}
+    if metrics_config.get('write_interval_seconds', None) is not None:
+        _check_number(errors, 'metrics.write_interval_seconds', metrics_config['write_interval_seconds'], 1)
+    if metrics_config.get('http_port', None) is not None:
+        _check_number(errors, 'metrics.http_port', metrics_config['http_port'], 0, integer=True)
+    log_rate_limits = config.get('log_rate_limits', None) or {}
+    if not isinstance(log_rate_limits, dict):
+        errors.append("log_rate_limits must be an object")
+    else:
+        for event_type, limit in log_rate_limits.items():
+            _check_number(errors, 'log_rate_limits.' + event_type, limit, 0, integer=True)
+    if config.get('executor', None) is not None:
+        _check_executor(errors, 'executor', config['executor'])
+    claims = config.get('claims', None) or {}
+    for key, minimum in [('lease_seconds', 1), ('heartbeat_interval_seconds', 1), ('partition_grace_seconds', 0)]:
+        if key in claims:
+            _check_number(errors, 'claims.' + key, claims[key], minimum)
+    if 'lease_seconds' in claims and 'heartbeat_interval_seconds' in claims and not errors:
+        if float(str(claims['heartbeat_interval_seconds'])) >= float(str(claims['lease_seconds'])):
+            errors.append("claims.heartbeat_interval_seconds must be less than claims.lease_seconds")
+    if not isinstance(claims.get('instances', None) or [], list):
+        errors.append("claims.instances must be a list")
+    warmup = config.get('warmup', None) or {}
+    for key, minimum in [('timeout_seconds', 1), ('retry_seconds', 0)]:
+        if key in warmup:
+            _check_number(errors, 'warmup.' + key, warmup[key], minimum)
+    for key in ['pull_command', 'env_command']:
+        if warmup.get(key, None) is not None and not isinstance(warmup[key], list):
+            errors.append(f"warmup.{key} must be a list of arguments or null")
+    simulation = config.get('simulation', None) or {}
+    for key, minimum in [('duration_days', 0), ('failure_rate', 0)]:
+        if key in simulation:
+            _check_number(errors, 'simulation.' + key, simulation[key], minimum)
+    for arrival_index, arrival in enumerate(simulation.get('arrivals', None) or []):
+        if 'instrument_model' not in arrival:
+            errors.append(f"simulation.arrivals[{arrival_index}] is missing instrument_model")
+        for key in ['runs_per_day', 'input_gigabytes']:
+            if key in arrival:
+                _check_number(errors, f"simulation.arrivals[{arrival_index}].{key}", arrival[key], 0)
+    for pipeline_name, runtime in (simulation.get('pipeline_runtimes', None) or {}).items():
+        if 'median_seconds' not in runtime:
+            errors.append(f"simulation.pipeline_runtimes.{pipeline_name} is missing median_seconds")
+        for key in ['median_seconds', 'sigma']:
+            if key in runtime:
+                _check_number(errors, f"simulation.pipeline_runtimes.{pipeline_name}.{key}", runtime[key], 0)
+    scheduling = config.get('scheduling', None) or {}
+    if 'aging_factor' in scheduling:
+        _check_number(errors, 'scheduling.aging_factor', scheduling['aging_factor'], 0)
+    input_fastq_qc = (config.get('qc_filters', None) or {}).get('input_fastq', None) or {}
+    for key in ['minimum_q30_percent', 'warning_q30_percent']:
+        if input_fastq_qc.get(key, None) is not None:
+            _check_number(errors, 'qc_filters.input_fastq.' + key, input_fastq_qc[key], 0)
+    if input_fastq_qc.get('max_workers', None) is not None:
+        _check_number(errors, 'qc_filters.input_fastq.max_workers', input_fastq_qc['max_workers'], 1, integer=True)
+    if input_fastq_qc.get('action', 'exclude') not in ['exclude', 'flag']:
+        errors.append(f"qc_filters.input_fastq.action must be 'exclude' or 'flag', not {input_fastq_qc['action']!r}")
+
+    pipelines = config.get('pipelines', [])
+    if not isinstance(pipelines, list):
+        errors.append("pipelines must be a list")
+        pipelines = []
+    for pipeline_index, pipeline in enumerate(pipelines):
+        if pipeline is None:
+            continue
+        pipeline_label = f"pipelines[{pipeline_index}]"
+        if not isinstance(pipeline, dict):
+            errors.append(f"{pipeline_label} must be an object")
+            continue
+        for key in REQUIRED_PIPELINE_KEYS:
+            if key not in pipeline:
+                errors.append(f"{pipeline_label} is missing required key: {key}")
+        if 'name' in pipeline:
+            pipeline_label += f" ({pipeline['name']})"
+            if not isinstance(pipeline['name'], str) or '/' not in pipeline['name']:
+                errors.append(f"{pipeline_label} name must look like '<org>/<pipeline>'")
+        if 'parameters' in pipeline and not isinstance(pipeline['parameters'], dict):
+            errors.append(f"{pipeline_label} parameters must be an object")
+        if 'max_concurrent' in pipeline:
+            _check_number(errors, pipeline_label + ' max_concurrent', pipeline['max_concurrent'], 1, integer=True)
+        if pipeline.get('executor', None) is not None:
+            _check_executor(errors, pipeline_label + ' executor', pipeline['executor'])
+        pipeline_retry = pipeline.get('retry', None) or {}
+        if 'max_attempts' in pipeline_retry:
+            _check_number(errors, pipeline_label + ' retry.max_attempts', pipeline_retry['max_attempts'], 1, integer=True)
+        dependencies = pipeline.get('dependencies', None) or []
+        if not isinstance(dependencies, list):
+            errors.append(f"{pipeline_label} dependencies must be a list")
+            continue
+        for dependency in dependencies:
+            if not isinstance(dependency, dict) or 'pipeline_name' not in dependency or 'pipeline_version' not in dependency:
+                errors.append(f"{pipeline_label} dependencies must each have a pipeline_name and pipeline_version")
+
+    if errors:
+        raise ValueError('Invalid config: ' + '; '.join(errors))
+
+    build_pipeline_dependency_graph(pipelines)
 
 
 def load_config(config_path: Path) -> dict[str, object]:
     """
     Load auto-analysis config.
 
+    The config is validated when it is loaded (see `validate_config`), so that a misconfiguration
+    is reported straight away, rather than when a run is analyzed.
+
     :param config_path: Path to auto-analysis config file.
     :type config_path: Path
+    :raises ValueError: If the config is not valid JSON, or is invalid.
     :return: Parsed auto-analysis config
     :rtype: dict
     """
@@ -17,7 +271,7 @@ def load_config(config_path: Path) -> dict[str, object]:
     with open(config_path, 'r') as f:
         config = json.load(f)
 
-    if 'notification' in config:
+    if isinstance(config, dict) and isinstance(config.get('notification', None), dict):
         notification_system_config_file = config['notification'].get('system_config_file', None)
         if notification_system_config_file and os.path.exists(notification_system_config_file):
             with open(notification_system_config_file, 'r') as f:
@@ -25,4 +279,90 @@ def load_config(config_path: Path) -> dict[str, object]:
                 for k, v in notification_system_config.items():
                     config['notification'][k] = v
 
+    validate_config(config)
+
     return config
+
+
+def _get_file_fingerprint(path: Optional[str]) -> Optional[tuple[int, int, int, int]]:
+    """
+    Identify a version of a file by its device, inode, size and modification time, so that
+    both in-place edits and replacement by a new file (eg. by an editor or `mv`) are noticed.
+    """
+    if not path:
+        return None
+    try:
+        file_stat = os.stat(path)
+    except OSError as e:
+        return None
+
+    return (file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+
+
+class CachedConfig:
+    """
+    Load the config once, and only load it again when the config file (or the notification system
+    config file that it refers to) changes, or when a reload is requested (eg. on SIGHUP).
+
+    Each successful load produces a new config dict, and a config is never modified after it has been
+    handed out by `get`. In-flight analyses can therefore keep using the config they were started with,
+    while new analyses get the latest one. If a changed config file fails to load, the last valid config
+    continues to be used.
+    """
+
+    def __init__(self, config_path: str):
+        self.config_path = os.path.abspath(config_path)
+        self._config = None
+        self._fingerprints = None
+        self._reload_requested = False
+        self._load()
+        if self._config is None:
+            raise ValueError(f"Could not load config: {self.config_path}")
+
+
+    def _get_fingerprints(self, config: Optional[dict[str, object]]) -> tuple:
+        notification_system_config_file = None
+        if config is not None:
+            notification_system_config_file = config['notification'].get('system_config_file', None)
+
+        return (_get_file_fingerprint(self.config_path), _get_file_fingerprint(notification_system_config_file))
+
+
+    def _load(self):
+        # Take the fingerprint before reading, so that a change made while loading is picked up next time.
+        fingerprints = self._get_fingerprints(self._config)
+        try:
+            config = load_config(self.config_path)
+        except (OSError, ValueError) as e:
+            self._fingerprints = fingerprints
+            logging.error(json.dumps({"event_type": "load_config_failed", "config_file": self.config_path, "error": str(e)}))
+            return
+        # The notification system config file may have changed along with the config.
+        self._fingerprints = (fingerprints[0], self._get_fingerprints(config)[1])
+        self._config = config
+        logging.info(json.dumps({"event_type": "config_loaded", "config_file": self.config_path}))
+
+
+    def request_reload(self):
+        """
+        Reload the config on the next call to `get`, even if the config file hasn't changed.
+        Safe to call from a signal handler.
+
+        :return: None
+        :rtype: NoneType
+        """
+        self._reload_requested = True
+
+
+    def get(self) -> dict[str, object]:
+        """
+        Get the current config, reloading it first if it has changed.
+
+        :return: The current config. Must not be modified.
+        :rtype: dict[str, object]
+        """
+        if self._reload_requested or self._get_fingerprints(self._config) != self._fingerprints:
+            self._reload_requested = False
+            self._load()
+
+        return self._config
@@ -1,27 +1,94 @@
+import concurrent.futures
+import contextlib
+import copy
 import csv
 import datetime
-import glob
 import json
 import logging
 import os
 import re
 import shutil
 import subprocess
+import time
 import uuid
 
 from typing import Iterator, Optional
 
+import auto_analysis.config
 import auto_analysis.pre_analysis as pre_analysis
 import auto_analysis.analysis as analysis
+import auto_analysis.ledger as ledger
+import auto_analysis.metrics as metrics
 import auto_analysis.post_analysis as post_analysis
+import auto_analysis.profiling as profiling
+import auto_analysis.warehouse as warehouse
 
 from auto_analysis.notification import send_notification_email
 
 
+SEQUENCING_RUN_ID_REGEXES = {
+    "miseq": "\\d{6}_M\\d{5}_\\d+_\\d{9}-[A-Z0-9]{5}",
+    "nextseq": "\\d{6}_VH\\d{5}_\\d+_[A-Z0-9]{9}",
+    "gridion": "\\d{8}_\\d{4}_X[1-5]_[A-Z0-9]+_[a-z0-9]{8}",
+    "promethion": "\\d{8}_\\d{4}_P\\dS_\\d+-\\d_[A-Z0-9]+_[a-z0-9]{8}",
+}
+
+FASTQ_FILENAME_REGEX = re.compile(r'\.f(ast)?q(\.gz)?$')
+
+INSTRUMENT_TYPES_BY_INSTRUMENT_MODEL = {
+    "miseq": "illumina",
+    "nextseq": "illumina",
+    "gridion": "nanopore",
+    "promethion": "nanopore",
+}
+
+
+def get_instrument_type(run_id: str) -> Optional[str]:
+    """
+    Determine the instrument type from a sequencing run ID.
+
+    :param run_id: Sequencing run ID (eg. '240101_M00123_0001_000000000-ABCDE')
+    :type run_id: str
+    :return: Instrument type ('illumina' or 'nanopore'), or None if the run ID doesn't match any known format.
+    :rtype: Optional[str]
+    """
+    for instrument_model, run_id_regex in SEQUENCING_RUN_ID_REGEXES.items():
+        if re.match(run_id_regex, run_id):
+            return INSTRUMENT_TYPES_BY_INSTRUMENT_MODEL[instrument_model]
+
+    return None
+
+
+def build_run(run_id: str, run_fastq_directory: str, instrument_type: str) -> dict[str, object]:
+    """
+    Build the run dictionary that is passed through to analysis.
+
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param run_fastq_directory: Path to the directory of fastq files for the run.
+    :type run_fastq_directory: str
+    :param instrument_type: Instrument type ('illumina' or 'nanopore')
+    :type instrument_type: str
+    :return: Run dictionary. Keys: ['sequencing_run_id', 'fastq_directory', 'analysis_parameters', 'instrument_type']
+    :rtype: dict[str, object]
+    """
+    run = {
+        "sequencing_run_id": run_id,
+        "fastq_directory": os.path.abspath(run_fastq_directory),
+        "analysis_parameters": {},
+        "instrument_type": instrument_type,
+    }
+
+    return run
+
+
 def find_fastq_dirs(config, check_symlinks_complete=True):
     """
     Find all directories in the fastq_by_run_dir that match the expected format for a sequencing run directory.
 
+    If the analysis ledger is configured, runs for which every configured pipeline has already been initiated
+    are skipped without touching the run directory.
+
     :param config: Application config.
     :type config: dict[str, object]
     :param check_symlinks_complete: Whether or not to check for the presence of a `symlinks_complete.json` file in each run directory.
@@ -29,44 +96,45 @@ def find_fastq_dirs(config, check_symlinks_complete=True):
     :return: A run directory to analyze, or None
     :rtype: Iterator[Optional[dict[str, object]]]
     """
-    miseq_run_id_regex = "\\d{6}_M\\d{5}_\\d+_\\d{9}-[A-Z0-9]{5}"
-    nextseq_run_id_regex = "\\d{6}_VH\\d{5}_\\d+_[A-Z0-9]{9}"
-    gridion_run_id_regex = "\\d{8}_\\d{4}_X[1-5]_[A-Z0-9]+_[a-z0-9]{8}"
-    promethion_run_id_regex = "\\d{8}_\\d{4}_P\\dS_\\d+-\\d_[A-Z0-9]+_[a-z0-9]{8}"
+    with profiling.span('get_analysis_states'):
+        analysis_states_by_run = ledger.get_analysis_states_by_run(config)
+    pipelines = config.get('pipelines', [])
 
     fastq_by_run_dir = config['fastq_by_run_dir']
-    subdirs = os.scandir(fastq_by_run_dir)
-    if 'analyze_runs_in_reverse_order' in config and config['analyze_runs_in_reverse_order']:
-        subdirs = sorted(subdirs, key=lambda x: os.path.basename(x.path), reverse=True)
+    with profiling.span('scandir'):
+        subdirs = os.scandir(fastq_by_run_dir)
+        if 'analyze_runs_in_reverse_order' in config and config['analyze_runs_in_reverse_order']:
+            subdirs = sorted(subdirs, key=lambda x: os.path.basename(x.path), reverse=True)
+    # Skipped directories are summarized in a single event per scan, rather than one event each.
+    num_directories_skipped = 0
+    num_skipped_by_condition = {}
     for subdir in subdirs:
         run_id = subdir.name
         run_fastq_directory = os.path.abspath(subdir.path)
 
-        matches_miseq_regex = re.match(miseq_run_id_regex, run_id)
-        matches_nextseq_regex = re.match(nextseq_run_id_regex, run_id)
-        matches_gridion_regex = re.match(gridion_run_id_regex, run_id)
-        matches_promethion_regex = re.match(promethion_run_id_regex, run_id)
+        with profiling.span('match_sequencing_run_id'):
+            instrument_type = get_instrument_type(run_id)
+        matches_sequencing_run_id_format = instrument_type is not None
 
-        matches_sequencing_run_id_format = any([
-            matches_miseq_regex,
-            matches_nextseq_regex,
-            matches_gridion_regex,
-            matches_promethion_regex
-        ])
+        analyses_already_started = ledger.all_analyses_started(analysis_states_by_run.get(run_id, {}), pipelines)
 
-        if check_symlinks_complete:
-            ready_to_analyze = os.path.exists(os.path.join(subdir.path, "symlinks_complete.json"))
+        # Only check for the `symlinks_complete.json` file if the run could still need analysis.
+        if check_symlinks_complete and matches_sequencing_run_id_format and not analyses_already_started:
+            with profiling.span('check_symlinks_complete'):
+                ready_to_analyze = os.path.exists(os.path.join(subdir.path, "symlinks_complete.json"))
+        elif check_symlinks_complete:
+            ready_to_analyze = False
         else:
             ready_to_analyze = True
             
         conditions_checked = {
             "is_directory": subdir.is_dir(),
             "matches_sequencing_run_id_format": matches_sequencing_run_id_format,
+            "analyses_not_already_started": not analyses_already_started,
             "ready_to_analyze": ready_to_analyze,
         }
         conditions_met = list(conditions_checked.values())
         
-        analysis_parameters = {}
         if all(conditions_met):
 
             logging.info(json.dumps({
@@ -74,27 +142,28 @@ def find_fastq_dirs(config, check_symlinks_complete=True):
                 "sequencing_run_id": run_id,
                 "fastq_directory_path": os.path.abspath(subdir.path),
             }))
-            run = {
-                "sequencing_run_id": run_id,
-                "fastq_directory": run_fastq_directory,
-                "analysis_parameters": analysis_parameters
-            }
-            if matches_miseq_regex:
-                run["instrument_type"] = "illumina"
-            elif matches_nextseq_regex:
-                run["instrument_type"] = "illumina"
-            elif matches_gridion_regex:
-                run["instrument_type"] = "nanopore"
-            elif matches_promethion_regex:
-                run["instrument_type"] = "nanopore"
+            metrics.inc("auto_analysis_runs_discovered_total")
+            run = build_run(run_id, run_fastq_directory, instrument_type)
+            for pipeline in pipelines:
+                if pipeline is not None:
+                    ledger.set_analysis_state(config, run_id, pipeline['name'], pipeline['version'], 'discovered', only_if_absent=True)
             yield run
         else:
-            logging.debug(json.dumps({
-                "event_type": "directory_skipped",
-                "fastq_directory": run_fastq_directory,
-                "conditions_checked": conditions_checked,
-            }))
+            num_directories_skipped += 1
+            for condition, condition_met in conditions_checked.items():
+                if not condition_met:
+                    num_skipped_by_condition[condition] = num_skipped_by_condition.get(condition, 0) + 1
             yield None
+
+    for condition, num_skipped in num_skipped_by_condition.items():
+        metrics.inc("auto_analysis_directories_skipped_total", {"condition": condition}, num_skipped)
+
+    logging.debug(json.dumps({
+        "event_type": "directories_skipped",
+        "fastq_by_run_dir": os.path.abspath(fastq_by_run_dir),
+        "num_directories_skipped": num_directories_skipped,
+        "num_skipped_by_condition": num_skipped_by_condition,
+    }))
     
 
 def scan(config: dict[str, object]) -> Iterator[Optional[dict[str, object]]]:
@@ -109,115 +178,358 @@ def scan(config: dict[str, object]) -> Iterator[Optional[dict[str, object]]]:
     :rtype: Iterator[Optional[dict[str, object]]]
     """
     logging.info(json.dumps({"event_type": "scan_start"}))
-    for symlinks_dir in find_fastq_dirs(config):    
-        yield symlinks_dir
+    with metrics.timer("auto_analysis_scan_duration_seconds"):
+        for symlinks_dir in find_fastq_dirs(config):    
+            yield symlinks_dir
 
 
-def get_library_fastq_paths(fastq_input_dir: str):
+def get_run_input_bytes(fastq_directory: str) -> int:
     """
-    Get the paths to all of the fastq files in a directory.
-    param: fastq_input_dir: Path to a directory containing fastq files.
-    type: fastq_input_dir: str
-    return: Paths to R1 and R2 fastq files, indexed by library ID. Keys of the dict are library IDs, values are dicts with keys: ['ID', 'R1', 'R2'].
-    rtype: dict[str, dict[str, str]]
+    Get the total size of the fastq files for a run. Symlinks are followed, so this is the size of the files they point to.
+
+    :param fastq_directory: Path to the run's fastq directory.
+    :type fastq_directory: str
+    :return: Total size of the fastq files, in bytes.
+    :rtype: int
     """
-    fastq_paths_by_library_id = {}
-    for fastq_file in glob.glob(os.path.join(fastq_input_dir, '*.f*q.gz')):
-        fastq_file_basename = os.path.basename(fastq_file)
-        fastq_file_abspath = os.path.abspath(fastq_file)
-        fastq_file_basename_parts = fastq_file_basename.split('_')
-        library_id = fastq_file_basename_parts[0]
-        if library_id not in fastq_paths_by_library_id:
-            fastq_paths_by_library_id[library_id] = {
-                'ID': library_id,
-                'R1': None,
-                'R2': None,
-            }
-        if '_R1' in fastq_file_basename:
-            fastq_paths_by_library_id[library_id]['R1'] = fastq_file_abspath
-        elif '_R2' in fastq_file_basename:
-            fastq_paths_by_library_id[library_id]['R2'] = fastq_file_abspath
+    input_bytes = 0
+    for dirpath, dirnames, filenames in os.walk(fastq_directory):
+        for filename in filenames:
+            if not FASTQ_FILENAME_REGEX.search(filename):
+                continue
+            try:
+                input_bytes += os.stat(os.path.join(dirpath, filename)).st_size
+            except OSError as e:
+                # Broken symlink
+                continue
 
-    return fastq_paths_by_library_id
+    return input_bytes
 
 
-def analyze_run(config: dict[str, object], run: dict[str, object]):
+def analyze_pipeline(config: dict[str, object], pipeline: dict[str, object], run: dict[str, object], scheduler=None, janitor=None, warmer=None) -> str:
     """
-    Initiate an analysis on one directory of fastq files. We assume that the directory of fastq files is named using
-    a sequencing run ID.
+    Prepare, run and post-process a single pipeline for a run. Skips the analysis if it has already been initiated
+    (whether completed or not). If the analysis ledger is configured, it is consulted first, and the analysis output
+    directory is only checked for analyses that the ledger has no record of having been started.
 
-    Runs the pipeline as defined in the config, with parameters configured for the run to be analyzed. Skips any
-    analyses that have already been initiated (whether completed or not).
+    If the pipeline specifies that it depends on the outputs of other pipelines through its 'dependencies' config,
+    we confirm that all of the upstream analyses are complete, or the analysis will be skipped.
 
-    Some pipelines may specify that they depend on the outputs of another through their 'dependencies' config.
-    For those pipelines, we confirm that all of the upstream analyses that we depend on are complete, or
-    the analysis will be skipped.
+    Failed attempts are retried according to the pipeline's retry policy (see `analysis.get_retry_policy`).
+    Retries reuse the same work dir and run nextflow with `-resume`, so completed tasks aren't repeated.
 
-    :param config:
+    :param config: Application config.
     :type config: dict[str, object]
+    :param pipeline: The pipeline to run, from `config['pipelines']`. It is not modified.
+    :type pipeline: dict[str, object]
     :param run: Dictionary describing the run to be analyzed.
-                Keys: ['sequencing_run_id', 'fastq_directory', 'instrument_type', 'analysis_parameters']
     :type run: dict[str, object]
-               Keys: ['sequencing_run_id', 'fastq_directory', 'instrument_type', 'analysis_parameters']
-    :param analysis_type: The type of analysis to perform. Default is 'short', alternative is 'hybrid'.
-    :type analysis_mode: str
-    :return: None
-    :rtype: NoneType
+    :param scheduler: Scheduler that provides the slots that limit concurrent pipeline execution.
+                      If None, the pipeline is run as soon as it is ready.
+    :type scheduler: Optional[auto_analysis.scheduler.AnalysisScheduler]
+    :param janitor: Janitor that deletes the analysis work dir in the background. If None, it is deleted in post-analysis.
+    :type janitor: Optional[auto_analysis.janitor.WorkDirJanitor]
+    :param warmer: Warmer that pulls the pipeline and builds its environments ahead of time. If given, the analysis
+                   waits for the pipeline to be warmed up before it asks for an analysis slot, and is cancelled
+                   if the warm-up fails.
+    :type warmer: Optional[auto_analysis.warmup.PipelineWarmer]
+    :return: Outcome of the analysis. One of: ['complete', 'failed', 'skipped', 'cancelled']
+    :rtype: str
     """
     sequencing_run_id = run['sequencing_run_id']
-    top_level_analysis_output_dir = config['analysis_output_dir']
-    
-    for pipeline in config['pipelines']:
-        if pipeline is None:
-            logging.error(json.dumps({
-                "event_type": "analysis_skipped",
-                "sequencing_run_id": sequencing_run_id,
-                "reason": "pipeline_not_found"
-            }))
-            continue
 
-        try:
-            logging.debug(json.dumps({
-                "event_type": "prepare_analysis_started",
-                "sequencing_run_id": sequencing_run_id,
-                "pipeline_name": pipeline['name']
-            }))
+    # Preparing the analysis fills in run-specific parameters, so each analysis
+    # needs its own copy of the pipeline config.
+    pipeline = copy.deepcopy(pipeline)
+
+    with profiling.span('get_ledger_analysis', pipeline_name=pipeline['name']):
+        ledger_analysis = ledger.get_analysis(config, sequencing_run_id, pipeline['name'], pipeline['version'])
+    if ledger_analysis is not None and ledger_analysis['state'] in ledger.STARTED_ANALYSIS_STATES:
+        logging.debug(json.dumps({
+            "event_type": "analysis_skipped",
+            "pipeline_name": pipeline['name'],
+            "pipeline_version": pipeline['version'],
+            "sequencing_run_id": sequencing_run_id,
+            "reason": "analysis_already_started",
+            "analysis_state": ledger_analysis['state'],
+        }))
+        return 'skipped'
+
+    try:
+        logging.debug(json.dumps({
+            "event_type": "prepare_analysis_started",
+            "sequencing_run_id": sequencing_run_id,
+            "pipeline_name": pipeline['name']
+        }))
+        pipeline_name = pipeline['name']
+        with profiling.span('prepare_analysis', pipeline_name=pipeline_name), metrics.timer("auto_analysis_stage_duration_seconds", {"stage": "prepare", "pipeline": pipeline_name}):
             pipeline = pre_analysis.prepare_analysis(config, pipeline, run)
-            if not pipeline:
-                logging.error(json.dumps({"event_type": "prepare_analysis_failed", "sequencing_run_id": sequencing_run_id}))
-                return 
-        except Exception as e:
-            logging.error(json.dumps({"event_type": "prepare_analysis_failed", "sequencing_run_id": sequencing_run_id, "pipeline_name": pipeline['name'], "error": str(e)}))
-            return
+        if not pipeline:
+            logging.error(json.dumps({"event_type": "prepare_analysis_failed", "sequencing_run_id": sequencing_run_id, "pipeline_name": pipeline_name}))
+            return 'skipped'
+    except Exception as e:
+        logging.error(json.dumps({"event_type": "prepare_analysis_failed", "sequencing_run_id": sequencing_run_id, "pipeline_name": pipeline['name'], "error": str(e)}))
+        return 'skipped'
 
-        logging.debug(json.dumps({"event_type": "prepare_analysis_complete", "sequencing_run_id": sequencing_run_id, "pipeline_name": pipeline.get('name', "unknown")}))
+    logging.debug(json.dumps({"event_type": "prepare_analysis_complete", "sequencing_run_id": sequencing_run_id, "pipeline_name": pipeline.get('name', "unknown")}))
 
-        analysis_dependencies_complete = pre_analysis.check_analysis_dependencies_complete(config, pipeline, run)
-        analysis_not_already_started = not os.path.exists(pipeline['parameters']['outdir'])
-        conditions_checked = {
-            'pipeline_dependencies_met': analysis_dependencies_complete,
-            'analysis_not_already_started': analysis_not_already_started,
-        }
-        conditions_met = list(conditions_checked.values())
+    analysis_dependencies_complete = pre_analysis.check_analysis_dependencies_complete(config, pipeline, run)
+    analysis_outdir = pipeline['parameters']['outdir']
+    # An earlier attempt that was interrupted (eg. its retry was cancelled by a drain) is put back in the
+    # 'discovered' state with its work dir kept, so that nextflow can resume it. Its outdir already exists.
+    analysis_resumable = (
+        ledger_analysis is not None
+        and ledger_analysis['state'] == 'discovered'
+        and bool(ledger_analysis['work_dir'])
+        and os.path.isdir(ledger_analysis['work_dir'])
+    )
+    analysis_not_already_started = analysis_resumable or not os.path.exists(analysis_outdir)
+    if not analysis_not_already_started:
+        # Started before the ledger knew about it. Record it so that we don't need to check again.
+        if os.path.exists(os.path.join(analysis_outdir, 'analysis_complete.json')):
+            analysis_state = 'complete'
+        else:
+            analysis_state = 'failed'
+        ledger.set_analysis_state(config, sequencing_run_id, pipeline['name'], pipeline['version'], analysis_state, outdir=analysis_outdir)
+    conditions_checked = {
+        'pipeline_dependencies_met': analysis_dependencies_complete,
+        'analysis_not_already_started': analysis_not_already_started,
+    }
+    conditions_met = list(conditions_checked.values())
+
+    if not all(conditions_met):
+        logging.warning(json.dumps({
+            "event_type": "analysis_skipped",
+            "pipeline_name": pipeline['name'],
+            "pipeline_version": pipeline['version'],
+            "pipeline_dependencies": pipeline['dependencies'],
+            "sequencing_run_id": sequencing_run_id,
+            "conditions_checked": conditions_checked,
+        }))
+        return 'skipped'
+
+    # Reuse the work dir of an earlier attempt that was never completed, so that nextflow can resume it.
+    # Attempts carry on from the earlier ones, so that their logs and reports aren't overwritten.
+    attempt = 1
+    if analysis_resumable:
+        pipeline['parameters']['work_dir'] = ledger_analysis['work_dir']
+        pipeline['resume'] = True
+        attempt = int(ledger_analysis['attempts'] or 0) + 1
+        logging.info(json.dumps({
+            "event_type": "analysis_resumed",
+            "sequencing_run_id": sequencing_run_id,
+            "pipeline_name": pipeline['name'],
+            "pipeline_version": pipeline['version'],
+            "work_dir": ledger_analysis['work_dir'],
+            "attempt": attempt,
+        }))
+
+    # Preparation reads the run's input files, so the scheduler limits how many analyses do it at once.
+    if scheduler is not None:
+        preparation_slot = scheduler.preparation_slot(run)
+    else:
+        preparation_slot = contextlib.nullcontext(True)
+    with preparation_slot as preparation_slot_granted:
+        if preparation_slot_granted:
+            # The input size is used by the scheduler to estimate how long the analysis will take.
+            if 'input_bytes' not in run:
+                with profiling.span('get_run_input_bytes'):
+                    run['input_bytes'] = get_run_input_bytes(run['fastq_directory'])
+            try:
+                pipeline_name = pipeline['name']
+                with profiling.span('prepare_analysis_inputs', pipeline_name=pipeline_name), metrics.timer("auto_analysis_stage_duration_seconds", {"stage": "prepare_inputs", "pipeline": pipeline_name}):
+                    pipeline = pre_analysis.prepare_analysis_inputs(config, pipeline, run)
+            except Exception as e:
+                logging.error(json.dumps({"event_type": "prepare_analysis_inputs_failed", "sequencing_run_id": sequencing_run_id, "pipeline_name": pipeline_name, "error": str(e)}))
+                pipeline = None
+    if not preparation_slot_granted:
+        ledger.set_analysis_state(config, sequencing_run_id, pipeline['name'], pipeline['version'], 'discovered')
+        return 'cancelled'
+    if not pipeline:
+        return 'skipped'
 
-        if not all(conditions_met):
+    # Pipelines are only run once they're warm, so that analyses never build the same environments at once.
+    # If the warm-up failed (or the warmer was closed), the analysis is picked up again by a later scan.
+    if warmer is not None:
+        with profiling.span('wait_for_warm_up', pipeline_name=pipeline['name']):
+            pipeline_warm = warmer.wait_until_warm(config, pipeline)
+        if not pipeline_warm:
             logging.warning(json.dumps({
-                "event_type": "analysis_skipped",
+                "event_type": "pipeline_not_warm",
+                "sequencing_run_id": sequencing_run_id,
                 "pipeline_name": pipeline['name'],
                 "pipeline_version": pipeline['version'],
-                "pipeline_dependencies": pipeline['dependencies'],
-                "sequencing_run_id": sequencing_run_id,
-                "conditions_checked": conditions_checked,
             }))
-            continue
+            ledger.set_analysis_state(config, sequencing_run_id, pipeline['name'], pipeline['version'], 'discovered')
+            return 'cancelled'
+
+    retry_policy = analysis.get_retry_policy(config, pipeline)
+    while True:
+        ledger.set_analysis_state(
+            config, sequencing_run_id, pipeline['name'], pipeline['version'], 'queued',
+            work_dir=pipeline['parameters']['work_dir'],
+            outdir=analysis_outdir,
+            input_bytes=run['input_bytes'],
+        )
+        if scheduler is not None:
+            analysis_slot = scheduler.analysis_slot(pipeline, run)
+        else:
+            analysis_slot = contextlib.nullcontext(True)
+        with analysis_slot as analysis_slot_granted:
+            if analysis_slot_granted:
+                with profiling.span('run_pipeline', pipeline_name=pipeline['name']), metrics.timer("auto_analysis_stage_duration_seconds", {"stage": "nextflow", "pipeline": pipeline['name']}):
+                    exit_code = analysis.run_pipeline(config, pipeline, run, attempt, scheduler.draining if scheduler is not None else None)
+        if not analysis_slot_granted:
+            # Never started (or, if an earlier attempt left a work dir, will be resumed), so it can be picked up again by a later scan.
+            ledger.set_analysis_state(config, sequencing_run_id, pipeline['name'], pipeline['version'], 'discovered')
+            return 'cancelled'
+        if exit_code != 0 and scheduler is not None and scheduler.draining.is_set():
+            # Most likely stopped by the drain (batch jobs are cancelled). Its work dir is kept, so it's resumed by a later scan.
+            ledger.set_analysis_state(config, sequencing_run_id, pipeline['name'], pipeline['version'], 'discovered')
+            return 'cancelled'
+
+        if exit_code == 0 or not analysis.should_retry(retry_policy, exit_code, attempt):
+            break
 
-        if pipeline:
-            analysis.run_pipeline(config, pipeline, run)
-            post_analysis.post_analysis(config, pipeline, run)
+        retry_delay_seconds = analysis.get_retry_delay_seconds(retry_policy, attempt)
+        # Queued again straight away, rather than after the backoff, so that the janitor doesn't evict
+        # the work dir that the retry will resume.
+        ledger.set_analysis_state(config, sequencing_run_id, pipeline['name'], pipeline['version'], 'queued')
+        logging.warning(json.dumps({
+            "event_type": "analysis_retry_scheduled",
+            "sequencing_run_id": sequencing_run_id,
+            "pipeline_name": pipeline['name'],
+            "pipeline_version": pipeline['version'],
+            "exit_code": exit_code,
+            "attempt": attempt,
+            "retry_delay_seconds": retry_delay_seconds,
+            "work_dir": pipeline['parameters']['work_dir'],
+        }))
+        if scheduler is not None:
+            continue_retrying = scheduler.sleep_unless_draining(retry_delay_seconds)
         else:
-            logging.error(json.dumps({"event_type": "analysis_skipped", "sequencing_run_id": sequencing_run_id, "reason": "analysis_preparation_failed"}))
-            continue
+            time.sleep(retry_delay_seconds)
+            continue_retrying = True
+        if not continue_retrying:
+            ledger.set_analysis_state(config, sequencing_run_id, pipeline['name'], pipeline['version'], 'discovered')
+            return 'cancelled'
+        pipeline['resume'] = True
+        attempt += 1
+
+    with profiling.span('post_analysis', pipeline_name=pipeline['name']), metrics.timer("auto_analysis_stage_duration_seconds", {"stage": "post_analysis", "pipeline": pipeline['name']}):
+        post_analysis.post_analysis(config, pipeline, run, janitor)
+
+    if exit_code == 0:
+        return 'complete'
+    else:
+        return 'failed'
+
+
+def analyze_run(config: dict[str, object], run: dict[str, object], scheduler=None, janitor=None, outbox=None, warmer=None):
+    """
+    Initiate an analysis on one directory of fastq files. We assume that the directory of fastq files is named using
+    a sequencing run ID.
+
+    Runs the pipelines as defined in the config, with parameters configured for the run to be analyzed. The
+    pipelines' 'dependencies' are compiled into a dependency graph: pipelines that don't depend on each other
+    are run in parallel, and each pipeline is started as soon as all of the pipelines it depends on have finished.
+    See `analyze_pipeline` for the conditions under which an individual analysis is skipped.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run: Dictionary describing the run to be analyzed.
+                Keys: ['sequencing_run_id', 'fastq_directory', 'instrument_type', 'analysis_parameters']
+    :type run: dict[str, object]
+               Keys: ['sequencing_run_id', 'fastq_directory', 'instrument_type', 'analysis_parameters']
+    :param scheduler: Scheduler that provides the slots that limit concurrent pipeline execution.
+                      If None, pipelines are run as soon as they are ready.
+    :type scheduler: Optional[auto_analysis.scheduler.AnalysisScheduler]
+    :param janitor: Janitor that deletes analysis work dirs in the background. If None, they are deleted in post-analysis.
+    :type janitor: Optional[auto_analysis.janitor.WorkDirJanitor]
+    :param outbox: Outbox that sends the analysis-complete notification in the background. If None, it is sent before returning.
+                   It is only sent if at least one of the pipelines completed.
+    :type outbox: Optional[auto_analysis.outbox.NotificationOutbox]
+    :param warmer: Warmer that pipelines wait for before they are run (see `analyze_pipeline`). If None, they don't wait.
+    :type warmer: Optional[auto_analysis.warmup.PipelineWarmer]
+    :return: Outcome of each pipeline (see `analyze_pipeline`), or None if the run's analysis was cancelled.
+             Keys: ['pipeline_name', 'pipeline_version', 'outcome']
+    :rtype: Optional[list[dict[str, str]]]
+    """
+    sequencing_run_id = run['sequencing_run_id']
+    # Timings of each stage of the run's analysis are logged in a single 'timing' event (see `profiling.trace`).
+    with profiling.trace('analyze_run', sequencing_run_id=sequencing_run_id):
+        top_level_analysis_output_dir = config['analysis_output_dir']
+        pipelines = config['pipelines']
+        analysis_start = time.monotonic()
+
+        for pipeline in pipelines:
+            if pipeline is None:
+                logging.error(json.dumps({
+                    "event_type": "analysis_skipped",
+                    "sequencing_run_id": sequencing_run_id,
+                    "reason": "pipeline_not_found"
+                }))
+
+        upstream_pipeline_indexes = auto_analysis.config.build_pipeline_dependency_graph(pipelines)
+        pipelines_not_yet_started = dict(upstream_pipeline_indexes)
+        pipeline_indexes_by_future = {}
+        analysis_outcomes = {}
+        analysis_cancelled = False
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(pipelines_not_yet_started)), thread_name_prefix='analyze-' + sequencing_run_id) as executor:
+            while True:
+                if not analysis_cancelled:
+                    for pipeline_index, upstream in list(pipelines_not_yet_started.items()):
+                        if upstream.issubset(analysis_outcomes):
+                            future = executor.submit(profiling.run_in_context(analyze_pipeline), config, pipelines[pipeline_index], run, scheduler, janitor, warmer)
+                            pipeline_indexes_by_future[future] = pipeline_index
+                            pipelines_not_yet_started.pop(pipeline_index)
 
-    run_analysis_outdir = os.path.join(top_level_analysis_output_dir, sequencing_run_id)
+                if not pipeline_indexes_by_future:
+                    break
+
+                done, _ = concurrent.futures.wait(pipeline_indexes_by_future, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    pipeline_index = pipeline_indexes_by_future.pop(future)
+                    try:
+                        analysis_outcomes[pipeline_index] = future.result()
+                    except Exception as e:
+                        logging.error(json.dumps({
+                            "event_type": "analyze_pipeline_failed",
+                            "sequencing_run_id": sequencing_run_id,
+                            "pipeline_name": pipelines[pipeline_index]['name'],
+                            "error": str(e),
+                        }))
+                        analysis_outcomes[pipeline_index] = 'failed'
+                    metrics.inc("auto_analysis_analyses_total", {"pipeline": pipelines[pipeline_index]['name'], "outcome": analysis_outcomes[pipeline_index]})
+                    if analysis_outcomes[pipeline_index] == 'cancelled':
+                        analysis_cancelled = True
+
+        if analysis_cancelled:
+            return None
+        metrics.observe("auto_analysis_run_duration_seconds", time.monotonic() - analysis_start)
+
+        run_analysis_outdir = os.path.join(top_level_analysis_output_dir, sequencing_run_id)
     
-    send_notification_email(run_analysis_outdir, config['notification'])
+        # Only completed analyses are reported. Notifications can only be sent once for each run (see
+        # `outbox.get_message_id`), so one sent now would hold back the notification of a later, complete analysis.
+        if 'complete' not in analysis_outcomes.values():
+            logging.info(json.dumps({
+                "event_type": "notification_skipped",
+                "sequencing_run_id": sequencing_run_id,
+                "reason": "no_analyses_complete",
+            }))
+        else:
+            with profiling.span('notify'):
+                if outbox is not None:
+                    outbox.enqueue(config, run_analysis_outdir, sequencing_run_id)
+                else:
+                    send_notification_email(run_analysis_outdir, config['notification'], warehouse.get_warehouse_path(config))
+
+        return [
+            {
+                "pipeline_name": pipelines[pipeline_index]['name'],
+                "pipeline_version": pipelines[pipeline_index]['version'],
+                "outcome": outcome,
+            }
+            for pipeline_index, outcome in sorted(analysis_outcomes.items())
+        ]
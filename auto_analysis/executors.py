@@ -0,0 +1,360 @@
+import collections
+import json
+import logging
+import re
+import shlex
+import subprocess
+import threading
+
+from typing import Optional
+
+
+# Longer lines are split when they are written to the log files.
+MAX_NEXTFLOW_OUTPUT_LINE_LENGTH = 65536
+
+NEXTFLOW_PROGRESS_REGEX = re.compile(r'^\[(?P<task_hash>[0-9a-f]{2}/[0-9a-f]{6})\] (?P<task_status>Submitted|Cached) process > (?P<process_name>\S+)(?: \((?P<task_tag>.*)\))?$')
+
+# Reported when the executor itself fails (eg. a batch job can't be submitted, or its status can't be found),
+# rather than nextflow. Same as the code used by `env` and container runtimes for a command that couldn't be run.
+EXECUTOR_ERROR_EXIT_CODE = 125
+
+# Reported for batch jobs that the batch scheduler killed, eg. for running out of time or memory (as SIGKILL).
+BATCH_JOB_KILLED_EXIT_CODE = -9
+
+DEFAULT_EXECUTOR_CONFIG = {
+    # One of: ['local', 'batch']
+    "type": "local",
+    # Batch executor only. Commands are templates: each argument is formatted with `str.format` using the fields
+    # ['command', 'job_name', 'work_dir', 'outdir', 'stdout_path', 'stderr_path', 'sequencing_run_id', 'pipeline_name', 'job_id'].
+    # `command` is the nextflow command line, quoted for a POSIX shell. The defaults are for SLURM.
+    "submit_command": ["sbatch", "--parsable", "--job-name", "{job_name}", "--output", "{stdout_path}", "--error", "{stderr_path}", "--chdir", "{work_dir}", "--wrap", "{command}"],
+    "job_id_regex": "^(?P<job_id>[0-9]+)",
+    "status_command": ["sacct", "--noheader", "--allocations", "--parsable2", "--format", "State,ExitCode", "--jobs", "{job_id}"],
+    # Must capture the job's `state`. If it captures `exit_code` (and optionally `signal`), they are used once the job has finished.
+    "status_regex": "^(?P<state>[A-Z_]+)[^|\\n]*\\|(?P<exit_code>[0-9]+):(?P<signal>[0-9]+)",
+    "cancel_command": ["scancel", "{job_id}"],
+    "active_states": ["PENDING", "CONFIGURING", "RUNNING", "COMPLETING", "REQUEUED", "RESIZING", "SUSPENDED"],
+    "completed_states": ["COMPLETED"],
+    "killed_states": ["CANCELLED", "TIMEOUT", "OUT_OF_MEMORY", "PREEMPTED", "NODE_FAIL", "BOOT_FAIL", "DEADLINE"],
+    "poll_interval_seconds": 30,
+    "command_timeout_seconds": 60,
+    # A job is cancelled and reported as failed if its status can't be found this many times in a row.
+    "max_status_failures": 20,
+}
+
+
+def get_executor_config(config: dict[str, object], pipeline: dict[str, object]) -> dict[str, object]:
+    """
+    Get the executor config for a pipeline. The pipeline's own `executor` config takes precedence over
+    the top-level `executor` config, which takes precedence over the defaults (run nextflow locally).
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param pipeline: The pipeline to run.
+    :type pipeline: dict[str, object]
+    :return: Executor config (see `DEFAULT_EXECUTOR_CONFIG`)
+    :rtype: dict[str, object]
+    """
+    executor_config = dict(DEFAULT_EXECUTOR_CONFIG)
+    executor_config.update(config.get('executor', None) or {})
+    executor_config.update(pipeline.get('executor', None) or {})
+    for key in ['poll_interval_seconds', 'command_timeout_seconds']:
+        executor_config[key] = float(executor_config[key])
+    executor_config['max_status_failures'] = int(executor_config['max_status_failures'])
+
+    return executor_config
+
+
+def _log_nextflow_progress(line: str, job: dict[str, object]):
+    progress_match = NEXTFLOW_PROGRESS_REGEX.match(line)
+    if progress_match:
+        logging.info(json.dumps({
+            "event_type": "analysis_progress",
+            "sequencing_run_id": job['sequencing_run_id'],
+            "pipeline_name": job['pipeline']['name'],
+            "pipeline_version": job['pipeline']['version'],
+            "task_hash": progress_match.group('task_hash'),
+            "task_status": progress_match.group('task_status').lower(),
+            "process_name": progress_match.group('process_name'),
+            "task_tag": progress_match.group('task_tag'),
+        }))
+
+
+def _stream_nextflow_output(stream, log_path: str, tail: collections.deque, job: dict[str, object], log_progress: bool):
+    """
+    Copy one of nextflow's output streams to a log file, line by line, keeping the last few lines in `tail`.
+
+    :param stream: stdout or stderr of the nextflow process, opened in text mode.
+    :type stream: io.TextIOBase
+    :param log_path: Path to the log file to write.
+    :type log_path: str
+    :param tail: Bounded buffer that receives each line as it is read.
+    :type tail: collections.deque
+    :param job: The job being run (see `execute`).
+    :type job: dict[str, object]
+    :param log_progress: Whether to log an `analysis_progress` event for each process task that nextflow reports.
+    :type log_progress: bool
+    :return: None
+    :rtype: None
+    """
+    with open(log_path, 'w', buffering=1) as f:
+        for line in iter(lambda: stream.readline(MAX_NEXTFLOW_OUTPUT_LINE_LENGTH), ''):
+            f.write(line)
+            line = line.rstrip('\n')
+            tail.append(line)
+            if log_progress:
+                _log_nextflow_progress(line, job)
+    stream.close()
+
+
+def run_local(executor_config: dict[str, object], pipeline_command: list[str], job: dict[str, object]) -> dict[str, object]:
+    """
+    Run nextflow as a child process. Its stdout and stderr are streamed to the job's log files as they are produced.
+
+    :param executor_config: Executor config.
+    :type executor_config: dict[str, object]
+    :param pipeline_command: nextflow command line.
+    :type pipeline_command: list[str]
+    :param job: The job to run (see `execute`).
+    :type job: dict[str, object]
+    :return: Keys: ['exit_code', 'stdout_tail', 'stderr_tail']
+    :rtype: dict[str, object]
+    """
+    # Run nextflow in its own session so that a Ctrl-C meant for auto-analysis
+    # doesn't also interrupt the analyses that we're waiting to finish.
+    analysis_process = subprocess.Popen(
+        pipeline_command,
+        cwd=job['work_dir'],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors='replace',
+        start_new_session=True,
+    )
+    stdout_tail = collections.deque(maxlen=job['num_tail_lines'])
+    stderr_tail = collections.deque(maxlen=job['num_tail_lines'])
+    output_threads = [
+        threading.Thread(target=_stream_nextflow_output, args=(analysis_process.stdout, job['stdout_path'], stdout_tail, job, job['log_progress'])),
+        threading.Thread(target=_stream_nextflow_output, args=(analysis_process.stderr, job['stderr_path'], stderr_tail, job, False)),
+    ]
+    for output_thread in output_threads:
+        output_thread.start()
+    exit_code = analysis_process.wait()
+    for output_thread in output_threads:
+        output_thread.join()
+
+    return {'exit_code': exit_code, 'stdout_tail': list(stdout_tail), 'stderr_tail': list(stderr_tail)}
+
+
+def _read_tail(path: str, num_lines: int) -> list[str]:
+    try:
+        with open(path, 'r', errors='replace') as f:
+            return [line.rstrip('\n') for line in collections.deque(f, maxlen=num_lines)]
+    except OSError as e:
+        return []
+
+
+def _format_command(command_template: list[str], fields: dict[str, str]) -> list[str]:
+    return [str(argument).format(**fields) for argument in command_template]
+
+
+def _run_batch_command(executor_config: dict[str, object], command: list[str], job: dict[str, object]) -> Optional[subprocess.CompletedProcess]:
+    """
+    Run a batch scheduler command (submit, status or cancel), logging a 'batch_command_failed' event if it fails.
+
+    :return: The finished command, or None if it failed (or timed out).
+    :rtype: Optional[subprocess.CompletedProcess]
+    """
+    try:
+        result = subprocess.run(
+            command,
+            cwd=job['work_dir'],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            text=True,
+            errors='replace',
+            timeout=executor_config['command_timeout_seconds'],
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        error = str(e)
+    else:
+        if result.returncode == 0:
+            return result
+        error = result.stderr.strip()
+    logging.error(json.dumps({
+        "event_type": "batch_command_failed",
+        "sequencing_run_id": job['sequencing_run_id'],
+        "pipeline_name": job['pipeline']['name'],
+        "command": command,
+        "error": error,
+    }))
+
+    return None
+
+
+def _get_batch_job_exit_code(executor_config: dict[str, object], status_match: re.Match) -> int:
+    state = status_match.group('state')
+    if state in executor_config['killed_states']:
+        return BATCH_JOB_KILLED_EXIT_CODE
+    status_fields = status_match.groupdict()
+    if status_fields.get('signal', None) and int(status_fields['signal']) != 0:
+        return -int(status_fields['signal'])
+    if status_fields.get('exit_code', None):
+        exit_code = int(status_fields['exit_code'])
+    else:
+        exit_code = 0
+    if exit_code == 0 and state not in executor_config['completed_states']:
+        return 1
+
+    return exit_code
+
+
+def run_batch(executor_config: dict[str, object], pipeline_command: list[str], job: dict[str, object]) -> dict[str, object]:
+    """
+    Submit nextflow as a job to a batch scheduler (eg. SLURM) with `submit_command`, then poll `status_command`
+    every `poll_interval_seconds` until the job has finished. The batch scheduler writes nextflow's stdout and stderr
+    to the job's log files. While the job is running, new lines in its stdout are checked for nextflow's progress.
+
+    Jobs that can't be submitted, or whose status can't be found `max_status_failures` times in a row (in which case
+    they are cancelled with `cancel_command`), are reported with `EXECUTOR_ERROR_EXIT_CODE`.
+
+    If the job's `stop_event` is set (eg. auto-analysis is draining), the job is cancelled with `cancel_command`
+    and reported with `BATCH_JOB_KILLED_EXIT_CODE`, rather than waited for: it may be pending for hours.
+
+    :param executor_config: Executor config.
+    :type executor_config: dict[str, object]
+    :param pipeline_command: nextflow command line.
+    :type pipeline_command: list[str]
+    :param job: The job to run (see `execute`).
+    :type job: dict[str, object]
+    :return: Keys: ['exit_code', 'stdout_tail', 'stderr_tail', 'job_id']
+    :rtype: dict[str, object]
+    """
+    fields = {
+        'command': shlex.join(pipeline_command),
+        'job_name': job['job_name'],
+        'work_dir': job['work_dir'],
+        'outdir': job['outdir'],
+        'stdout_path': job['stdout_path'],
+        'stderr_path': job['stderr_path'],
+        'sequencing_run_id': job['sequencing_run_id'],
+        'pipeline_name': job['pipeline']['name'].split('/')[-1],
+        'job_id': '',
+    }
+    job_result = {'exit_code': EXECUTOR_ERROR_EXIT_CODE, 'stdout_tail': [], 'stderr_tail': [], 'job_id': None}
+
+    submit_result = _run_batch_command(executor_config, _format_command(executor_config['submit_command'], fields), job)
+    job_id_match = re.search(executor_config['job_id_regex'], submit_result.stdout, re.MULTILINE) if submit_result is not None else None
+    if job_id_match is None:
+        if submit_result is not None:
+            job_result['stderr_tail'] = ["Job ID not found in submit command output: " + submit_result.stdout.strip()]
+        return job_result
+    fields['job_id'] = job_id_match.group('job_id')
+    job_result['job_id'] = fields['job_id']
+    logging.info(json.dumps({
+        "event_type": "batch_job_submitted",
+        "sequencing_run_id": job['sequencing_run_id'],
+        "pipeline_name": job['pipeline']['name'],
+        "job_id": fields['job_id'],
+    }))
+
+    status_command = _format_command(executor_config['status_command'], fields)
+    status_regex = re.compile(executor_config['status_regex'], re.MULTILINE)
+    stdout_offset = 0
+    num_status_failures = 0
+    stop_event = job.get('stop_event', None) or threading.Event()
+    while True:
+        if stop_event.wait(executor_config['poll_interval_seconds']):
+            logging.warning(json.dumps({
+                "event_type": "batch_job_cancelled",
+                "sequencing_run_id": job['sequencing_run_id'],
+                "pipeline_name": job['pipeline']['name'],
+                "job_id": fields['job_id'],
+                "reason": "stopping",
+            }))
+            _run_batch_command(executor_config, _format_command(executor_config['cancel_command'], fields), job)
+            job_result['exit_code'] = BATCH_JOB_KILLED_EXIT_CODE
+            break
+        if job['log_progress']:
+            stdout_offset = _log_new_progress(job, stdout_offset)
+
+        status_result = _run_batch_command(executor_config, status_command, job)
+        status_match = status_regex.search(status_result.stdout) if status_result is not None else None
+        if status_match is None:
+            # Jobs may not be listed until the batch scheduler has caught up with their submission.
+            num_status_failures += 1
+            if num_status_failures < executor_config['max_status_failures']:
+                continue
+            logging.error(json.dumps({
+                "event_type": "batch_job_status_unknown",
+                "sequencing_run_id": job['sequencing_run_id'],
+                "pipeline_name": job['pipeline']['name'],
+                "job_id": fields['job_id'],
+                "num_status_failures": num_status_failures,
+            }))
+            _run_batch_command(executor_config, _format_command(executor_config['cancel_command'], fields), job)
+            break
+        num_status_failures = 0
+        if status_match.group('state') in executor_config['active_states']:
+            continue
+        job_result['exit_code'] = _get_batch_job_exit_code(executor_config, status_match)
+        break
+
+    if job['log_progress']:
+        _log_new_progress(job, stdout_offset)
+    job_result['stdout_tail'] = _read_tail(job['stdout_path'], job['num_tail_lines'])
+    job_result['stderr_tail'] = _read_tail(job['stderr_path'], job['num_tail_lines'])
+
+    return job_result
+
+
+def _log_new_progress(job: dict[str, object], offset: int) -> int:
+    """
+    Check the lines that have been added to a batch job's stdout since `offset` for nextflow's progress.
+
+    :return: Offset of the first line that hasn't been checked yet.
+    :rtype: int
+    """
+    try:
+        with open(job['stdout_path'], 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                # A partial line is read again once it has been finished.
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                _log_nextflow_progress(line.decode('utf-8', errors='replace').rstrip('\n'), job)
+    except OSError as e:
+        pass
+
+    return offset
+
+
+EXECUTORS = {
+    'local': run_local,
+    'batch': run_batch,
+}
+
+
+def execute(executor_config: dict[str, object], pipeline_command: list[str], job: dict[str, object]) -> dict[str, object]:
+    """
+    Run nextflow with the configured executor, and wait for it to finish.
+
+    :param executor_config: Executor config, from `get_executor_config`.
+    :type executor_config: dict[str, object]
+    :param pipeline_command: nextflow command line.
+    :type pipeline_command: list[str]
+    :param job: The job to run. Keys: ['sequencing_run_id', 'pipeline', 'job_name', 'work_dir', 'outdir',
+                'stdout_path', 'stderr_path', 'num_tail_lines', 'log_progress', 'stop_event']
+    :type job: dict[str, object]
+    :raises ValueError: If the executor type is unknown.
+    :return: nextflow's exit code, and the last `num_tail_lines` lines of its stdout and stderr.
+             Keys: ['exit_code', 'stdout_tail', 'stderr_tail']
+    :rtype: dict[str, object]
+    """
+    executor = EXECUTORS.get(executor_config['type'], None)
+    if executor is None:
+        raise ValueError("Unknown executor type: " + str(executor_config['type']))
+
+    return executor(executor_config, pipeline_command, job)
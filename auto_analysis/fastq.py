@@ -1,62 +1,385 @@
-import gzip
-import io
+import collections
+import concurrent.futures
 import json
 import logging
+import os
+import zlib
 
+from typing import Iterator, Optional
 
-def get_first_n_reads(fastq_path, num_reads):
-    num_lines = num_reads * 4
-    lines_read = 0
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from . import manifest
+
+
+# Size of the blocks read from fastq files, and the maximum size of each decompressed chunk. Chunks are
+# large enough to amortize per-chunk overhead, but small enough that sampling a few reads doesn't
+# decompress much more of the file than it needs to.
+READ_CHUNK_SIZE = 256 * 1024
+DECOMPRESSED_CHUNK_SIZE = 1024 * 1024
+
+DEFAULT_NUM_SAMPLED_READS = 10000
+
+# BGZF files are gzip files made up of independent blocks of at most 64 KiB, each with
+# a 'BC' extra subfield, so decompression can start at the beginning of any block.
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BGZF_MAX_BLOCK_SIZE = 65536
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Phred+33 quality characters below Q30, for counting Q30 bases with `bytes.translate`.
+BELOW_Q30_QUALITY_CHARS = bytes(range(33 + 30))
+
+
+def is_bgzf(fastq_path: str) -> bool:
+    """
+    Check whether a file is BGZF-compressed (eg. by `bgzip`), rather than plain gzip.
+
+    :param fastq_path: Path to a fastq file.
+    :type fastq_path: str
+    :return: Whether the file is BGZF-compressed.
+    :rtype: bool
+    """
+    with open(fastq_path, 'rb') as f:
+        header = f.read(16)
+
+    return header[:4] == BGZF_MAGIC and header[12:14] == b'BC'
+
+
+def _find_bgzf_block_start(f, offset: int) -> Optional[int]:
+    """
+    Find the first BGZF block that starts at or after `offset`.
+
+    :return: Offset of the block, or None if there are no more blocks.
+    :rtype: Optional[int]
+    """
+    f.seek(offset)
+    data = f.read(2 * BGZF_MAX_BLOCK_SIZE)
+    position = data.find(BGZF_MAGIC)
+    while position >= 0:
+        if data[position + 12:position + 14] == b'BC':
+            return offset + position
+        position = data.find(BGZF_MAGIC, position + 1)
+
+    return None
+
+
+def _iter_decompressed_chunks(fastq_path: str, offset: int=0) -> Iterator[bytes]:
+    """
+    Read a fastq file in large chunks, decompressing it if it is gzipped. Files made up of
+    several gzip members (including BGZF files) are read through to the end.
+
+    :param fastq_path: Path to a fastq file.
+    :type fastq_path: str
+    :param offset: Where to start reading. For compressed files, must be the start of a gzip member (eg. a BGZF block).
+    :type offset: int
+    :return: Chunks of (decompressed) fastq data
+    :rtype: Iterator[bytes]
+    """
+    with open(fastq_path, 'rb') as f:
+        compressed = f.read(2) == GZIP_MAGIC
+        f.seek(offset)
+        if not compressed:
+            for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+                yield chunk
+            return
+
+        decompressor = zlib.decompressobj(wbits=31)
+        for data in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+            while data:
+                chunk = decompressor.decompress(data, DECOMPRESSED_CHUNK_SIZE)
+                if chunk:
+                    yield chunk
+                if decompressor.eof:
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(wbits=31)
+                else:
+                    data = decompressor.unconsumed_tail
+
+
+def _find_record_start(data: bytes) -> Optional[int]:
+    """
+    Find the start of the first complete fastq record in data that may begin part-way through a record.
+    Quality lines may also start with '@', so a header line is confirmed by the separator ('+') line two lines later.
+
+    :return: Offset of the first record, or None if none was found.
+    :rtype: Optional[int]
+    """
+    position = 0
+    while True:
+        if not data.startswith(b'@', position):
+            position = data.find(b'\n@', position) + 1
+            if position == 0:
+                return None
+        line_2_start = data.find(b'\n', position) + 1
+        line_3_start = data.find(b'\n', line_2_start) + 1 if line_2_start > 0 else 0
+        if line_3_start == 0 or line_3_start >= len(data):
+            return None
+        if data.startswith(b'+', line_3_start):
+            return position
+        position = line_2_start
+
+
+def _iter_fastq_record_line_batches(fastq_path: str, max_reads: Optional[int]=None, offset: int=0) -> Iterator[tuple[list[bytes], list[bytes], list[bytes]]]:
+    """
+    Read a fastq file in batches of (headers, sequences, qualities). See `iter_fastq_record_batches`.
+    """
     num_reads_read = 0
+    pending = b''
+    synchronized = offset == 0
+    for chunk in _iter_decompressed_chunks(fastq_path, offset):
+        data = pending + chunk
+        if not synchronized:
+            record_start = _find_record_start(data)
+            if record_start is None:
+                pending = data
+                continue
+            data = data[record_start:]
+            synchronized = True
+
+        lines = data.split(b'\n')
+        num_complete_lines = (len(lines) - 1) // 4 * 4
+        pending = b'\n'.join(lines[num_complete_lines:])
+        headers = lines[0:num_complete_lines:4]
+        sequences = lines[1:num_complete_lines:4]
+        qualities = lines[3:num_complete_lines:4]
+        if max_reads is not None and num_reads_read + len(sequences) >= max_reads:
+            num_reads_remaining = max_reads - num_reads_read
+            yield headers[:num_reads_remaining], sequences[:num_reads_remaining], qualities[:num_reads_remaining]
+            return
+        num_reads_read += len(sequences)
+        yield headers, sequences, qualities
+
+    # The last record may not end with a newline.
+    lines = pending.split(b'\n')
+    if max_reads is not None and num_reads_read >= max_reads:
+        return
+    if synchronized and len(lines) >= 4 and lines[0].startswith(b'@'):
+        yield [lines[0]], [lines[1]], [lines[3]]
+
+
+def iter_fastq_record_batches(fastq_path: str, max_reads: Optional[int]=None, offset: int=0) -> Iterator[tuple[list[bytes], list[bytes]]]:
+    """
+    Read a fastq file in batches of records. Each batch is split from a large decompressed chunk in one pass,
+    rather than line by line.
+
+    :param fastq_path: Path to a fastq file, optionally gzipped.
+    :type fastq_path: str
+    :param max_reads: Stop after this many reads. If None, read the whole file.
+    :type max_reads: Optional[int]
+    :param offset: Where to start reading. For compressed files, must be the start of a BGZF block.
+                   If it isn't zero, reading starts from the first complete record after the offset.
+    :type offset: int
+    :return: Batches of (sequences, qualities)
+    :rtype: Iterator[tuple[list[bytes], list[bytes]]]
+    """
+    for headers, sequences, qualities in _iter_fastq_record_line_batches(fastq_path, max_reads, offset):
+        yield sequences, qualities
+
+
+def get_first_n_reads(fastq_path: str, num_reads: int) -> list[dict[str, str]]:
+    """
+    Read the first reads of a fastq file.
+
+    :param fastq_path: Path to a fastq file, optionally gzipped.
+    :type fastq_path: str
+    :param num_reads: Maximum number of reads to return.
+    :type num_reads: int
+    :return: Reads, with keys: ['header', 'seq', 'quality']
+    :rtype: list[dict[str, str]]
+    """
     reads = []
-    if fastq_path.endswith('.gz'):
-        f = io.TextIOWrapper(io.BufferedReader(gzip.open(fastq_path, 'rb')))
-    else:
-        f = open(fastq_path, 'r')
-
-    while num_reads_read < num_reads:
-        try:
-            header = next(f).strip()
-            seq = next(f).strip()
-            plus = next(f).strip()
-            quality = next(f).strip()
-            read = {
-                'header': header,
-                'seq': seq,
-                'quality': quality,
-            }
-            reads.append(read)
-            num_reads_read += 1
-        except StopIteration as e:
-            break
-
-    f.close()
+    for headers, sequences, qualities in _iter_fastq_record_line_batches(fastq_path, num_reads):
+        for header, seq, quality in zip(headers, sequences, qualities):
+            reads.append({
+                'header': header.decode('ascii', errors='replace').strip(),
+                'seq': seq.decode('ascii', errors='replace').strip(),
+                'quality': quality.decode('ascii', errors='replace').strip(),
+            })
     logging.debug(json.dumps({"event_name": "sampled_reads_for_length_estimation", "fastq_path": fastq_path, "num_reads": len(reads)}))
 
     return reads
 
 
-def estimate_read_length(reads):
-    num_reads = len(reads)
-    total_len_seqs = 0
-    avg_read_len = 0
-    estimated_read_len = 150
+def estimate_read_length(reads: list[dict[str, str]]) -> int:
+    """
+    Estimate the nominal read length of a sequencing run from a sample of its reads (see `get_first_n_reads`).
+
+    :param reads: Reads, with keys: ['header', 'seq', 'quality']
+    :type reads: list[dict[str, str]]
+    :return: Estimated read length. One of [100, 150, 200, 250], defaulting to 150.
+    :rtype: int
+    """
+    mean_read_length = sum(len(read['seq']) for read in reads) / len(reads) if reads else 0
+
+    return round_read_length(mean_read_length)
+
 
-    for read in reads:
-        total_len_seqs += len(read['seq'])
-    if num_reads > 0:
-        avg_read_len = total_len_seqs / num_reads
+def round_read_length(mean_read_length: float) -> int:
+    """
+    Round a mean read length to the nominal read length of the sequencing run.
 
-    if avg_read_len > 52 and avg_read_len < 102:
+    :param mean_read_length: Mean read length of a sample of reads.
+    :type mean_read_length: float
+    :return: Estimated read length. One of [100, 150, 200, 250], defaulting to 150.
+    :rtype: int
+    """
+    estimated_read_len = 150
+
+    if mean_read_length > 52 and mean_read_length <= 102:
         estimated_read_len = 100
-    elif avg_read_len > 102 and avg_read_len < 152:
+    elif mean_read_length > 102 and mean_read_length <= 152:
         estimated_read_len = 150
-    elif avg_read_len > 152 and avg_read_len < 202:
+    elif mean_read_length > 152 and mean_read_length <= 202:
         estimated_read_len = 200
-    elif avg_read_len > 152 and avg_read_len < 202:
+    elif mean_read_length > 202 and mean_read_length <= 252:
         estimated_read_len = 250
 
-    logging.debug(json.dumps({"event_name": "estimated_read_length", "num_reads": num_reads, "mean_read_length": avg_read_len, "rounded_estimated_read_length": estimated_read_len}))
+    logging.debug(json.dumps({"event_name": "estimated_read_length", "mean_read_length": mean_read_length, "rounded_estimated_read_length": estimated_read_len}))
 
     return estimated_read_len
-        
+
+
+def get_fastq_stats(fastq_path: str, num_reads: int=DEFAULT_NUM_SAMPLED_READS, num_sample_offsets: int=1) -> dict[str, object]:
+    """
+    Estimate read length and base quality for a fastq file from a sample of its reads.
+
+    For BGZF-compressed and uncompressed files, reads are sampled from `num_sample_offsets` points spread evenly
+    through the file, rather than only from its head (where quality is often unrepresentative). Plain gzip files
+    can't be read from the middle, so they are always sampled from the head.
+
+    :param fastq_path: Path to a fastq file, optionally gzipped.
+    :type fastq_path: str
+    :param num_reads: Number of reads to sample.
+    :type num_reads: int
+    :param num_sample_offsets: Number of points in the file to sample reads from.
+    :type num_sample_offsets: int
+    :return: Stats from the sampled reads. Keys: ['fastq_path', 'num_reads_sampled', 'num_bases_sampled', 'mean_read_length',
+             'max_read_length', 'estimated_read_length', 'percent_bases_above_q30']
+    :rtype: dict[str, object]
+    """
+    offsets = [0]
+    with open(fastq_path, 'rb') as f:
+        compressed = f.read(2) == GZIP_MAGIC
+        file_size = os.fstat(f.fileno()).st_size
+        if num_sample_offsets > 1 and (not compressed or is_bgzf(fastq_path)):
+            for i in range(1, num_sample_offsets):
+                offset = file_size * i // num_sample_offsets
+                if compressed:
+                    offset = _find_bgzf_block_start(f, offset)
+                if offset is not None and offset not in offsets:
+                    offsets.append(offset)
+
+    num_reads_per_offset = -(-num_reads // len(offsets))
+    num_reads_sampled = 0
+    num_bases_sampled = 0
+    num_bases_above_q30 = 0
+    max_read_length = 0
+    for offset in offsets:
+        for sequences, qualities in iter_fastq_record_batches(fastq_path, num_reads_per_offset, offset):
+            num_reads_sampled += len(sequences)
+            read_lengths = list(map(len, sequences))
+            num_bases_sampled += sum(read_lengths)
+            max_read_length = max(read_lengths, default=max_read_length)
+            all_qualities = b''.join(qualities)
+            num_bases_above_q30 += len(all_qualities.translate(None, BELOW_Q30_QUALITY_CHARS))
+
+    mean_read_length = num_bases_sampled / num_reads_sampled if num_reads_sampled > 0 else 0
+    fastq_stats = {
+        'fastq_path': fastq_path,
+        'num_reads_sampled': num_reads_sampled,
+        'num_bases_sampled': num_bases_sampled,
+        'mean_read_length': mean_read_length,
+        'max_read_length': max_read_length,
+        'estimated_read_length': round_read_length(mean_read_length),
+        'percent_bases_above_q30': 100 * num_bases_above_q30 / num_bases_sampled if num_bases_sampled > 0 else None,
+    }
+    logging.debug(json.dumps({"event_name": "sampled_reads_for_fastq_stats", "fastq_path": fastq_path, "num_reads": num_reads_sampled, "num_sample_offsets": len(offsets)}))
+
+    return fastq_stats
+
+
+def get_fastq_stats_for_files(fastq_paths: list[str], num_reads: int=DEFAULT_NUM_SAMPLED_READS, num_sample_offsets: int=1, max_workers: Optional[int]=None) -> dict[str, Optional[dict[str, object]]]:
+    """
+    Get stats (see `get_fastq_stats`) for many fastq files, eg. all of the files for a run, in a thread pool.
+    Decompression and the bulk splitting of decompressed data release (or spend little time holding) the GIL,
+    so the files are read in parallel.
+
+    :param fastq_paths: Paths to fastq files.
+    :type fastq_paths: list[str]
+    :param num_reads: Number of reads to sample from each file.
+    :type num_reads: int
+    :param num_sample_offsets: Number of points in each file to sample reads from.
+    :type num_sample_offsets: int
+    :param max_workers: Number of threads. Defaults to the `ThreadPoolExecutor` default.
+    :type max_workers: Optional[int]
+    :return: Stats for each file, indexed by path. None for files that couldn't be read.
+    :rtype: dict[str, Optional[dict[str, object]]]
+    """
+    fastq_stats_by_path = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fastq-stats') as executor:
+        futures_by_path = {
+            fastq_path: executor.submit(get_fastq_stats, fastq_path, num_reads, num_sample_offsets)
+            for fastq_path in fastq_paths
+        }
+        for fastq_path, future in futures_by_path.items():
+            try:
+                fastq_stats_by_path[fastq_path] = future.result()
+            except (OSError, EOFError, zlib.error) as e:
+                logging.warning(json.dumps({"event_type": "get_fastq_stats_failed", "fastq_path": fastq_path, "error": str(e)}))
+                fastq_stats_by_path[fastq_path] = None
+
+    return fastq_stats_by_path
+
+
+def get_fastq_qc_stats(fastq_path: str) -> dict[str, object]:
+    """
+    Read a whole fastq file, counting reads, bases and Q30 bases, and building a read length histogram.
+    Quality scores are decoded a batch at a time with NumPy if it is installed, or with `bytes.translate` otherwise.
+
+    :param fastq_path: Path to a fastq file, optionally gzipped.
+    :type fastq_path: str
+    :return: QC stats. Keys: ['num_reads', 'num_bases', 'num_bases_above_q30', 'read_length_histogram'].
+             The histogram is a list of [read_length, num_reads] pairs, in order of read length.
+    :rtype: dict[str, object]
+    """
+    num_reads = 0
+    num_bases = 0
+    num_bases_above_q30 = 0
+    read_length_counts = collections.Counter()
+    for sequences, qualities in iter_fastq_record_batches(fastq_path):
+        all_qualities = b''.join(qualities)
+        num_reads += len(sequences)
+        num_bases += len(all_qualities)
+        if np is not None:
+            quality_chars = np.frombuffer(all_qualities, dtype=np.uint8)
+            num_bases_above_q30 += int(np.count_nonzero(quality_chars >= len(BELOW_Q30_QUALITY_CHARS)))
+            read_length_bins = np.bincount(np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences)))
+            for read_length in np.flatnonzero(read_length_bins):
+                read_length_counts[int(read_length)] += int(read_length_bins[read_length])
+        else:
+            num_bases_above_q30 += len(all_qualities.translate(None, BELOW_Q30_QUALITY_CHARS))
+            read_length_counts.update(map(len, sequences))
+
+    return {
+        'num_reads': num_reads,
+        'num_bases': num_bases,
+        'num_bases_above_q30': num_bases_above_q30,
+        'read_length_histogram': [[read_length, read_length_counts[read_length]] for read_length in sorted(read_length_counts)],
+    }
+
+
+def get_library_fastq_paths(fastq_input_dir: str):
+    """
+    Get the paths to all of the fastq files in a directory.
+    Uses the directory's cached manifest (see `manifest.get_manifest`), so unchanged directories aren't re-listed.
+    param: fastq_input_dir: Path to a directory containing fastq files.
+    type: fastq_input_dir: str
+    return: Paths to R1 and R2 fastq files, indexed by library ID. Keys of the dict are library IDs, values are dicts with keys: ['ID', 'R1', 'R2'].
+    rtype: dict[str, dict[str, str]]
+    """
+    libraries = manifest.get_manifest(fastq_input_dir)['libraries']
+
+    return {library_id: dict(library) for library_id, library in libraries.items()}
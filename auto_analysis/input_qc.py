@@ -0,0 +1,273 @@
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import zlib
+
+from typing import Optional
+
+from . import fastq
+from . import manifest
+
+
+DEFAULT_INPUT_FASTQ_QC_CONFIG = {
+    "minimum_q30_percent": None,
+    "warning_q30_percent": None,
+    # What to do with libraries below `minimum_q30_percent`: 'exclude' them from analysis, or only 'flag' them.
+    "action": "exclude",
+    "max_workers": None,
+    # Q30 thresholds don't apply to nanopore reads.
+    "instrument_types": ["illumina"],
+}
+
+INPUT_FASTQ_QC_FILENAME = 'input_fastq_qc.json'
+QC_PASSED_FASTQ_DIRNAME = 'input_fastq_qc_passed'
+
+# Only one analysis of a run should compute its QC stats (or build its QC-passed fastq dir) at a time.
+# The others wait for, and then use, the cached results. Runs share a fixed number of locks, so that
+# they don't accumulate over the life of the process. Runs that share a lock are QC'd one at a time.
+NUM_RUN_QC_LOCKS = 64
+_run_qc_locks = [threading.Lock() for _ in range(NUM_RUN_QC_LOCKS)]
+
+
+def _get_run_qc_lock(sequencing_run_id: str) -> threading.Lock:
+    return _run_qc_locks[zlib.crc32(sequencing_run_id.encode()) % NUM_RUN_QC_LOCKS]
+
+
+def get_input_fastq_qc_config(config: dict[str, object]) -> dict[str, object]:
+    """
+    Get the `qc_filters.input_fastq` config, with defaults filled in.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Input fastq QC config. Keys: ['minimum_q30_percent', 'warning_q30_percent', 'action', 'max_workers', 'instrument_types']
+    :rtype: dict[str, object]
+    """
+    input_fastq_qc_config = dict(DEFAULT_INPUT_FASTQ_QC_CONFIG)
+    input_fastq_qc_config.update((config.get('qc_filters', None) or {}).get('input_fastq', None) or {})
+    if input_fastq_qc_config['max_workers'] is not None:
+        input_fastq_qc_config['max_workers'] = int(float(str(input_fastq_qc_config['max_workers'])))
+
+    return input_fastq_qc_config
+
+
+def _get_fastq_fingerprint(fastq_path: str) -> list[int]:
+    # Follows symlinks, so that the fingerprint changes if a symlink is repointed to a different file.
+    fastq_stat = os.stat(fastq_path)
+
+    return [fastq_stat.st_dev, fastq_stat.st_ino, fastq_stat.st_size, fastq_stat.st_mtime_ns]
+
+
+def _load_cached_fastq_qc_stats(qc_path: str) -> dict[str, dict[str, object]]:
+    try:
+        with open(qc_path, 'r') as f:
+            return json.load(f).get('fastq_files', {})
+    except (OSError, ValueError) as e:
+        return {}
+
+
+def _get_fastq_qc_stats_for_files(fastq_paths: list[str], cached_fastq_qc_stats: dict[str, dict[str, object]], max_workers: Optional[int]) -> dict[str, dict[str, object]]:
+    """
+    Get QC stats for each fastq file, reusing cached stats for files whose fingerprint hasn't changed,
+    and computing the rest in a process pool.
+    """
+    fastq_qc_stats = {}
+    fastq_paths_to_compute = []
+    for fastq_path in fastq_paths:
+        fingerprint = _get_fastq_fingerprint(fastq_path)
+        cached = cached_fastq_qc_stats.get(fastq_path, None)
+        if cached is not None and cached.get('fingerprint', None) == fingerprint:
+            fastq_qc_stats[fastq_path] = cached
+        else:
+            fastq_paths_to_compute.append((fastq_path, fingerprint))
+
+    if not fastq_paths_to_compute:
+        return fastq_qc_stats
+
+    # Analyses run in threads, so worker processes are spawned rather than forked from a multi-threaded process.
+    mp_context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
+        futures = {
+            executor.submit(fastq.get_fastq_qc_stats, fastq_path): (fastq_path, fingerprint)
+            for fastq_path, fingerprint in fastq_paths_to_compute
+        }
+        for future in concurrent.futures.as_completed(futures):
+            fastq_path, fingerprint = futures[future]
+            stats = future.result()
+            stats['fingerprint'] = fingerprint
+            fastq_qc_stats[fastq_path] = stats
+
+    return fastq_qc_stats
+
+
+def _combine_library_stats(library_fastq_qc_stats: list[dict[str, object]]) -> dict[str, object]:
+    num_reads = sum(stats['num_reads'] for stats in library_fastq_qc_stats)
+    num_bases = sum(stats['num_bases'] for stats in library_fastq_qc_stats)
+    num_bases_above_q30 = sum(stats['num_bases_above_q30'] for stats in library_fastq_qc_stats)
+    read_length_counts = {}
+    for stats in library_fastq_qc_stats:
+        for read_length, count in stats['read_length_histogram']:
+            read_length_counts[read_length] = read_length_counts.get(read_length, 0) + count
+
+    return {
+        'num_reads': num_reads,
+        'num_bases': num_bases,
+        'percent_bases_above_q30': round(100 * num_bases_above_q30 / num_bases, 2) if num_bases > 0 else 0.0,
+        'read_length_histogram': [[read_length, read_length_counts[read_length]] for read_length in sorted(read_length_counts)],
+    }
+
+
+def _classify_library(library_qc: dict[str, object], input_fastq_qc_config: dict[str, object]) -> str:
+    minimum_q30_percent = input_fastq_qc_config['minimum_q30_percent']
+    warning_q30_percent = input_fastq_qc_config['warning_q30_percent']
+    percent_bases_above_q30 = library_qc['percent_bases_above_q30']
+    if library_qc['num_reads'] == 0:
+        return 'fail'
+    if minimum_q30_percent is not None and percent_bases_above_q30 < float(minimum_q30_percent):
+        return 'fail'
+    if warning_q30_percent is not None and percent_bases_above_q30 < float(warning_q30_percent):
+        return 'warn'
+
+    return 'pass'
+
+
+def run_input_fastq_qc(config: dict[str, object], run: dict[str, object]) -> Optional[dict[str, dict[str, object]]]:
+    """
+    Check the quality of each library's input fastq files against the `qc_filters.input_fastq` thresholds.
+
+    Per-library read counts, base counts, Q30 percentage and read length histogram are written to
+    `<analysis_output_dir>/<run>/input_fastq_qc.json`. Stats are cached there by file fingerprint
+    (device, inode, size and modification time), so they are only computed once for each fastq file,
+    however many pipelines are run.
+
+    Libraries below `minimum_q30_percent` are given a `qc_status` of 'fail', and libraries below
+    `warning_q30_percent` a `qc_status` of 'warn'. Failed libraries are dropped from the result
+    if the `action` is 'exclude'.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run: The run dictionary
+    :type run: dict[str, object]
+    :return: Libraries to analyze, indexed by library ID, with keys: ['ID', 'R1', 'R2', 'qc_status', 'qc'].
+             None if input QC doesn't apply to the run (no thresholds are configured, or it's from another instrument type).
+    :rtype: Optional[dict[str, dict[str, object]]]
+    """
+    input_fastq_qc_config = get_input_fastq_qc_config(config)
+    if input_fastq_qc_config['minimum_q30_percent'] is None and input_fastq_qc_config['warning_q30_percent'] is None:
+        return None
+    if run.get('instrument_type', None) not in input_fastq_qc_config['instrument_types']:
+        return None
+
+    sequencing_run_id = run['sequencing_run_id']
+    run_analysis_outdir = os.path.join(config['analysis_output_dir'], sequencing_run_id)
+    qc_path = os.path.join(run_analysis_outdir, INPUT_FASTQ_QC_FILENAME)
+    libraries = manifest.get_run_manifest(config, run)['libraries']
+    fastq_paths = sorted(p for library in libraries.values() for p in [library['R1'], library['R2']] if p is not None)
+
+    with _get_run_qc_lock(sequencing_run_id):
+        cached_fastq_qc_stats = _load_cached_fastq_qc_stats(qc_path)
+        fastq_qc_stats = _get_fastq_qc_stats_for_files(fastq_paths, cached_fastq_qc_stats, input_fastq_qc_config['max_workers'])
+
+        libraries_qc = {}
+        for library_id, library in sorted(libraries.items()):
+            library_fastq_paths = [p for p in [library['R1'], library['R2']] if p is not None]
+            library_qc = _combine_library_stats([fastq_qc_stats[p] for p in library_fastq_paths])
+            library = dict(library)
+            library['qc_status'] = _classify_library(library_qc, input_fastq_qc_config)
+            library['qc'] = library_qc
+            libraries_qc[library_id] = library
+
+        os.makedirs(run_analysis_outdir, exist_ok=True)
+        qc_tmp_path = qc_path + '.tmp'
+        with open(qc_tmp_path, 'w') as f:
+            json.dump({
+                'sequencing_run_id': sequencing_run_id,
+                'qc_thresholds': {k: input_fastq_qc_config[k] for k in ['minimum_q30_percent', 'warning_q30_percent']},
+                'libraries': libraries_qc,
+                'fastq_files': fastq_qc_stats,
+            }, f, indent=2)
+            f.write('\n')
+        os.replace(qc_tmp_path, qc_path)
+
+    num_libraries_by_qc_status = {'pass': 0, 'warn': 0, 'fail': 0}
+    for library in libraries_qc.values():
+        num_libraries_by_qc_status[library['qc_status']] += 1
+        if library['qc_status'] == 'pass':
+            continue
+        logging.warning(json.dumps({
+            "event_type": "library_input_fastq_qc_" + library['qc_status'],
+            "sequencing_run_id": sequencing_run_id,
+            "library_id": library['ID'],
+            "percent_bases_above_q30": library['qc']['percent_bases_above_q30'],
+            "num_reads": library['qc']['num_reads'],
+            "action": input_fastq_qc_config['action'] if library['qc_status'] == 'fail' else 'flag',
+        }))
+    logging.info(json.dumps({
+        "event_type": "input_fastq_qc_complete",
+        "sequencing_run_id": sequencing_run_id,
+        "input_fastq_qc_path": qc_path,
+        "num_libraries_by_qc_status": num_libraries_by_qc_status,
+    }))
+
+    if input_fastq_qc_config['action'] == 'exclude':
+        libraries_qc = {library_id: library for library_id, library in libraries_qc.items() if library['qc_status'] != 'fail'}
+
+    return libraries_qc
+
+
+def get_fastq_input_dir(config: dict[str, object], run: dict[str, object]) -> str:
+    """
+    Get the directory of fastq files to pass to a pipeline. If any of the run's libraries were excluded
+    by input QC, this is a directory of symlinks to the files of the remaining libraries. Otherwise it is
+    the run's own fastq directory.
+
+    The pipelines of a run share the directory, and may be reading from it already, so it is only rebuilt
+    if the libraries that passed have changed. It is built alongside and then renamed into place.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run: The run dictionary. If input QC was run, `run['libraries']` holds the libraries that passed.
+    :type run: dict[str, object]
+    :return: Path to the fastq input directory
+    :rtype: str
+    """
+    libraries = run.get('libraries', None)
+    if libraries is None:
+        return run['fastq_directory']
+
+    passed_fastq_paths = sorted(p for library in libraries.values() for p in [library['R1'], library['R2']] if p is not None)
+    all_fastq_paths = sorted(p for library in manifest.get_run_manifest(config, run)['libraries'].values() for p in [library['R1'], library['R2']] if p is not None)
+    if passed_fastq_paths == all_fastq_paths:
+        return run['fastq_directory']
+
+    run_analysis_outdir = os.path.abspath(os.path.join(config['analysis_output_dir'], run['sequencing_run_id']))
+    qc_passed_fastq_dir = os.path.join(run_analysis_outdir, QC_PASSED_FASTQ_DIRNAME)
+    symlinks = {os.path.basename(fastq_path): fastq_path for fastq_path in passed_fastq_paths}
+    with _get_run_qc_lock(run['sequencing_run_id']):
+        try:
+            with os.scandir(qc_passed_fastq_dir) as entries:
+                existing_symlinks = {entry.name: os.readlink(entry.path) for entry in entries if entry.is_symlink()}
+        except FileNotFoundError as e:
+            existing_symlinks = None
+        if existing_symlinks == symlinks:
+            return qc_passed_fastq_dir
+
+        os.makedirs(run_analysis_outdir, exist_ok=True)
+        tmp_qc_passed_fastq_dir = tempfile.mkdtemp(prefix=QC_PASSED_FASTQ_DIRNAME + '.', suffix='.tmp', dir=run_analysis_outdir)
+        for filename, fastq_path in symlinks.items():
+            os.symlink(fastq_path, os.path.join(tmp_qc_passed_fastq_dir, filename))
+        os.chmod(tmp_qc_passed_fastq_dir, 0o755)
+        # A directory can't be renamed over a non-empty one, so the old one is moved out of the way first.
+        if existing_symlinks is not None:
+            old_qc_passed_fastq_dir = tmp_qc_passed_fastq_dir[:-len('.tmp')] + '.old'
+            os.rename(qc_passed_fastq_dir, old_qc_passed_fastq_dir)
+            os.rename(tmp_qc_passed_fastq_dir, qc_passed_fastq_dir)
+            shutil.rmtree(old_qc_passed_fastq_dir, ignore_errors=True)
+        else:
+            os.rename(tmp_qc_passed_fastq_dir, qc_passed_fastq_dir)
+
+    return qc_passed_fastq_dir
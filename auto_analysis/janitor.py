@@ -0,0 +1,381 @@
+import concurrent.futures
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from typing import Optional
+
+import auto_analysis.ledger as ledger
+
+
+DEFAULT_JANITOR_CONFIG = {
+    "max_workers": 4,
+    # When free space on the `analysis_work_dir` filesystem falls below `min_free_percent`, the work dirs that
+    # were kept (eg. for pipelines with `delete_work_dir: false`) are evicted, oldest first, until free space
+    # is back above `target_free_percent`. Eviction is disabled unless both are set.
+    "min_free_percent": None,
+    "target_free_percent": None,
+}
+
+# Work dirs are renamed before they're deleted, so that a partially-deleted work dir is never mistaken for
+# one that can be resumed, and so that deletions interrupted by a restart can be finished later.
+DELETING_SUFFIX = '.deleting'
+
+
+def delete_tree(path: str, stop_event: Optional[threading.Event]=None) -> tuple[int, int]:
+    """
+    Delete a directory tree, bottom-up, measuring the space reclaimed as it goes.
+    Symlinks are removed, never followed.
+
+    :param path: Directory to delete.
+    :type path: str
+    :param stop_event: If set during the deletion, stop early (leaving the rest of the tree in place).
+    :type stop_event: Optional[threading.Event]
+    :raises OSError: If any file or directory could not be removed.
+    :return: Number of files deleted, and the number of bytes of disk space they used.
+    :rtype: tuple[int, int]
+    """
+    num_files_deleted = 0
+    num_bytes_reclaimed = 0
+    errors = []
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False, onerror=errors.append):
+        if stop_event is not None and stop_event.is_set():
+            raise InterruptedError(f"Deletion of {path} was interrupted")
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            try:
+                file_stat = os.lstat(file_path)
+                os.unlink(file_path)
+                num_files_deleted += 1
+                num_bytes_reclaimed += file_stat.st_blocks * 512
+            except OSError as e:
+                errors.append(e)
+        # Subdirectories have already been emptied. Symlinks to directories are listed here too, but aren't descended into.
+        for dirname in dirnames:
+            subdir_path = os.path.join(dirpath, dirname)
+            try:
+                if os.path.islink(subdir_path):
+                    os.unlink(subdir_path)
+                    num_files_deleted += 1
+                else:
+                    os.rmdir(subdir_path)
+            except OSError as e:
+                errors.append(e)
+    try:
+        os.rmdir(path)
+    except OSError as e:
+        errors.append(e)
+
+    if errors:
+        raise errors[0]
+
+    return num_files_deleted, num_bytes_reclaimed
+
+
+def _mark_for_deletion(work_dir: str) -> str:
+    """
+    Rename a work dir with the `DELETING_SUFFIX`.
+
+    :return: Path to the renamed work dir, or the original path if it couldn't be renamed.
+    :rtype: str
+    """
+    if work_dir.endswith(DELETING_SUFFIX):
+        return work_dir
+    try:
+        os.rename(work_dir, work_dir + DELETING_SUFFIX)
+    except OSError as e:
+        # eg. an earlier, interrupted deletion of a work dir with the same name is still pending.
+        return work_dir
+
+    return work_dir + DELETING_SUFFIX
+
+
+def delete_work_dir(work_dir: str, sequencing_run_id: Optional[str]=None, stop_event: Optional[threading.Event]=None) -> Optional[dict[str, object]]:
+    """
+    Delete a nextflow work dir, and log how much space was reclaimed and how quickly.
+
+    :param work_dir: Path to the work dir. It is renamed with the `DELETING_SUFFIX` first, unless it already has it.
+    :type work_dir: str
+    :param sequencing_run_id: Sequencing run ID that the work dir was used for, for logging.
+    :type sequencing_run_id: Optional[str]
+    :param stop_event: If set during the deletion, stop early.
+    :type stop_event: Optional[threading.Event]
+    :return: Deletion stats, or None if the work dir could not be (completely) deleted.
+             Keys: ['num_files_deleted', 'bytes_reclaimed', 'deletion_seconds']
+    :rtype: Optional[dict[str, object]]
+    """
+    deletion_path = _mark_for_deletion(work_dir)
+
+    deletion_start = time.monotonic()
+    try:
+        num_files_deleted, bytes_reclaimed = delete_tree(deletion_path, stop_event)
+    except InterruptedError as e:
+        logging.info(json.dumps({
+            "event_type": "delete_analysis_work_dir_interrupted",
+            "sequencing_run_id": sequencing_run_id,
+            "analysis_work_dir_path": deletion_path,
+        }))
+        return None
+    except OSError as e:
+        logging.error(json.dumps({
+            "event_type": "delete_analysis_work_dir_failed",
+            "sequencing_run_id": sequencing_run_id,
+            "analysis_work_dir_path": work_dir,
+            "error": str(e),
+        }))
+        return None
+    deletion_seconds = time.monotonic() - deletion_start
+
+    logging.info(json.dumps({
+        "event_type": "analysis_work_dir_deleted",
+        "sequencing_run_id": sequencing_run_id,
+        "analysis_work_dir_path": work_dir,
+        "num_files_deleted": num_files_deleted,
+        "bytes_reclaimed": bytes_reclaimed,
+        "deletion_seconds": round(deletion_seconds, 3),
+        "files_per_second": round(num_files_deleted / deletion_seconds, 1) if deletion_seconds > 0 else None,
+        "bytes_per_second": round(bytes_reclaimed / deletion_seconds, 1) if deletion_seconds > 0 else None,
+    }))
+
+    return {
+        'num_files_deleted': num_files_deleted,
+        'bytes_reclaimed': bytes_reclaimed,
+        'deletion_seconds': deletion_seconds,
+    }
+
+
+class WorkDirJanitor:
+    """
+    Delete nextflow work dirs in background worker threads, so that analyses don't wait
+    on the removal of work dirs containing many small task files.
+
+    Also keeps free space on the `analysis_work_dir` filesystem between the watermarks
+    set in the `janitor` config (see `DEFAULT_JANITOR_CONFIG`), by evicting the oldest work
+    dirs that were kept. Work dirs that the ledger shows are in use, or will be resumed, are never evicted
+    (see `ledger.get_active_work_dirs`), so eviction requires the analysis ledger. If `analysis_work_dir` is shared by several
+    instances, the `claims` must be given too: work dirs of runs claimed by any instance are never evicted.
+    """
+
+    def __init__(self, config: dict[str, object], claims=None):
+        self.claims = claims
+        janitor_config = dict(DEFAULT_JANITOR_CONFIG)
+        janitor_config.update(config.get('janitor', None) or {})
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, int(janitor_config['max_workers'])),
+            thread_name_prefix='janitor',
+        )
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._deletions_in_progress = {}
+        self._eviction_in_progress = False
+        self._totals = {
+            'num_work_dirs_deleted': 0,
+            'num_files_deleted': 0,
+            'bytes_reclaimed': 0,
+            'deletion_seconds': 0.0,
+        }
+        self.update_config(config)
+        self._resume_interrupted_deletions()
+
+
+    def update_config(self, config: dict[str, object]):
+        """
+        Update the work dir location and free space watermarks from a (re)loaded config.
+        The number of worker threads is only set when the janitor is created.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :return: None
+        :rtype: NoneType
+        """
+        janitor_config = dict(DEFAULT_JANITOR_CONFIG)
+        janitor_config.update(config.get('janitor', None) or {})
+        with self._lock:
+            self._config = config
+            self._analysis_work_dir = os.path.abspath(config['analysis_work_dir'])
+            self._min_free_percent = janitor_config['min_free_percent']
+            self._target_free_percent = janitor_config['target_free_percent']
+
+
+    def _resume_interrupted_deletions(self):
+        if not os.path.isdir(self._analysis_work_dir):
+            return
+        with os.scandir(self._analysis_work_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(DELETING_SUFFIX) and entry.is_dir(follow_symlinks=False):
+                    self.delete_work_dir(entry.path)
+
+
+    def delete_work_dir(self, work_dir: str, sequencing_run_id: Optional[str]=None) -> Optional[concurrent.futures.Future]:
+        """
+        Queue a work dir for deletion. The work dir is renamed with the `DELETING_SUFFIX` immediately,
+        so that it can't be resumed by a later analysis.
+
+        :param work_dir: Path to the work dir.
+        :type work_dir: str
+        :param sequencing_run_id: Sequencing run ID that the work dir was used for, for logging.
+        :type sequencing_run_id: Optional[str]
+        :return: Future for the deletion stats (see `delete_work_dir`), or None if the janitor has been closed.
+        :rtype: Optional[concurrent.futures.Future]
+        """
+        with self._lock:
+            if self._stop_event.is_set():
+                return None
+            work_dir = _mark_for_deletion(os.path.abspath(work_dir))
+            future = self._deletions_in_progress.get(work_dir, None)
+            if future is None:
+                future = self._executor.submit(self._delete_work_dir, work_dir, sequencing_run_id)
+                self._deletions_in_progress[work_dir] = future
+
+        return future
+
+
+    def _delete_work_dir(self, work_dir: str, sequencing_run_id: Optional[str]) -> Optional[dict[str, object]]:
+        try:
+            deletion_stats = delete_work_dir(work_dir, sequencing_run_id, self._stop_event)
+        finally:
+            with self._lock:
+                self._deletions_in_progress.pop(work_dir, None)
+        if deletion_stats is not None:
+            with self._lock:
+                self._totals['num_work_dirs_deleted'] += 1
+                for key in ['num_files_deleted', 'bytes_reclaimed', 'deletion_seconds']:
+                    self._totals[key] += deletion_stats[key]
+
+        return deletion_stats
+
+
+    def _get_free_percent(self) -> Optional[float]:
+        try:
+            disk_usage = shutil.disk_usage(self._analysis_work_dir)
+        except OSError as e:
+            return None
+
+        return 100 * disk_usage.free / disk_usage.total
+
+
+    def check_free_space(self):
+        """
+        Start evicting kept work dirs in the background if free space is below the low watermark.
+
+        :return: None
+        :rtype: NoneType
+        """
+        with self._lock:
+            if self._min_free_percent is None or self._target_free_percent is None:
+                return
+            if self._eviction_in_progress or self._stop_event.is_set():
+                return
+            free_percent = self._get_free_percent()
+            if free_percent is None or free_percent >= float(self._min_free_percent):
+                return
+            if ledger.get_ledger_path(self._config) is None:
+                logging.warning(json.dumps({
+                    "event_type": "work_dir_eviction_skipped",
+                    "reason": "analysis_ledger_db_not_configured",
+                    "free_percent": round(free_percent, 2),
+                }))
+                return
+            self._eviction_in_progress = True
+            self._executor.submit(self._evict_work_dirs)
+
+        logging.warning(json.dumps({
+            "event_type": "work_dir_eviction_started",
+            "analysis_work_dir": self._analysis_work_dir,
+            "free_percent": round(free_percent, 2),
+            "min_free_percent": self._min_free_percent,
+            "target_free_percent": self._target_free_percent,
+        }))
+
+
+    def _get_eviction_candidates(self) -> list[str]:
+        """
+        Kept work dirs that can be evicted, oldest (least recently modified) first.
+        """
+        protected_work_dirs = ledger.get_active_work_dirs(self._config)
+        with self._lock:
+            protected_work_dirs.update(self._deletions_in_progress)
+        # Work dirs are named 'work-<sequencing_run_id>_<pipeline>_<timestamp>' (see `pre_analysis.prepare_analysis`).
+        claimed_run_ids = self.claims.get_claimed_run_ids() if self.claims is not None else set()
+        protected_prefixes = tuple('work-' + sequencing_run_id + '_' for sequencing_run_id in claimed_run_ids)
+
+        work_dirs_by_mtime = []
+        with os.scandir(self._analysis_work_dir) as entries:
+            for entry in entries:
+                if not entry.name.startswith('work-') or entry.name.endswith(DELETING_SUFFIX):
+                    continue
+                if entry.path in protected_work_dirs or not entry.is_dir(follow_symlinks=False):
+                    continue
+                if protected_prefixes and entry.name.startswith(protected_prefixes):
+                    continue
+                work_dirs_by_mtime.append((entry.stat(follow_symlinks=False).st_mtime, entry.path))
+
+        return [work_dir for _, work_dir in sorted(work_dirs_by_mtime)]
+
+
+    def _evict_work_dirs(self):
+        num_work_dirs_evicted = 0
+        try:
+            while not self._stop_event.is_set():
+                free_percent = self._get_free_percent()
+                if free_percent is None or free_percent >= float(self._target_free_percent):
+                    break
+                eviction_candidates = self._get_eviction_candidates()
+                if not eviction_candidates:
+                    logging.warning(json.dumps({
+                        "event_type": "work_dir_eviction_exhausted",
+                        "analysis_work_dir": self._analysis_work_dir,
+                        "free_percent": round(free_percent, 2),
+                    }))
+                    break
+                work_dir = eviction_candidates[0]
+                logging.info(json.dumps({
+                    "event_type": "analysis_work_dir_evicted",
+                    "analysis_work_dir_path": work_dir,
+                    "free_percent": round(free_percent, 2),
+                }))
+                with self._lock:
+                    self._deletions_in_progress[work_dir] = None
+                if self._delete_work_dir(work_dir, None) is None:
+                    break
+                num_work_dirs_evicted += 1
+        finally:
+            with self._lock:
+                self._eviction_in_progress = False
+
+        logging.info(json.dumps({
+            "event_type": "work_dir_eviction_complete",
+            "num_work_dirs_evicted": num_work_dirs_evicted,
+            "free_percent": self._get_free_percent(),
+        }))
+
+
+    def stats(self) -> dict[str, object]:
+        """
+        :return: Totals since the janitor was started. Keys: ['num_work_dirs_deleted', 'num_files_deleted',
+                 'bytes_reclaimed', 'deletion_seconds', 'num_deletions_in_progress']
+        :rtype: dict[str, object]
+        """
+        with self._lock:
+            janitor_stats = dict(self._totals)
+            janitor_stats['num_deletions_in_progress'] = len(self._deletions_in_progress)
+
+        return janitor_stats
+
+
+    def close(self):
+        """
+        Stop the janitor. Deletions that are in progress are stopped early, and any that are queued
+        are not started. Their work dirs are left with the `DELETING_SUFFIX`, and the deletions will
+        be finished by the next janitor that is started on the same `analysis_work_dir`.
+
+        :return: None
+        :rtype: NoneType
+        """
+        with self._lock:
+            self._stop_event.set()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        logging.info(json.dumps({"event_type": "janitor_stopped", **self.stats()}))
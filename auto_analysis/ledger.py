@@ -0,0 +1,411 @@
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import statistics
+
+from contextlib import closing
+from typing import Optional
+
+
+ANALYSIS_STATES = ['discovered', 'queued', 'running', 'complete', 'failed']
+
+# Analyses in any of these states have already been initiated, and should
+# not be started again by a scan.
+STARTED_ANALYSIS_STATES = ['queued', 'running', 'complete', 'failed']
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    sequencing_run_id TEXT NOT NULL,
+    pipeline_name TEXT NOT NULL,
+    pipeline_version TEXT NOT NULL,
+    state TEXT NOT NULL,
+    work_dir TEXT,
+    outdir TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    exit_code INTEGER,
+    input_bytes INTEGER,
+    timestamp_discovered TEXT,
+    timestamp_queued TEXT,
+    timestamp_running TEXT,
+    timestamp_complete TEXT,
+    timestamp_failed TEXT,
+    timestamp_updated TEXT NOT NULL,
+    PRIMARY KEY (sequencing_run_id, pipeline_name, pipeline_version)
+);
+"""
+
+# Columns added since the ledger was first introduced, which may be missing from existing ledgers.
+_ADDED_COLUMNS = [
+    ('attempts', 'INTEGER NOT NULL DEFAULT 0'),
+    ('exit_code', 'INTEGER'),
+    ('input_bytes', 'INTEGER'),
+]
+
+_initialized_ledger_paths = set()
+
+
+def get_ledger_path(config: dict[str, object]) -> Optional[str]:
+    """
+    Get the path to the analysis ledger database from the config.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Path to the ledger database, or None if the ledger is not configured.
+    :rtype: Optional[str]
+    """
+    ledger_path = config.get('analysis_ledger_db', None)
+    if not ledger_path:
+        return None
+
+    return os.path.abspath(ledger_path)
+
+
+def connect(ledger_path: str) -> sqlite3.Connection:
+    """
+    Open a connection to the analysis ledger, creating the database if needed.
+
+    The ledger should live on local disk rather than on the (possibly network-mounted)
+    `analysis_output_dir`, as SQLite locking is unreliable over NFS.
+
+    :param ledger_path: Path to the ledger database.
+    :type ledger_path: str
+    :return: Connection to the ledger database
+    :rtype: sqlite3.Connection
+    """
+    conn = sqlite3.connect(ledger_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    if ledger_path not in _initialized_ledger_paths:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        existing_columns = [row['name'] for row in conn.execute("PRAGMA table_info(analyses)")]
+        for column_name, column_definition in _ADDED_COLUMNS:
+            if column_name not in existing_columns:
+                conn.execute(f"ALTER TABLE analyses ADD COLUMN {column_name} {column_definition}")
+        _initialized_ledger_paths.add(ledger_path)
+
+    return conn
+
+
+def get_analysis(config: dict[str, object], sequencing_run_id: str, pipeline_name: str, pipeline_version: str) -> Optional[dict[str, object]]:
+    """
+    Get the ledger entry for a single analysis.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param sequencing_run_id: Sequencing run ID
+    :type sequencing_run_id: str
+    :param pipeline_name: Pipeline name (eg. 'BCCDC-PHL/basic-sequence-qc')
+    :type pipeline_name: str
+    :param pipeline_version: Pipeline version (eg. 'v0.3.1')
+    :type pipeline_version: str
+    :return: The ledger entry, or None if the analysis is not recorded (or the ledger is not configured).
+    :rtype: Optional[dict[str, object]]
+    """
+    ledger_path = get_ledger_path(config)
+    if ledger_path is None:
+        return None
+
+    with closing(connect(ledger_path)) as conn:
+        row = conn.execute(
+            "SELECT * FROM analyses WHERE sequencing_run_id = ? AND pipeline_name = ? AND pipeline_version = ?",
+            (sequencing_run_id, pipeline_name, pipeline_version),
+        ).fetchone()
+
+    if row is None:
+        return None
+
+    return dict(row)
+
+
+def get_analysis_states_by_run(config: dict[str, object]) -> dict[str, dict[tuple[str, str], str]]:
+    """
+    Load the state of every analysis in the ledger, using a single query.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Analysis states, indexed by sequencing run ID and then by (pipeline_name, pipeline_version).
+    :rtype: dict[str, dict[tuple[str, str], str]]
+    """
+    analysis_states_by_run = {}
+    ledger_path = get_ledger_path(config)
+    if ledger_path is None:
+        return analysis_states_by_run
+
+    with closing(connect(ledger_path)) as conn:
+        rows = conn.execute("SELECT sequencing_run_id, pipeline_name, pipeline_version, state FROM analyses")
+        for sequencing_run_id, pipeline_name, pipeline_version, state in rows:
+            run_analysis_states = analysis_states_by_run.setdefault(sequencing_run_id, {})
+            run_analysis_states[(pipeline_name, pipeline_version)] = state
+
+    return analysis_states_by_run
+
+
+def all_analyses_started(run_analysis_states: dict[tuple[str, str], str], pipelines: list[dict[str, object]]) -> bool:
+    """
+    Check whether every configured pipeline has already been initiated for a run, according to the ledger.
+
+    :param run_analysis_states: Analysis states for a single run, indexed by (pipeline_name, pipeline_version).
+    :type run_analysis_states: dict[tuple[str, str], str]
+    :param pipelines: Pipelines from the application config.
+    :type pipelines: list[dict[str, object]]
+    :return: Whether all pipelines have already been initiated for the run.
+    :rtype: bool
+    """
+    pipelines = [p for p in pipelines if p is not None]
+    if not run_analysis_states or not pipelines:
+        return False
+
+    for pipeline in pipelines:
+        state = run_analysis_states.get((pipeline['name'], pipeline['version']), None)
+        if state not in STARTED_ANALYSIS_STATES:
+            return False
+
+    return True
+
+
+def set_analysis_state(config: dict[str, object], sequencing_run_id: str, pipeline_name: str, pipeline_version: str, state: str, work_dir: Optional[str]=None, outdir: Optional[str]=None, exit_code: Optional[int]=None, input_bytes: Optional[int]=None, only_if_absent: bool=False):
+    """
+    Record the state of an analysis in the ledger. Does nothing if the ledger is not configured.
+
+    The `timestamp_<state>` column for the new state is set to the current time. Existing
+    `work_dir`, `outdir`, `exit_code` and `input_bytes` values are preserved unless new values are provided.
+    Each change to the 'running' state counts as an attempt.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param sequencing_run_id: Sequencing run ID
+    :type sequencing_run_id: str
+    :param pipeline_name: Pipeline name
+    :type pipeline_name: str
+    :param pipeline_version: Pipeline version
+    :type pipeline_version: str
+    :param state: One of: ['discovered', 'queued', 'running', 'complete', 'failed']
+    :type state: str
+    :param work_dir: Nextflow work dir used for the analysis
+    :type work_dir: Optional[str]
+    :param outdir: Pipeline output dir for the analysis
+    :type outdir: Optional[str]
+    :param exit_code: nextflow exit code, for analyses that have finished
+    :type exit_code: Optional[int]
+    :param input_bytes: Total size of the run's input fastq files
+    :type input_bytes: Optional[int]
+    :param only_if_absent: Only record the state if the analysis is not already in the ledger.
+    :type only_if_absent: bool
+    :return: None
+    :rtype: NoneType
+    """
+    if state not in ANALYSIS_STATES:
+        raise ValueError(f"Unknown analysis state: {state}")
+
+    ledger_path = get_ledger_path(config)
+    if ledger_path is None:
+        return None
+
+    timestamp = datetime.datetime.now().isoformat()
+    timestamp_column = 'timestamp_' + state
+    attempts = 1 if state == 'running' else 0
+    insert_sql = (
+        f"INSERT INTO analyses (sequencing_run_id, pipeline_name, pipeline_version, state, work_dir, outdir, attempts, exit_code, input_bytes, {timestamp_column}, timestamp_updated) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+    )
+    if only_if_absent:
+        insert_sql += "ON CONFLICT DO NOTHING"
+    else:
+        insert_sql += (
+            "ON CONFLICT (sequencing_run_id, pipeline_name, pipeline_version) DO UPDATE SET "
+            "state = excluded.state, "
+            "work_dir = COALESCE(excluded.work_dir, work_dir), "
+            "outdir = COALESCE(excluded.outdir, outdir), "
+            "attempts = attempts + excluded.attempts, "
+            "exit_code = COALESCE(excluded.exit_code, exit_code), "
+            "input_bytes = COALESCE(excluded.input_bytes, input_bytes), "
+            f"{timestamp_column} = excluded.{timestamp_column}, "
+            "timestamp_updated = excluded.timestamp_updated"
+        )
+
+    with closing(connect(ledger_path)) as conn, conn:
+        conn.execute(insert_sql, (sequencing_run_id, pipeline_name, pipeline_version, state, work_dir, outdir, attempts, exit_code, input_bytes, timestamp, timestamp))
+
+    return None
+
+
+def reset_interrupted_analyses(config: dict[str, object]) -> dict[str, int]:
+    """
+    Put analyses that were left 'queued' or 'running' when auto-analysis last stopped (eg. it was killed, or
+    the host crashed) back in the 'discovered' state, so that the next scan picks them up again. The ledger
+    belongs to a single instance, so this must be done at startup, before any analyses are started.
+
+    Their work dirs are kept, so analyses that were running are resumed (see `core.analyze_pipeline`).
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Number of analyses reset, by the state they were left in.
+    :rtype: dict[str, int]
+    """
+    num_analyses_by_state = {'queued': 0, 'running': 0}
+    ledger_path = get_ledger_path(config)
+    if ledger_path is None:
+        return num_analyses_by_state
+
+    timestamp = datetime.datetime.now().isoformat()
+    with closing(connect(ledger_path)) as conn, conn:
+        for state in num_analyses_by_state:
+            cursor = conn.execute(
+                "UPDATE analyses SET state = 'discovered', timestamp_discovered = ?, timestamp_updated = ? WHERE state = ?",
+                (timestamp, timestamp, state),
+            )
+            num_analyses_by_state[state] = cursor.rowcount
+
+    if any(num_analyses_by_state.values()):
+        logging.warning(json.dumps({
+            "event_type": "interrupted_analyses_reset",
+            "num_analyses_by_state": num_analyses_by_state,
+        }))
+
+    return num_analyses_by_state
+
+
+def get_active_work_dirs(config: dict[str, object]) -> set[str]:
+    """
+    Get the work dirs of analyses that are queued (including retries waiting out their backoff) or running,
+    and of interrupted analyses that will be resumed ('discovered', with a work dir). They must not be deleted.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Absolute paths of the work dirs in use.
+    :rtype: set[str]
+    """
+    active_work_dirs = set()
+    ledger_path = get_ledger_path(config)
+    if ledger_path is None:
+        return active_work_dirs
+
+    with closing(connect(ledger_path)) as conn:
+        rows = conn.execute("SELECT work_dir FROM analyses WHERE state IN ('discovered', 'queued', 'running') AND work_dir IS NOT NULL")
+        for (work_dir,) in rows:
+            active_work_dirs.add(os.path.abspath(work_dir))
+
+    return active_work_dirs
+
+
+def get_seconds_per_input_byte_history(config: dict[str, object], pipeline_name: str, pipeline_version: Optional[str]=None, max_analyses: int=50) -> list[float]:
+    """
+    Get the analysis time per byte of input of a pipeline's most recent analyses that completed
+    on their first attempt. Resumed analyses are excluded, as they don't repeat the tasks that
+    completed in earlier attempts.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param pipeline_name: Pipeline name
+    :type pipeline_name: str
+    :param pipeline_version: Pipeline version. If None, analyses using any version of the pipeline are included.
+    :type pipeline_version: Optional[str]
+    :param max_analyses: Maximum number of recent analyses to include.
+    :type max_analyses: int
+    :return: Seconds of analysis time per input byte, most recent first. Empty if there is no history for the pipeline.
+    :rtype: list[float]
+    """
+    ledger_path = get_ledger_path(config)
+    if ledger_path is None:
+        return []
+
+    query = (
+        "SELECT timestamp_running, timestamp_complete, input_bytes FROM analyses "
+        "WHERE pipeline_name = ? AND state = 'complete' AND attempts = 1 AND input_bytes > 0 "
+        "AND timestamp_running IS NOT NULL AND timestamp_complete IS NOT NULL"
+    )
+    query_params = [pipeline_name]
+    if pipeline_version is not None:
+        query += " AND pipeline_version = ?"
+        query_params.append(pipeline_version)
+    query += " ORDER BY timestamp_complete DESC LIMIT ?"
+    query_params.append(max_analyses)
+
+    seconds_per_input_byte = []
+    with closing(connect(ledger_path)) as conn:
+        for timestamp_running, timestamp_complete, input_bytes in conn.execute(query, query_params):
+            try:
+                analysis_duration = datetime.datetime.fromisoformat(timestamp_complete) - datetime.datetime.fromisoformat(timestamp_running)
+            except ValueError as e:
+                continue
+            if analysis_duration.total_seconds() > 0:
+                seconds_per_input_byte.append(analysis_duration.total_seconds() / input_bytes)
+
+    return seconds_per_input_byte
+
+
+def get_seconds_per_input_byte(config: dict[str, object], pipeline_name: str, pipeline_version: Optional[str]=None, max_analyses: int=50) -> Optional[float]:
+    """
+    Estimate how long a pipeline takes per byte of input (see `get_seconds_per_input_byte_history`).
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param pipeline_name: Pipeline name
+    :type pipeline_name: str
+    :param pipeline_version: Pipeline version. If None, analyses using any version of the pipeline are included.
+    :type pipeline_version: Optional[str]
+    :param max_analyses: Maximum number of recent analyses to include.
+    :type max_analyses: int
+    :return: Median seconds of analysis time per input byte, or None if there is no history for the pipeline.
+    :rtype: Optional[float]
+    """
+    seconds_per_input_byte = get_seconds_per_input_byte_history(config, pipeline_name, pipeline_version, max_analyses)
+    if not seconds_per_input_byte:
+        return None
+
+    return statistics.median(seconds_per_input_byte)
+
+
+def import_analysis_output_dirs(config: dict[str, object]) -> dict[str, int]:
+    """
+    Seed the ledger from the existing analysis output directories. Intended to be run once,
+    when the ledger is first enabled for an `analysis_output_dir` containing historical runs.
+
+    For every run directory, each configured pipeline whose output directory exists is recorded
+    as 'complete' if it contains an `analysis_complete.json` file, or 'failed' otherwise.
+    Analyses that are already recorded in the ledger are left unchanged.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Number of analyses found in the output directories, by state.
+    :rtype: dict[str, int]
+    """
+    num_analyses_by_state = {'complete': 0, 'failed': 0}
+    if get_ledger_path(config) is None:
+        logging.error(json.dumps({"event_type": "import_ledger_failed", "reason": "analysis_ledger_db_not_configured"}))
+        return num_analyses_by_state
+
+    base_analysis_outdir = config['analysis_output_dir']
+    pipelines = [p for p in config.get('pipelines', []) if p is not None]
+    with os.scandir(base_analysis_outdir) as run_dirs:
+        for run_dir in run_dirs:
+            if not run_dir.is_dir():
+                continue
+            sequencing_run_id = run_dir.name
+            for pipeline in pipelines:
+                pipeline_short_name = pipeline['name'].split('/')[1]
+                pipeline_minor_version = ''.join(pipeline['version'].rsplit('.', 1)[0])
+                pipeline_output_dirname = '-'.join([pipeline_short_name, pipeline_minor_version, 'output'])
+                pipeline_output_dir = os.path.abspath(os.path.join(run_dir.path, pipeline_output_dirname))
+                if not os.path.isdir(pipeline_output_dir):
+                    continue
+                if os.path.exists(os.path.join(pipeline_output_dir, 'analysis_complete.json')):
+                    state = 'complete'
+                else:
+                    state = 'failed'
+                set_analysis_state(
+                    config, sequencing_run_id, pipeline['name'], pipeline['version'], state,
+                    outdir=pipeline_output_dir,
+                    only_if_absent=True,
+                )
+                num_analyses_by_state[state] += 1
+
+    logging.info(json.dumps({
+        "event_type": "import_ledger_complete",
+        "analysis_output_dir": os.path.abspath(base_analysis_outdir),
+        "num_analyses_by_state": num_analyses_by_state,
+    }))
+
+    return num_analyses_by_state
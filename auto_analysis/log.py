@@ -0,0 +1,231 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import sys
+import threading
+import time
+
+from typing import Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# Rate limits are counted over windows of this many seconds.
+RATE_LIMIT_WINDOW_SECONDS = 60.0
+
+_EVENT_TYPE_REGEX = re.compile(r'"event_type":\s*"([^"]*)"')
+
+
+def dumps(obj: object) -> str:
+    """
+    Serialize an object to JSON, with orjson if it is installed.
+
+    :param obj: Object to serialize
+    :type obj: object
+    :return: JSON
+    :rtype: str
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            # orjson is stricter than json (eg. about non-str dict keys).
+            pass
+
+    return json.dumps(obj)
+
+
+def _get_event_type(record: logging.LogRecord) -> Optional[str]:
+    if isinstance(record.msg, dict):
+        return record.msg.get('event_type', None)
+    if isinstance(record.msg, str):
+        event_type_match = _EVENT_TYPE_REGEX.search(record.msg, 0, 200)
+        if event_type_match:
+            return event_type_match.group(1)
+
+    return None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format log records as JSON Lines, with keys: ['timestamp', 'level', 'module', 'function_name', 'line_num', 'message'],
+    as expected by the Genomics Services Monitor.
+
+    The message is expected to be an event: either a dict, which is serialized here, or a string that has already
+    been serialized with `json.dumps`. Any other message (eg. from a third-party library) is included as a JSON string.
+    """
+
+    def __init__(self):
+        super().__init__(datefmt=DATE_FORMAT)
+
+    def format(self, record: logging.LogRecord) -> str:
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+
+        if isinstance(record.msg, dict) and not record.args:
+            message = dumps(record.msg)
+        else:
+            message = record.getMessage()
+            if not message.startswith('{'):
+                message = dumps({"event_type": "log_message", "message": message}) if record.exc_text else dumps(message)
+        if record.exc_text:
+            # The traceback is added to the event, so that the line stays valid JSON.
+            message = message[:-1].rstrip() + ', "traceback": ' + dumps(record.exc_text) + '}'
+
+        timestamp = self.formatTime(record, self.datefmt) + '.%03d' % record.msecs
+
+        return (
+            '{"timestamp": "' + timestamp + '", "level": "' + record.levelname + '", "module": ' + dumps(record.module)
+            + ', "function_name": ' + dumps(record.funcName) + ', "line_num": ' + str(record.lineno) + ', "message": ' + message + '}'
+        )
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Limit how many events of each type are logged per `RATE_LIMIT_WINDOW_SECONDS`. Once a window has passed, the number
+    of events that were dropped is logged in a single 'log_events_suppressed' event, along with the next event after
+    the window. Events of types without a limit are always logged.
+    """
+
+    def __init__(self, rate_limits: Optional[dict[str, int]]=None):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._rate_limits = {}
+        self._window_start = time.monotonic()
+        self._num_logged = {}
+        self._num_suppressed = {}
+        self.update_rate_limits(rate_limits)
+
+    def update_rate_limits(self, rate_limits: Optional[dict[str, int]]):
+        """
+        :param rate_limits: Maximum number of events logged per window, by event type.
+        :type rate_limits: Optional[dict[str, int]]
+        """
+        with self._lock:
+            self._rate_limits = {event_type: int(limit) for event_type, limit in (rate_limits or {}).items()}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not self._rate_limits:
+            return True
+        suppressed_summary = None
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= RATE_LIMIT_WINDOW_SECONDS:
+                if self._num_suppressed:
+                    suppressed_summary = {
+                        "event_type": "log_events_suppressed",
+                        "window_seconds": round(now - self._window_start, 1),
+                        "num_events_suppressed_by_event_type": self._num_suppressed,
+                    }
+                self._window_start = now
+                self._num_logged = {}
+                self._num_suppressed = {}
+
+            event_type = _get_event_type(record)
+            limit = self._rate_limits.get(event_type, None)
+            allowed = True
+            if limit is not None:
+                num_logged = self._num_logged.get(event_type, 0)
+                if num_logged >= limit:
+                    self._num_suppressed[event_type] = self._num_suppressed.get(event_type, 0) + 1
+                    allowed = False
+                else:
+                    self._num_logged[event_type] = num_logged + 1
+
+        if suppressed_summary is not None:
+            logging.getLogger(record.name).warning(suppressed_summary)
+
+        return allowed
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Hand records to the writer thread with as little work as possible in the logging thread. Unlike the standard
+    `QueueHandler`, the message isn't formatted here: event dicts are serialized once, by the formatter, in the writer thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        if record.args:
+            # Arguments may be mutated after the call returns, so they're merged into the message now.
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+
+_queue_listener = None
+_rate_limit_filter = None
+
+
+def configure_logging(log_level: int=logging.INFO, stream=None) -> logging.handlers.QueueListener:
+    """
+    Set up the root logger to write JSON Lines (see `JsonFormatter`) from a background writer thread, so that
+    logging never blocks on the output stream. The writer thread is flushed and stopped when the process exits.
+
+    :param log_level: Log level
+    :type log_level: int
+    :param stream: Stream to write to. Defaults to stderr.
+    :return: The listener that runs the writer thread.
+    :rtype: logging.handlers.QueueListener
+    """
+    global _queue_listener, _rate_limit_filter
+
+    stream_handler = logging.StreamHandler(stream or sys.stderr)
+    stream_handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    _rate_limit_filter = RateLimitFilter()
+    queue_handler.addFilter(_rate_limit_filter)
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(log_level)
+
+    if _queue_listener is None:
+        atexit.register(stop_logging)
+    else:
+        stop_logging()
+    _queue_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _queue_listener.start()
+
+    return _queue_listener
+
+
+def stop_logging():
+    """
+    Write out any queued log records and stop the writer thread.
+
+    :return: None
+    :rtype: NoneType
+    """
+    if _queue_listener is not None and _queue_listener._thread is not None:
+        _queue_listener.stop()
+
+
+def update_rate_limits(rate_limits: Optional[dict[str, int]]):
+    """
+    Set the per-event-type rate limits (see `RateLimitFilter`), eg. from the `log_rate_limits` config.
+
+    :param rate_limits: Maximum number of events logged per minute, by event type.
+    :type rate_limits: Optional[dict[str, int]]
+    :return: None
+    :rtype: NoneType
+    """
+    if _rate_limit_filter is not None:
+        _rate_limit_filter.update_rate_limits(rate_limits)
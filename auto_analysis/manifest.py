@@ -0,0 +1,259 @@
+import csv
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from typing import Optional
+
+
+MANIFEST_FILENAME = 'fastq_manifest.json'
+SAMPLESHEET_FILENAME = 'samplesheet.csv'
+SAMPLESHEET_FIELDNAMES = ['ID', 'R1', 'R2']
+
+FASTQ_GZ_FILENAME_REGEX = re.compile(r'\.f(ast)?q\.gz$')
+READ_NUMBER_REGEX = re.compile(r'_R([12])(?=[_.])')
+
+# A directory modified this recently may still be changing within the resolution of its mtime
+# (which can be as coarse as 1s on NFS), so a matching mtime doesn't prove that its contents are unchanged.
+RACY_MTIME_WINDOW_NS = 2 * 1000 ** 3
+
+# Manifests are kept in memory as well as on disk, indexed by absolute fastq directory path.
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def _get_fingerprint(stat_result: os.stat_result) -> list[int]:
+    return [stat_result.st_dev, stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns]
+
+
+def _parse_fastq_filename(filename: str) -> dict[str, object]:
+    """
+    Parse the library ID and read number (1 or 2) from a fastq filename like 'LIBRARY-ID_S1_L001_R1_001.fastq.gz'.
+    The read number is None if it can't be determined.
+    """
+    library_id = filename.split('_')[0]
+    read_number_match = READ_NUMBER_REGEX.search(filename)
+    read_number = int(read_number_match.group(1)) if read_number_match else None
+
+    return {
+        'library_id': library_id,
+        'read_number': read_number,
+    }
+
+
+def _examine_fastq_file(path: str, fingerprint: list[int]) -> dict[str, object]:
+    fastq_file = _parse_fastq_filename(os.path.basename(path))
+    fastq_file['path'] = path
+    fastq_file['fingerprint'] = fingerprint
+    try:
+        # Follows symlinks. Only done for new or changed entries.
+        fastq_file['size'] = os.stat(path).st_size
+    except OSError as e:
+        fastq_file['size'] = None
+
+    return fastq_file
+
+
+def _pair_fastq_files(fastq_files: dict[str, dict[str, object]]) -> tuple[dict[str, dict[str, object]], list[dict[str, object]]]:
+    """
+    Pair up R1 and R2 files by library ID, collecting anything that doesn't pair cleanly as an anomaly.
+    If there are several files for the same library and read number, the first (by filename) is used.
+    """
+    libraries = {}
+    anomalies = []
+    paths_by_library_read = {}
+    for filename, fastq_file in sorted(fastq_files.items()):
+        if fastq_file['size'] is None:
+            anomalies.append({'type': 'broken_symlink', 'library_id': fastq_file['library_id'], 'paths': [fastq_file['path']]})
+            continue
+        if fastq_file['read_number'] is None:
+            anomalies.append({'type': 'unrecognized_read_number', 'library_id': fastq_file['library_id'], 'paths': [fastq_file['path']]})
+            continue
+        paths_by_library_read.setdefault((fastq_file['library_id'], fastq_file['read_number']), []).append(fastq_file['path'])
+
+    for (library_id, read_number), paths in sorted(paths_by_library_read.items()):
+        library = libraries.setdefault(library_id, {'ID': library_id, 'R1': None, 'R2': None})
+        library['R' + str(read_number)] = paths[0]
+        if len(paths) > 1:
+            anomalies.append({'type': 'duplicate_library_id', 'library_id': library_id, 'read_number': read_number, 'paths': paths})
+
+    for library_id, library in sorted(libraries.items()):
+        if library['R2'] is None:
+            anomalies.append({'type': 'orphan_r1', 'library_id': library_id, 'paths': [library['R1']]})
+        elif library['R1'] is None:
+            anomalies.append({'type': 'orphan_r2', 'library_id': library_id, 'paths': [library['R2']]})
+
+    return libraries, anomalies
+
+
+def _load_manifest(manifest_path: Optional[str], fastq_directory: str) -> Optional[dict[str, object]]:
+    if manifest_path is None:
+        return None
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        return None
+    if manifest.get('fastq_directory', None) != fastq_directory:
+        return None
+
+    return manifest
+
+
+def _save_manifest(manifest: dict[str, object], manifest_path: str):
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    manifest_tmp_path = manifest_path + '.tmp'
+    with open(manifest_tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+        f.write('\n')
+    os.replace(manifest_tmp_path, manifest_path)
+
+
+def _scan_fastq_directory(fastq_directory: str, directory_fingerprint: list[int], previous_manifest: Optional[dict[str, object]]) -> dict[str, object]:
+    """
+    List the fastq directory, re-examining only the entries that are new or whose fingerprint has changed.
+    """
+    previous_fastq_files = previous_manifest['files'] if previous_manifest is not None else {}
+    fastq_files = {}
+    num_examined = 0
+    with os.scandir(fastq_directory) as entries:
+        for entry in entries:
+            if not FASTQ_GZ_FILENAME_REGEX.search(entry.name):
+                continue
+            try:
+                # The fingerprint is of the directory entry itself, so a symlink that's repointed is re-examined.
+                fingerprint = _get_fingerprint(entry.stat(follow_symlinks=False))
+            except OSError as e:
+                continue
+            previous_fastq_file = previous_fastq_files.get(entry.name, None)
+            if previous_fastq_file is not None and previous_fastq_file['fingerprint'] == fingerprint:
+                fastq_files[entry.name] = previous_fastq_file
+            else:
+                fastq_files[entry.name] = _examine_fastq_file(os.path.join(fastq_directory, entry.name), fingerprint)
+                num_examined += 1
+
+    libraries, anomalies = _pair_fastq_files(fastq_files)
+    manifest = {
+        'fastq_directory': fastq_directory,
+        'directory_fingerprint': directory_fingerprint,
+        'files': fastq_files,
+        'libraries': libraries,
+        'anomalies': anomalies,
+    }
+    logging.info(json.dumps({
+        "event_type": "fastq_manifest_updated",
+        "fastq_directory": fastq_directory,
+        "num_files": len(fastq_files),
+        "num_files_examined": num_examined,
+        "num_libraries": len(libraries),
+        "num_anomalies": len(anomalies),
+    }))
+    previous_anomalies = previous_manifest['anomalies'] if previous_manifest is not None else []
+    for anomaly in anomalies:
+        if anomaly in previous_anomalies:
+            continue
+        logging.warning(json.dumps({"event_type": "fastq_pairing_anomaly", "fastq_directory": fastq_directory, **anomaly}))
+
+    return manifest
+
+
+def get_manifest(fastq_directory: str, manifest_path: Optional[str]=None) -> dict[str, object]:
+    """
+    Get the manifest of fastq files in a directory, pairing R1 and R2 files by library ID.
+
+    The manifest is cached in memory and, if `manifest_path` is given, on disk. If the directory itself is unchanged
+    since the manifest was built, the cached manifest is used without listing the directory. Otherwise, the directory
+    is listed, and only new or changed entries (by device, inode, size and mtime) are re-examined.
+
+    :param fastq_directory: Path to a directory containing fastq files.
+    :type fastq_directory: str
+    :param manifest_path: Path to store the manifest at, so that it survives restarts.
+    :type manifest_path: Optional[str]
+    :return: The manifest. Keys: ['fastq_directory', 'directory_fingerprint', 'files', 'libraries', 'anomalies'].
+             `libraries` is indexed by library ID, with values with keys: ['ID', 'R1', 'R2'].
+             `anomalies` is a list of pairing problems, with keys: ['type', 'library_id', 'paths'].
+             Types are: 'orphan_r1', 'orphan_r2', 'duplicate_library_id', 'unrecognized_read_number' and 'broken_symlink'.
+    :rtype: dict[str, object]
+    """
+    fastq_directory = os.path.abspath(fastq_directory)
+    with _manifests_lock:
+        directory_stat = os.stat(fastq_directory)
+        directory_fingerprint = _get_fingerprint(directory_stat)
+        directory_fingerprint_trusted = time.time_ns() - directory_stat.st_mtime_ns > RACY_MTIME_WINDOW_NS
+
+        manifest = _manifests.get(fastq_directory, None)
+        if manifest is None:
+            manifest = _load_manifest(manifest_path, fastq_directory)
+        if manifest is not None and manifest.get('directory_fingerprint_trusted', False) and manifest['directory_fingerprint'] == directory_fingerprint:
+            _manifests[fastq_directory] = manifest
+            return manifest
+
+        manifest = _scan_fastq_directory(fastq_directory, directory_fingerprint, manifest)
+        manifest['directory_fingerprint_trusted'] = directory_fingerprint_trusted
+        _manifests[fastq_directory] = manifest
+        if manifest_path is not None:
+            _save_manifest(manifest, manifest_path)
+
+    return manifest
+
+
+def get_run_manifest(config: dict[str, object], run: dict[str, object]) -> dict[str, object]:
+    """
+    Get the manifest of a run's fastq files, stored at `<analysis_output_dir>/<run>/fastq_manifest.json`.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run: The run dictionary. Expected keys: ['sequencing_run_id', 'fastq_directory']
+    :type run: dict[str, object]
+    :return: The manifest (see `get_manifest`)
+    :rtype: dict[str, object]
+    """
+    manifest_path = os.path.abspath(os.path.join(config['analysis_output_dir'], run['sequencing_run_id'], MANIFEST_FILENAME))
+
+    return get_manifest(run['fastq_directory'], manifest_path)
+
+
+def write_samplesheet(manifest: dict[str, object], samplesheet_path: str, library_ids: Optional[list[str]]=None) -> str:
+    """
+    Write a samplesheet (with columns: ID, R1, R2) for the libraries in a manifest. The file is only
+    rewritten if its contents would change, so that nextflow's `-resume` cache for it stays valid.
+
+    :param manifest: The manifest (see `get_manifest`)
+    :type manifest: dict[str, object]
+    :param samplesheet_path: Path to write the samplesheet to.
+    :type samplesheet_path: str
+    :param library_ids: Only include these libraries. If None, all libraries in the manifest are included.
+    :type library_ids: Optional[list[str]]
+    :return: Path to the samplesheet
+    :rtype: str
+    """
+    samplesheet = io.StringIO()
+    writer = csv.DictWriter(samplesheet, fieldnames=SAMPLESHEET_FIELDNAMES, dialect='unix', quoting=csv.QUOTE_MINIMAL, extrasaction='ignore')
+    writer.writeheader()
+    for library_id, library in sorted(manifest['libraries'].items()):
+        if library_ids is not None and library_id not in library_ids:
+            continue
+        writer.writerow(library)
+    samplesheet_contents = samplesheet.getvalue()
+
+    try:
+        with open(samplesheet_path, 'r') as f:
+            if f.read() == samplesheet_contents:
+                return samplesheet_path
+    except OSError as e:
+        pass
+
+    # The pipelines of a run are prepared in parallel, and share the samplesheet, so each writes its own temp file.
+    os.makedirs(os.path.dirname(samplesheet_path), exist_ok=True)
+    fd, samplesheet_tmp_path = tempfile.mkstemp(prefix=os.path.basename(samplesheet_path) + '.', suffix='.tmp', dir=os.path.dirname(samplesheet_path))
+    with os.fdopen(fd, 'w') as f:
+        f.write(samplesheet_contents)
+    os.chmod(samplesheet_tmp_path, 0o644)
+    os.replace(samplesheet_tmp_path, samplesheet_path)
+
+    return samplesheet_path
@@ -0,0 +1,380 @@
+import bisect
+import contextlib
+import http.server
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from typing import Iterator, Optional
+
+
+DEFAULT_METRICS_CONFIG = {
+    # If set, metrics are written to this file in the Prometheus text format (eg. for the node_exporter textfile collector).
+    "textfile_path": None,
+    "write_interval_seconds": 15,
+    # If set, metrics are served at `http://<http_address>:<http_port>/metrics`.
+    "http_port": None,
+    "http_address": "127.0.0.1",
+}
+
+# Buckets for durations, in seconds. Stages range from sub-second (notifications) to many hours (nextflow).
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900, 1800, 3600, 7200, 14400, 28800, 86400)
+
+# Metric name -> (type, help)
+METRICS = {
+    "auto_analysis_scan_duration_seconds": ("histogram", "Time taken to scan fastq_by_run_dir for runs to analyze."),
+    "auto_analysis_runs_discovered_total": ("counter", "Runs found ready to analyze by a scan."),
+    "auto_analysis_directories_skipped_total": ("counter", "Directories skipped by scans, counted once for each condition that wasn't met."),
+    "auto_analysis_stage_duration_seconds": ("histogram", "Time taken by each stage of a pipeline's analysis."),
+    "auto_analysis_run_duration_seconds": ("histogram", "Time taken to analyze a run with all pipelines."),
+    "auto_analysis_analyses_total": ("counter", "Pipeline analyses finished, by outcome."),
+    "auto_analysis_notification_send_duration_seconds": ("histogram", "Time taken to send a notification email."),
+    "auto_analysis_notifications_total": ("counter", "Notification emails sent, by outcome."),
+    "auto_analysis_analyses_running": ("gauge", "Pipeline analyses currently running."),
+    "auto_analysis_analyses_queued": ("gauge", "Pipeline analyses waiting for an analysis slot."),
+    "auto_analysis_runs_in_progress": ("gauge", "Runs currently being analyzed."),
+    "auto_analysis_notifications_pending": ("gauge", "Notifications waiting to be sent."),
+    "auto_analysis_work_dir_free_bytes": ("gauge", "Free space on the filesystem holding analysis_work_dir."),
+    "auto_analysis_work_dir_size_bytes": ("gauge", "Size of the filesystem holding analysis_work_dir."),
+    "auto_analysis_work_dir_bytes_reclaimed_total": ("counter", "Bytes freed by deleting analysis work dirs."),
+    "auto_analysis_work_dirs_deleted_total": ("counter", "Analysis work dirs deleted."),
+    "auto_analysis_run_claims_total": ("counter", "Attempts to claim a run for analysis by this instance, by outcome."),
+    "auto_analysis_run_claims_held": ("gauge", "Runs currently claimed by this instance."),
+    "auto_analysis_warm_up_duration_seconds": ("histogram", "Time taken to pull a pipeline and build its environments, by outcome."),
+    "auto_analysis_pipelines_by_warm_up_state": ("gauge", "Configured pipeline versions in each warm-up state."),
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+
+def _get_key(name: str, labels: Optional[dict[str, str]]) -> tuple:
+    if not labels:
+        return (name, ())
+    return (name, tuple(sorted(labels.items())))
+
+
+def inc(name: str, labels: Optional[dict[str, str]]=None, value: float=1):
+    """
+    Increment a counter.
+
+    :param name: Metric name, from `METRICS`
+    :type name: str
+    :param labels: Metric labels
+    :type labels: Optional[dict[str, str]]
+    :param value: Amount to increment by
+    :type value: float
+    :return: None
+    :rtype: NoneType
+    """
+    key = _get_key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, value: float, labels: Optional[dict[str, str]]=None):
+    """
+    Record an observation (eg. a duration) in a histogram.
+
+    :param name: Metric name, from `METRICS`
+    :type name: str
+    :param value: Observed value
+    :type value: float
+    :param labels: Metric labels
+    :type labels: Optional[dict[str, str]]
+    :return: None
+    :rtype: NoneType
+    """
+    key = _get_key(name, labels)
+    bucket_index = bisect.bisect_left(DURATION_BUCKETS, value)
+    with _lock:
+        histogram = _histograms.get(key, None)
+        if histogram is None:
+            # Counts per bucket (the last is +Inf), sum, count. Counts are made cumulative when rendered.
+            histogram = [[0] * (len(DURATION_BUCKETS) + 1), 0.0, 0]
+            _histograms[key] = histogram
+        histogram[0][bucket_index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+@contextlib.contextmanager
+def timer(name: str, labels: Optional[dict[str, str]]=None) -> Iterator[None]:
+    """
+    Record the duration of the `with` block in a histogram. Nothing is recorded if the block raises an exception.
+
+    :param name: Metric name, from `METRICS`
+    :type name: str
+    :param labels: Metric labels
+    :type labels: Optional[dict[str, str]]
+    """
+    start = time.monotonic()
+    yield
+    observe(name, time.monotonic() - start, labels)
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    formatted_labels = []
+    for label_name, label_value in labels:
+        label_value = str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        formatted_labels.append(label_name + '="' + label_value + '"')
+
+    return '{' + ','.join(formatted_labels) + '}'
+
+
+def _format_number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+
+def render(gauges: Optional[list[tuple[str, Optional[dict[str, str]], float]]]=None) -> str:
+    """
+    Render all metrics in the Prometheus text exposition format.
+
+    :param gauges: Current values of gauges (and of counters kept elsewhere), as (name, labels, value).
+    :type gauges: Optional[list[tuple[str, Optional[dict[str, str]], float]]]
+    :return: Metrics
+    :rtype: str
+    """
+    with _lock:
+        samples_by_name = {}
+        for (name, labels), value in _counters.items():
+            samples_by_name.setdefault(name, []).append((labels, value))
+        histograms_by_name = {}
+        for (name, labels), (bucket_counts, histogram_sum, histogram_count) in _histograms.items():
+            histograms_by_name.setdefault(name, []).append((labels, list(bucket_counts), histogram_sum, histogram_count))
+    for name, labels, value in gauges or []:
+        samples_by_name.setdefault(name, []).append((_get_key(name, labels)[1], value))
+
+    lines = []
+    for name in sorted(set(samples_by_name) | set(histograms_by_name)):
+        metric_type, metric_help = METRICS.get(name, ('untyped', ''))
+        lines.append('# HELP ' + name + ' ' + metric_help)
+        lines.append('# TYPE ' + name + ' ' + metric_type)
+        for labels, value in sorted(samples_by_name.get(name, [])):
+            lines.append(name + _format_labels(labels) + ' ' + _format_number(value))
+        for labels, bucket_counts, histogram_sum, histogram_count in sorted(histograms_by_name.get(name, [])):
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip(DURATION_BUCKETS + (float('inf'),), bucket_counts):
+                cumulative_count += bucket_count
+                lines.append(name + '_bucket' + _format_labels(labels + (('le', _format_number(upper_bound)),)) + ' ' + str(cumulative_count))
+            lines.append(name + '_sum' + _format_labels(labels) + ' ' + _format_number(histogram_sum))
+            lines.append(name + '_count' + _format_labels(labels) + ' ' + str(histogram_count))
+
+    return '\n'.join(lines) + '\n'
+
+
+def get_metrics_config(config: dict[str, object]) -> dict[str, object]:
+    """
+    Get the 'metrics' section of the config, with defaults filled in.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Metrics config. Keys: ['textfile_path', 'write_interval_seconds', 'http_port', 'http_address']
+    :rtype: dict[str, object]
+    """
+    metrics_config = dict(DEFAULT_METRICS_CONFIG)
+    metrics_config.update(config.get('metrics', None) or {})
+    metrics_config['write_interval_seconds'] = float(metrics_config['write_interval_seconds'])
+    if metrics_config['http_port'] is not None:
+        metrics_config['http_port'] = int(metrics_config['http_port'])
+
+    return metrics_config
+
+
+class MetricsExporter:
+    """
+    Export metrics to a file and/or over HTTP (see `DEFAULT_METRICS_CONFIG`). Along with the metrics
+    recorded by the rest of the package, gauges are collected from the scheduler, janitor, outbox,
+    run claims and pipeline warmer at the time they are exported.
+    """
+
+    def __init__(self, config: dict[str, object], scheduler=None, janitor=None, outbox=None, claims=None, warmer=None):
+        self.scheduler = scheduler
+        self.janitor = janitor
+        self.outbox = outbox
+        self.claims = claims
+        self.warmer = warmer
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._http_server = None
+        self._http_thread = None
+        self.update_config(config)
+        self._thread = threading.Thread(target=self._run, name='metrics-exporter', daemon=True)
+        self._thread.start()
+
+
+    def update_config(self, config: dict[str, object]):
+        """
+        Apply a new config. The HTTP server is restarted if its address or port has changed.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :return: None
+        :rtype: NoneType
+        """
+        metrics_config = get_metrics_config(config)
+        with self._condition:
+            self._analysis_work_dir = config.get('analysis_work_dir', None)
+            previous_http_address = None
+            if self._http_server is not None:
+                previous_http_address = (self._metrics_config['http_address'], self._metrics_config['http_port'])
+            self._metrics_config = metrics_config
+            self._condition.notify_all()
+
+        http_address = None
+        if metrics_config['http_port'] is not None:
+            http_address = (metrics_config['http_address'], metrics_config['http_port'])
+        if http_address != previous_http_address:
+            self._stop_http_server()
+            if http_address is not None:
+                self._start_http_server(http_address)
+
+
+    def collect_gauges(self) -> list[tuple[str, Optional[dict[str, str]], float]]:
+        """
+        :return: Current values of the gauges (and counters) kept by the scheduler, janitor, outbox, run claims and warmer, as (name, labels, value).
+        :rtype: list[tuple[str, Optional[dict[str, str]], float]]
+        """
+        gauges = []
+        if self.scheduler is not None:
+            scheduler_stats = self.scheduler.stats()
+            gauges.append(("auto_analysis_runs_in_progress", None, scheduler_stats['num_runs_in_progress']))
+            for pipeline_name, num_running in scheduler_stats['num_running_by_pipeline'].items():
+                gauges.append(("auto_analysis_analyses_running", {"pipeline": pipeline_name}, num_running))
+            for pipeline_name, num_waiting in scheduler_stats['num_waiting_by_pipeline'].items():
+                gauges.append(("auto_analysis_analyses_queued", {"pipeline": pipeline_name}, num_waiting))
+        if self.janitor is not None:
+            janitor_stats = self.janitor.stats()
+            gauges.append(("auto_analysis_work_dir_bytes_reclaimed_total", None, janitor_stats['bytes_reclaimed']))
+            gauges.append(("auto_analysis_work_dirs_deleted_total", None, janitor_stats['num_work_dirs_deleted']))
+        if self.outbox is not None:
+            gauges.append(("auto_analysis_notifications_pending", None, self.outbox.num_pending()))
+        if self.claims is not None:
+            gauges.append(("auto_analysis_run_claims_held", None, self.claims.num_held()))
+        if self.warmer is not None:
+            for state, num_pipelines in self.warmer.stats().items():
+                gauges.append(("auto_analysis_pipelines_by_warm_up_state", {"state": state}, num_pipelines))
+        if self._analysis_work_dir and os.path.isdir(self._analysis_work_dir):
+            disk_usage = shutil.disk_usage(self._analysis_work_dir)
+            gauges.append(("auto_analysis_work_dir_free_bytes", None, disk_usage.free))
+            gauges.append(("auto_analysis_work_dir_size_bytes", None, disk_usage.total))
+
+        return gauges
+
+
+    def render(self) -> str:
+        """
+        :return: All metrics, in the Prometheus text exposition format.
+        :rtype: str
+        """
+        return render(self.collect_gauges())
+
+
+    def write_textfile(self):
+        """
+        Write the metrics to the configured `textfile_path`, if any. The file is replaced atomically, so that
+        it is never read half-written.
+
+        :return: None
+        :rtype: NoneType
+        """
+        textfile_path = self._metrics_config['textfile_path']
+        if not textfile_path:
+            return
+        tmp_path = textfile_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(self.render())
+            os.replace(tmp_path, textfile_path)
+        except OSError as e:
+            logging.error(json.dumps({
+                "event_type": "metrics_write_failed",
+                "textfile_path": textfile_path,
+                "error": str(e),
+            }))
+
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopping:
+                    return
+                write_interval_seconds = self._metrics_config['write_interval_seconds']
+            self.write_textfile()
+            with self._condition:
+                if not self._stopping:
+                    self._condition.wait(timeout=write_interval_seconds)
+
+
+    def _start_http_server(self, http_address: tuple[str, int]):
+        exporter = self
+
+        class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._http_server = http.server.ThreadingHTTPServer(http_address, MetricsRequestHandler)
+        except OSError as e:
+            logging.error(json.dumps({
+                "event_type": "metrics_http_server_failed",
+                "http_address": http_address[0],
+                "http_port": http_address[1],
+                "error": str(e),
+            }))
+            return
+        self._http_server.daemon_threads = True
+        self._http_thread = threading.Thread(target=self._http_server.serve_forever, name='metrics-http', daemon=True)
+        self._http_thread.start()
+        logging.info(json.dumps({
+            "event_type": "metrics_http_server_started",
+            "http_address": http_address[0],
+            "http_port": self._http_server.server_address[1],
+        }))
+
+
+    def _stop_http_server(self):
+        if self._http_server is None:
+            return
+        self._http_server.shutdown()
+        self._http_server.server_close()
+        self._http_thread.join()
+        self._http_server = None
+        self._http_thread = None
+
+
+    def close(self):
+        """
+        Write the metrics one last time, and stop the background thread and HTTP server.
+
+        :return: None
+        :rtype: NoneType
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._stop_http_server()
+        self.write_textfile()
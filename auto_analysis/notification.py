@@ -1,114 +1,301 @@
 import argparse
-import datetime
 import glob
 import json
 import logging
 import os
+import threading
+import time
 import uuid
 
 from pathlib import Path
+from typing import Optional
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
 from jinja2 import Environment, Template
 from jinja2 import BaseLoader
 from importlib.resources import files
 
+import auto_analysis.metrics as metrics
 import auto_analysis.parsers as parsers
+import auto_analysis.profiling as profiling
+import auto_analysis.warehouse as warehouse
 from auto_analysis.config import load_config
 
 
-def _get_access_token(email_config: dict):
-    """
-    Get an access token from the MCMS auth service.
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 5
+DEFAULT_READ_TIMEOUT_SECONDS = 30
+# Access tokens are refreshed this long before they expire, so that a token doesn't expire mid-request.
+TOKEN_EXPIRY_MARGIN_SECONDS = 60
 
-    :param config: A dict containing the MCMS auth service URL, client ID, and client secret.
-                   Required keys are: ['auth_url', 'client_id', 'client_secret'].
-    :type config: dict
-    :return: A dict containing the access token and other info.
-             Keys are: ['access_token', 'token_type', 'expires_in', 'timestamp_token_received'].
-    :rtype: dict
+_notification_clients = {}
+_notification_clients_lock = threading.Lock()
+
+
+class NotificationClient:
     """
-    auth_url = email_config['auth_url']
-    client_id = email_config['client_id']
-    client_secret = email_config['client_secret']
-
-    auth = HTTPBasicAuth(client_id, client_secret)
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/x-www-form-urlencoded",
-    }
-    data = {
-        "client_id": client_id,
-        "grant_type": "client_credentials",
-    }
-    response = requests.post(auth_url, data=data, headers=headers, auth=auth)
-    response_json = {}
-    if response.status_code == 200:
-        response_json = response.json()
-        timestamp = datetime.datetime.now().isoformat()
-        response_json['timestamp_token_received'] = timestamp
-    else:
-        logging.error(json.dumps({
-            'event_type': 'email_authentication_failed',
-            'status_code': response.status_code,
-            'message': response.text
-        }))
-        return None
+    Client for the notification (email) service. Connections are pooled in a `requests.Session`,
+    access tokens are reused until shortly before they expire, and the email template is compiled once.
+    Every request has a timeout, so an unresponsive service can't stall analysis.
+    """
+    def __init__(self, notification_config: dict):
+        """
+        :param notification_config: The 'notification' section of the config, with the notification system config merged in.
+                                    Required keys are: ['auth_url', 'email_url', 'client_id', 'client_secret', 'sender_email', 'recipient_email_addresses'].
+                                    Optional keys are: ['subject_tag', 'connect_timeout_seconds', 'read_timeout_seconds'].
+        :type notification_config: dict
+        """
+        self.notification_config = notification_config
+        self.timeout = (
+            float(notification_config.get('connect_timeout_seconds', DEFAULT_CONNECT_TIMEOUT_SECONDS)),
+            float(notification_config.get('read_timeout_seconds', DEFAULT_READ_TIMEOUT_SECONDS)),
+        )
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=4))
+        self._session.mount('http://', HTTPAdapter(pool_connections=2, pool_maxsize=4))
+        self._access_token = None
+        self._access_token_expiry = 0.0
+        self._access_token_lock = threading.Lock()
 
-    access_token = response_json['access_token']
+        templates = files("auto_analysis.templates")
+        env = Environment(loader=BaseLoader())
+        self._email_template = env.from_string(templates.joinpath("analysis_complete_email.html").read_text())
+        self._digest_email_template = env.from_string(templates.joinpath("analysis_complete_digest_email.html").read_text())
 
-    return access_token
+    def get_access_token(self) -> Optional[str]:
+        """
+        Get an access token from the MCMS auth service, reusing the last one if it isn't about to expire.
 
+        :return: The access token, or None if one couldn't be obtained.
+        :rtype: Optional[str]
+        """
+        with self._access_token_lock:
+            if self._access_token is not None and time.monotonic() < self._access_token_expiry:
+                return self._access_token
 
-def _prepare_email_body(email_data: dict, notification_config: dict):
-    """
-    """
-    message_id = str(uuid.uuid4())
-    sender_email = notification_config['sender_email']
-    recipients = notification_config['recipient_email_addresses']
-    sequencing_run_id = email_data['sequencing_run_id']
-    subject_tag = notification_config.get('subject_tag', "auto-analysis")
-    subject = f"[{subject_tag}] Analysis Complete: {sequencing_run_id}"
-
-    template_path = files("auto_analysis.templates").joinpath("analysis_complete_email.html")
-    
-    template_text = template_path.read_text()
+            auth_url = self.notification_config['auth_url']
+            client_id = self.notification_config['client_id']
+            client_secret = self.notification_config['client_secret']
+            auth = HTTPBasicAuth(client_id, client_secret)
+            headers = {
+                "Accept": "application/json",
+                "Content-Type": "application/x-www-form-urlencoded",
+            }
+            data = {
+                "client_id": client_id,
+                "grant_type": "client_credentials",
+            }
+            request_start = time.monotonic()
+            try:
+                with profiling.span('request_access_token'):
+                    response = self._session.post(auth_url, data=data, headers=headers, auth=auth, timeout=self.timeout)
+            except requests.RequestException as e:
+                logging.error(json.dumps({
+                    'event_type': 'email_authentication_failed',
+                    'error': str(e),
+                }))
+                return None
+            if response.status_code != 200:
+                logging.error(json.dumps({
+                    'event_type': 'email_authentication_failed',
+                    'status_code': response.status_code,
+                    'message': response.text
+                }))
+                return None
 
-    env = Environment(loader=BaseLoader())
-    template = env.from_string(template_text)
+            try:
+                response_json = response.json()
+                access_token = response_json['access_token']
+            except (ValueError, KeyError) as e:
+                logging.error(json.dumps({
+                    'event_type': 'email_authentication_failed',
+                    'status_code': response.status_code,
+                    'error': "Auth response has no access token",
+                }))
+                return None
+            self._access_token = access_token
+            # Without an expiry time, the token is only used once.
+            expires_in_seconds = float(response_json.get('expires_in', 0) or 0)
+            self._access_token_expiry = request_start + expires_in_seconds - TOKEN_EXPIRY_MARGIN_SECONDS
+            logging.debug(json.dumps({
+                'event_type': 'email_access_token_received',
+                'expires_in_seconds': expires_in_seconds,
+            }))
 
-    body = template.render(email_data)
-    
-    email_request_body = {
-        "messageId": message_id,
-        "from": sender_email,
-        "email": {
-            "to": recipients,
-            "subject": subject,
-            "bodyType": "html",
-            "body": body,
+            return self._access_token
+
+    def invalidate_access_token(self):
+        """
+        Forget the cached access token, so that a new one is requested next time.
+        """
+        with self._access_token_lock:
+            self._access_token = None
+            self._access_token_expiry = 0.0
+
+    def prepare_email_body(self, email_data: dict, message_id: Optional[str]=None) -> dict:
+        """
+        Render the email template, and build the request body for the email service.
+
+        :param email_data: Data to render into the email (see `_collect_email_data`)
+        :type email_data: dict
+        :param message_id: Message ID, which the email service uses to recognize repeated sends of the same email. If None, a new one is generated.
+        :type message_id: Optional[str]
+        :return: Request body for the email service
+        :rtype: dict
+        """
+        sequencing_run_id = email_data['sequencing_run_id']
+        subject_tag = self.notification_config.get('subject_tag', "auto-analysis")
+        subject = f"[{subject_tag}] Analysis Complete: {sequencing_run_id}"
+        body = self._email_template.render(email_data)
+
+        return self._build_email_request_body(subject, body, message_id)
+
+    def prepare_digest_email_body(self, runs_email_data: list[dict], message_id: Optional[str]=None) -> dict:
+        """
+        Render a single email summarizing several runs, and build the request body for the email service.
+
+        :param runs_email_data: Data for each run (see `_collect_email_data`)
+        :type runs_email_data: list[dict]
+        :param message_id: Message ID, which the email service uses to recognize repeated sends of the same email. If None, a new one is generated.
+        :type message_id: Optional[str]
+        :return: Request body for the email service
+        :rtype: dict
+        """
+        subject_tag = self.notification_config.get('subject_tag', "auto-analysis")
+        subject = f"[{subject_tag}] Analysis Complete: {len(runs_email_data)} runs"
+        body = self._digest_email_template.render({'runs': runs_email_data})
+
+        return self._build_email_request_body(subject, body, message_id)
+
+    def _build_email_request_body(self, subject: str, body: str, message_id: Optional[str]) -> dict:
+        if message_id is None:
+            message_id = str(uuid.uuid4())
+        sender_email = self.notification_config['sender_email']
+        recipients = self.notification_config['recipient_email_addresses']
+
+        email_request_body = {
+            "messageId": message_id,
+            "from": sender_email,
+            "email": {
+                "to": recipients,
+                "subject": subject,
+                "bodyType": "html",
+                "body": body,
+            }
         }
-    }
 
-    return email_request_body
+        return email_request_body
+
+    def send_email(self, email_body: dict) -> bool:
+        """
+        Send an email through the email service. If the service rejects the access token, a new token
+        is requested and the email is sent once more.
+
+        :param email_body: Request body for the email service (see `prepare_email_body`)
+        :type email_body: dict
+        :return: Whether the email was accepted by the service.
+        :rtype: bool
+        """
+        with profiling.span('send_email'), metrics.timer("auto_analysis_notification_send_duration_seconds"):
+            sent = self._send_email(email_body)
+        metrics.inc("auto_analysis_notifications_total", {"outcome": "sent" if sent else "failed"})
+
+        return sent
+
+    def _send_email(self, email_body: dict) -> bool:
+        email_url = self.notification_config['email_url']
+        for attempt in range(2):
+            access_token = self.get_access_token()
+            if not access_token:
+                return False
+            headers = {
+                "Accept": "application/json",
+                "Content-Type": "application/json",
+                "Authorization": "Bearer " + access_token,
+            }
+            try:
+                response = self._session.post(email_url, data=json.dumps(email_body), headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                logging.error(json.dumps({
+                    'event_type': 'send_email_failed',
+                    'message_id': email_body.get('messageId', None),
+                    'error': str(e),
+                }))
+                return False
+            if response.status_code == 401 and attempt == 0:
+                self.invalidate_access_token()
+                continue
+            break
+
+        if not response.ok:
+            logging.error(json.dumps({
+                'event_type': 'send_email_failed',
+                'message_id': email_body.get('messageId', None),
+                'status_code': response.status_code,
+                'message': response.text,
+            }))
+            return False
+
+        return True
+
+    def close(self):
+        """
+        Close the client's pooled connections.
+        """
+        self._session.close()
 
 
-def _collect_email_data(analysis_dir: Path) -> dict:
+def get_notification_client(notification_config: dict) -> NotificationClient:
     """
-    Collect any relevant info needed from the analysis output dir.
+    Get a client for the notification service. The same client is reused for as long as the notification config is unchanged.
+
+    :param notification_config: The 'notification' section of the config.
+    :type notification_config: dict
+    :return: Notification client
+    :rtype: NotificationClient
+    """
+    config_key = json.dumps(notification_config, sort_keys=True)
+    with _notification_clients_lock:
+        client = _notification_clients.get(config_key, None)
+        if client is None:
+            for stale_client in _notification_clients.values():
+                stale_client.close()
+            _notification_clients.clear()
+            client = NotificationClient(notification_config)
+            _notification_clients[config_key] = client
+
+    return client
+
+
+def _collect_email_data(analysis_dir: Path, results_warehouse_db: Optional[str]=None) -> dict:
+    """
+    Collect any relevant info needed from the analysis output dir. Per-library results are
+    queried from the results warehouse, if it is configured, rather than parsed from the output dir.
 
     :param analysis_dir: Analysis dir to collect data from
     :type analysis_dir: Path
+    :param results_warehouse_db: Path to the results warehouse database.
+    :type results_warehouse_db: Optional[str]
     :return: Data to be included in the email
     :rtype: dict
     """
     email_data = {}
-    sequencing_run_id = os.path.basename(analysis_dir)
+    sequencing_run_id = os.path.basename(os.path.normpath(analysis_dir))
     email_data['sequencing_run_id'] = sequencing_run_id
     
     libraries_by_library_id = {}
+    if results_warehouse_db and os.path.exists(results_warehouse_db):
+        library_results = warehouse.get_run_library_results(results_warehouse_db, sequencing_run_id)
+        for library_id, results_by_pipeline in library_results.items():
+            input_fastq_qc = results_by_pipeline.get(warehouse.INPUT_FASTQ_QC_PIPELINE_NAME, {})
+            qc_status = input_fastq_qc.get('qc_status', None)
+            libraries_by_library_id[library_id] = {
+                'library_id': library_id,
+                'qc_status': qc_status.capitalize() if qc_status else 'Unknown',
+                'results': results_by_pipeline,
+            }
     
     email_data['libraries'] = []
     library_ids_sorted = list(sorted(libraries_by_library_id.keys()))
@@ -120,24 +307,17 @@ def _collect_email_data(analysis_dir: Path) -> dict:
     return email_data
     
 
-def send_notification_email(analysis_dir: Path, notification_config: dict):
+def send_notification_email(analysis_dir: Path, notification_config: dict, results_warehouse_db: Optional[str]=None):
     """
-    Collect relevant data from an analysis output dir
+    Collect relevant data from an analysis output dir (and the results warehouse, if given), and send it in a notification email.
+    Does nothing if `send_notification_emails` is false.
     """
-    access_token = _get_access_token(notification_config)
-    if not access_token:
+    if not notification_config.get('send_notification_emails', True):
         return None
-
-    email_data = _collect_email_data(analysis_dir)
-    email_body = _prepare_email_body(email_data, notification_config)
-    email_url = notification_config['email_url']
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-        "Authorization": "Bearer " + access_token,
-    }
-
-    response = requests.post(email_url, data=json.dumps(email_body), headers=headers)
+    client = get_notification_client(notification_config)
+    email_data = _collect_email_data(analysis_dir, results_warehouse_db)
+    email_body = client.prepare_email_body(email_data)
+    client.send_email(email_body)
 
     return None
 
@@ -145,7 +325,7 @@ def send_notification_email(analysis_dir: Path, notification_config: dict):
 
 def main(args):
     config = load_config(args.config)
-    send_notification_email(args.analysis_outdir, config['notification'])
+    send_notification_email(args.analysis_outdir, config['notification'], warehouse.get_warehouse_path(config))
     
 
 if __name__ == '__main__':
@@ -0,0 +1,390 @@
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from typing import Optional
+
+import auto_analysis.notification as notification
+import auto_analysis.profiling as profiling
+import auto_analysis.warehouse as warehouse
+
+
+DEFAULT_OUTBOX_CONFIG = {
+    # Defaults to `<analysis_output_dir>/.notification_outbox`
+    "outbox_dir": None,
+    "max_attempts": 10,
+    "backoff_seconds": 60,
+    "backoff_multiplier": 2,
+    "max_backoff_seconds": 3600,
+    # If set, runs that complete within this many seconds of each other are reported in a single email.
+    "digest_window_seconds": 0,
+}
+
+OUTBOX_SUBDIRS = ['pending', 'sent', 'failed']
+
+# Instances that share an outbox dir take turns to send from it, under an fcntl lock on this file.
+OUTBOX_LOCK_FILENAME = '.lock'
+
+LOCK_POLL_INTERVAL_SECONDS = 5
+
+# Message IDs are derived from what they report, so that the same notification always gets the same ID.
+_MESSAGE_ID_NAMESPACE = uuid.UUID('0b9f6a52-44e6-4f7e-9a51-6f1d3c7e2a10')
+
+
+def get_outbox_config(config: dict[str, object]) -> dict[str, object]:
+    """
+    Get the `notification.outbox` config, with defaults filled in.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Outbox config. Keys: ['outbox_dir', 'max_attempts', 'backoff_seconds', 'backoff_multiplier', 'max_backoff_seconds', 'digest_window_seconds']
+    :rtype: dict[str, object]
+    """
+    outbox_config = dict(DEFAULT_OUTBOX_CONFIG)
+    outbox_config.update((config.get('notification', None) or {}).get('outbox', None) or {})
+    if not outbox_config['outbox_dir']:
+        outbox_config['outbox_dir'] = os.path.join(config['analysis_output_dir'], '.notification_outbox')
+    outbox_config['outbox_dir'] = os.path.abspath(outbox_config['outbox_dir'])
+    for key in ['backoff_seconds', 'backoff_multiplier', 'max_backoff_seconds', 'digest_window_seconds']:
+        outbox_config[key] = float(outbox_config[key])
+    outbox_config['max_attempts'] = int(outbox_config['max_attempts'])
+
+    return outbox_config
+
+
+def get_message_id(config: dict[str, object], sequencing_run_id: str) -> str:
+    """
+    Get the ID of the analysis-complete notification for a run. The ID depends on the run and on the configured
+    pipelines, so a run is only reported again if it is analyzed with a different set of pipelines.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param sequencing_run_id: Sequencing run ID
+    :type sequencing_run_id: str
+    :return: Message ID
+    :rtype: str
+    """
+    pipeline_versions = sorted(p['name'] + ' ' + p['version'] for p in config['pipelines'] if p is not None)
+
+    return str(uuid.uuid5(_MESSAGE_ID_NAMESPACE, '\n'.join(['analysis_complete', sequencing_run_id] + pipeline_versions)))
+
+
+def _write_json_atomic(path: str, data: dict[str, object]):
+    # The temp file has a unique name, so that concurrent writers (eg. other instances) don't collide.
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.write('\n')
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+class NotificationOutbox:
+    """
+    Send analysis-complete notifications from an on-disk outbox, in a background thread, so that analysis
+    doesn't wait on (or fail with) the notification service.
+
+    Each notification is a file in `<outbox_dir>/pending`, named by its message ID. It is moved to `sent` once the
+    email service has accepted it, or to `failed` after `max_attempts`. Failed sends are retried with exponential
+    backoff. Notifications that were pending when the process stopped are sent after it restarts. If the process
+    stops between sending an email and recording it as sent, the email is sent again with the same message ID,
+    so that the email service can recognize it as a repeat.
+
+    Several instances may share an outbox dir. Each sends from it in turn, under an fcntl lock on
+    `<outbox_dir>/.lock`, so that a notification is only sent once, by whichever instance finds it due first.
+    """
+
+    def __init__(self, config: dict[str, object]):
+        self._condition = threading.Condition()
+        self._stopping = False
+        self.update_config(config)
+        self._thread = threading.Thread(target=self._run, name='notification-outbox', daemon=True)
+        self._thread.start()
+
+
+    def update_config(self, config: dict[str, object]):
+        """
+        Update the outbox settings and notification service config from a (re)loaded config.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :return: None
+        :rtype: NoneType
+        """
+        outbox_config = get_outbox_config(config)
+        for subdir in OUTBOX_SUBDIRS:
+            os.makedirs(os.path.join(outbox_config['outbox_dir'], subdir), exist_ok=True)
+        with self._condition:
+            self._config = config
+            self._outbox_config = outbox_config
+            self._condition.notify_all()
+
+
+    def _get_message_path(self, subdir: str, message_id: str) -> str:
+        return os.path.join(self._outbox_config['outbox_dir'], subdir, message_id + '.json')
+
+
+    def enqueue(self, config: dict[str, object], run_analysis_outdir: str, sequencing_run_id: str) -> Optional[str]:
+        """
+        Queue the analysis-complete notification for a run. Does nothing if `notification.send_notification_emails`
+        is false, or if the same notification has already been queued (or sent).
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :param run_analysis_outdir: The run's analysis output dir.
+        :type run_analysis_outdir: str
+        :param sequencing_run_id: Sequencing run ID
+        :type sequencing_run_id: str
+        :return: Message ID of the notification, or None if notifications are disabled.
+        :rtype: Optional[str]
+        """
+        if not config['notification'].get('send_notification_emails', True):
+            logging.info(json.dumps({
+                "event_type": "notification_skipped",
+                "sequencing_run_id": sequencing_run_id,
+                "reason": "send_notification_emails_disabled",
+            }))
+            return None
+
+        message_id = get_message_id(config, sequencing_run_id)
+        with self._condition:
+            for subdir in OUTBOX_SUBDIRS:
+                if os.path.exists(self._get_message_path(subdir, message_id)):
+                    logging.debug(json.dumps({
+                        "event_type": "notification_already_queued",
+                        "sequencing_run_id": sequencing_run_id,
+                        "message_id": message_id,
+                        "outbox_subdir": subdir,
+                    }))
+                    return message_id
+
+            now = time.time()
+            message = {
+                'message_id': message_id,
+                'sequencing_run_id': sequencing_run_id,
+                'analysis_dir': os.path.abspath(run_analysis_outdir),
+                'results_warehouse_db': warehouse.get_warehouse_path(config),
+                'attempts': 0,
+                'timestamp_created': now,
+                'next_attempt_time': now,
+                'digest_message_id': None,
+                'last_error': None,
+            }
+            _write_json_atomic(self._get_message_path('pending', message_id), message)
+            self._condition.notify_all()
+
+        logging.info(json.dumps({
+            "event_type": "notification_queued",
+            "sequencing_run_id": sequencing_run_id,
+            "message_id": message_id,
+        }))
+
+        return message_id
+
+
+    def _load_pending_messages(self) -> list[dict[str, object]]:
+        pending_dir = os.path.join(self._outbox_config['outbox_dir'], 'pending')
+        messages = []
+        with os.scandir(pending_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    with open(entry.path, 'r') as f:
+                        messages.append(json.load(f))
+                except (OSError, ValueError) as e:
+                    logging.error(json.dumps({"event_type": "notification_unreadable", "path": entry.path, "error": str(e)}))
+
+        return sorted(messages, key=lambda message: message['timestamp_created'])
+
+
+    def _get_batches(self, messages: list[dict[str, object]], now: float) -> tuple[list[list[dict[str, object]]], Optional[float]]:
+        """
+        Group the pending messages into the batches that are due to be sent now, and find when the next batch will be due.
+        """
+        digest_window_seconds = self._outbox_config['digest_window_seconds']
+        due_batches = []
+        next_due_time = None
+
+        # Digests that have already been assigned a message ID are always resent as-is, so that a repeated send
+        # has the same contents and ID as the first.
+        messages_by_digest_id = {}
+        unbatched_messages = []
+        for message in messages:
+            if message.get('digest_message_id', None):
+                messages_by_digest_id.setdefault(message['digest_message_id'], []).append(message)
+            elif digest_window_seconds > 0:
+                unbatched_messages.append(message)
+            else:
+                messages_by_digest_id[message['message_id']] = [message]
+
+        if unbatched_messages:
+            digest_due_time = unbatched_messages[0]['timestamp_created'] + digest_window_seconds
+            if digest_due_time <= now:
+                digest_message_id = str(uuid.uuid5(_MESSAGE_ID_NAMESPACE, '\n'.join(['digest'] + [m['message_id'] for m in unbatched_messages])))
+                for message in unbatched_messages:
+                    message['digest_message_id'] = digest_message_id
+                    _write_json_atomic(self._get_message_path('pending', message['message_id']), message)
+                messages_by_digest_id[digest_message_id] = unbatched_messages
+            else:
+                next_due_time = digest_due_time
+
+        for batch in messages_by_digest_id.values():
+            batch_due_time = max(message['next_attempt_time'] for message in batch)
+            if batch_due_time <= now:
+                due_batches.append(batch)
+            elif next_due_time is None or batch_due_time < next_due_time:
+                next_due_time = batch_due_time
+
+        return due_batches, next_due_time
+
+
+    def _send_batch(self, batch: list[dict[str, object]]) -> bool:
+        client = notification.get_notification_client(self._config['notification'])
+        if len(batch) == 1 and not batch[0].get('digest_message_id', None):
+            message = batch[0]
+            email_data = notification._collect_email_data(message['analysis_dir'], message['results_warehouse_db'])
+            email_body = client.prepare_email_body(email_data, message['message_id'])
+        else:
+            runs_email_data = [notification._collect_email_data(m['analysis_dir'], m['results_warehouse_db']) for m in batch]
+            email_body = client.prepare_digest_email_body(runs_email_data, batch[0]['digest_message_id'])
+
+        return client.send_email(email_body)
+
+
+    def _record_attempt(self, batch: list[dict[str, object]], sent: bool, error: Optional[str]=None):
+        now = time.time()
+        for message in batch:
+            message['attempts'] += 1
+            pending_path = self._get_message_path('pending', message['message_id'])
+            if sent:
+                message['timestamp_sent'] = now
+                _write_json_atomic(pending_path, message)
+                os.replace(pending_path, self._get_message_path('sent', message['message_id']))
+                continue
+
+            message['last_error'] = error
+            if message['attempts'] >= self._outbox_config['max_attempts']:
+                _write_json_atomic(pending_path, message)
+                os.replace(pending_path, self._get_message_path('failed', message['message_id']))
+                logging.error(json.dumps({
+                    "event_type": "notification_failed",
+                    "sequencing_run_id": message['sequencing_run_id'],
+                    "message_id": message['message_id'],
+                    "attempts": message['attempts'],
+                    "error": error,
+                }))
+                continue
+
+            backoff_seconds = min(
+                self._outbox_config['backoff_seconds'] * self._outbox_config['backoff_multiplier'] ** (message['attempts'] - 1),
+                self._outbox_config['max_backoff_seconds'],
+            )
+            message['next_attempt_time'] = now + backoff_seconds
+            _write_json_atomic(pending_path, message)
+            logging.warning(json.dumps({
+                "event_type": "notification_send_retry_scheduled",
+                "sequencing_run_id": message['sequencing_run_id'],
+                "message_id": message['message_id'],
+                "attempts": message['attempts'],
+                "backoff_seconds": backoff_seconds,
+                "error": error,
+            }))
+
+        if sent:
+            logging.info(json.dumps({
+                "event_type": "notification_sent",
+                "sequencing_run_ids": [message['sequencing_run_id'] for message in batch],
+                "message_id": batch[0].get('digest_message_id', None) or batch[0]['message_id'],
+            }))
+
+
+    def _send_due_batches(self) -> Optional[float]:
+        """
+        Send the notifications that are due. Must be called with the outbox lock held.
+
+        :return: When the next notification will be due (now, if any were sent), or None if none are pending.
+        :rtype: Optional[float]
+        """
+        with self._condition:
+            try:
+                due_batches, next_due_time = self._get_batches(self._load_pending_messages(), time.time())
+            except OSError as e:
+                logging.error(json.dumps({"event_type": "notification_outbox_unreadable", "error": str(e)}))
+                return time.time() + self._outbox_config['backoff_seconds']
+
+        for batch in due_batches:
+            error = None
+            try:
+                with profiling.trace('send_notification', sequencing_run_ids=[message['sequencing_run_id'] for message in batch]):
+                    sent = self._send_batch(batch)
+                if not sent:
+                    error = "Email service did not accept the notification"
+            except Exception as e:
+                sent = False
+                error = str(e)
+            with self._condition:
+                self._record_attempt(batch, sent, error)
+
+        return time.time() if due_batches else next_due_time
+
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopping:
+                    return
+                outbox_dir = self._outbox_config['outbox_dir']
+            try:
+                with open(os.path.join(outbox_dir, OUTBOX_LOCK_FILENAME), 'a') as lock_file:
+                    try:
+                        fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError as e:
+                        # Another instance is sending. Pending notifications are checked again once it's done.
+                        next_due_time = time.time() + LOCK_POLL_INTERVAL_SECONDS
+                    else:
+                        try:
+                            next_due_time = self._send_due_batches()
+                        finally:
+                            fcntl.lockf(lock_file, fcntl.LOCK_UN)
+            except OSError as e:
+                logging.error(json.dumps({"event_type": "notification_outbox_unreadable", "error": str(e)}))
+                next_due_time = time.time() + self._outbox_config['backoff_seconds']
+
+            with self._condition:
+                if self._stopping:
+                    return
+                timeout = None if next_due_time is None else next_due_time - time.time()
+                if timeout is None or timeout > 0:
+                    self._condition.wait(timeout)
+
+
+    def num_pending(self) -> int:
+        """
+        :return: Number of notifications waiting to be sent.
+        :rtype: int
+        """
+        with self._condition:
+            pending_dir = os.path.join(self._outbox_config['outbox_dir'], 'pending')
+            return sum(1 for name in os.listdir(pending_dir) if name.endswith('.json'))
+
+
+    def close(self, timeout: Optional[float]=None):
+        """
+        Stop the background thread. Notifications that haven't been sent stay in the outbox, and are sent
+        by the next outbox created for the same `outbox_dir`.
+
+        :param timeout: Seconds to wait for a send in progress to finish.
+        :type timeout: Optional[float]
+        :return: None
+        :rtype: NoneType
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
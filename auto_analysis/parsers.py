@@ -1,11 +1,169 @@
+import array
 import csv
 import json
 import logging
+import math
 
 from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional
 
 
-def parse_generic_csv(csv_path: Path, delimiter=',', fieldname_translation={}, int_fields=[], float_fields=[]):
+class CsvSchema:
+    """
+    How to convert the fields of a csv file: which fields to cast to int or float, which values to treat
+    as missing, and how to rename fields. Build a schema once, and reuse it for every file of the same kind.
+
+    Fields listed in `int_fields` and `float_fields` should use the fieldnames in the original file
+    (pre-translation, if applicable). Values that can't be cast are parsed as None.
+    """
+    def __init__(self, int_fields: Iterable[str]=(), float_fields: Iterable[str]=(), fieldname_translation: Optional[dict[str, str]]=None, null_values: Iterable[str]=()):
+        """
+        :param int_fields: Fields to cast to int.
+        :type int_fields: Iterable[str]
+        :param float_fields: Fields to cast to float.
+        :type float_fields: Iterable[str]
+        :param fieldname_translation: Lookup from original fieldname to translated fieldname.
+        :type fieldname_translation: Optional[dict[str, str]]
+        :param null_values: Values (eg. '', 'NA', '-') to parse as None, in any field.
+        :type null_values: Iterable[str]
+        """
+        self.int_fields = frozenset(int_fields)
+        self.float_fields = frozenset(float_fields)
+        self.fieldname_translation = dict(fieldname_translation or {})
+        self.null_values = frozenset(null_values)
+        self._compiled = {}
+
+    def _make_cast(self, cast: Callable[[str], object]) -> Callable[[Optional[str]], object]:
+        null_values = self.null_values
+        def cast_value(value):
+            if value is None or value in null_values:
+                return None
+            try:
+                return cast(value)
+            except ValueError as e:
+                return None
+
+        return cast_value
+
+    def compile(self, header: list[str]) -> tuple[list[str], list[tuple[int, Callable[[Optional[str]], object]]]]:
+        """
+        Work out, once per header, the output fieldname of each column, and the conversion to apply to each
+        column that needs one.
+
+        :param header: Fieldnames, as given in the file.
+        :type header: list[str]
+        :return: Output fieldnames, and a list of (column index, conversion function) for the columns that need converting.
+        :rtype: tuple[list[str], list[tuple[int, Callable[[Optional[str]], object]]]]
+        """
+        header = tuple(header)
+        if header in self._compiled:
+            return self._compiled[header]
+
+        fieldnames = [self.fieldname_translation.get(field, field) for field in header]
+        int_cast = self._make_cast(int)
+        float_cast = self._make_cast(float)
+        null_cast = self._make_cast(str)
+        converters = []
+        for column_index, field in enumerate(header):
+            if field in self.int_fields:
+                converters.append((column_index, int_cast))
+            elif field in self.float_fields:
+                converters.append((column_index, float_cast))
+            elif self.null_values:
+                converters.append((column_index, null_cast))
+        self._compiled[header] = (fieldnames, converters)
+
+        return fieldnames, converters
+
+
+def _iter_converted_rows(csv_path: Path, schema: CsvSchema, delimiter: str) -> Iterator[tuple[list[str], list[object]]]:
+    """
+    Yield the output fieldnames (once, first) and then each row of the file as a list of converted values.
+    Short rows are padded with None, and values beyond the header are dropped.
+    """
+    with open(csv_path, 'r', newline='') as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        header = next(reader, None)
+        if header is None:
+            return
+        fieldnames, converters = schema.compile(header)
+        yield fieldnames
+        num_fields = len(fieldnames)
+        for row in reader:
+            if not row:
+                continue
+            if len(row) != num_fields:
+                row = (row + [None] * num_fields)[:num_fields]
+            for column_index, convert in converters:
+                row[column_index] = convert(row[column_index])
+            yield row
+
+
+def iter_csv(csv_path: Path, schema: Optional[CsvSchema]=None, delimiter: str=',') -> Iterator[dict[str, object]]:
+    """
+    Parse a csv file one row at a time, so that memory use doesn't grow with the size of the file.
+
+    :param csv_path: Path to the csv file
+    :type csv_path: Path
+    :param schema: How to convert the file's fields. If None, all values are left as strings.
+    :type schema: Optional[CsvSchema]
+    :param delimiter: Field delimiter (eg. '\\t' for tsv files)
+    :type delimiter: str
+    :return: One dict per row, indexed by (translated) fieldname.
+    :rtype: Iterator[dict[str, object]]
+    """
+    rows = _iter_converted_rows(csv_path, schema or CsvSchema(), delimiter)
+    fieldnames = next(rows, None)
+    for row in rows:
+        yield dict(zip(fieldnames, row))
+
+
+def parse_csv_columns(csv_path: Path, schema: Optional[CsvSchema]=None, delimiter: str=',') -> dict[str, object]:
+    """
+    Parse a csv file to one sequence of values per column.
+
+    Float columns are returned as `array.array('d')`, with missing values as NaN. Int columns are returned as
+    `array.array('q')`, unless they have missing values (or values too large for 64 bits), in which case they are
+    returned as lists with None for missing values. All other columns are returned as lists.
+
+    :param csv_path: Path to the csv file
+    :type csv_path: Path
+    :param schema: How to convert the file's fields. If None, all values are left as strings.
+    :type schema: Optional[CsvSchema]
+    :param delimiter: Field delimiter (eg. '\\t' for tsv files)
+    :type delimiter: str
+    :return: Values of each column, indexed by (translated) fieldname.
+    :rtype: dict[str, object]
+    """
+    schema = schema or CsvSchema()
+    rows = _iter_converted_rows(csv_path, schema, delimiter)
+    fieldnames = next(rows, None)
+    if fieldnames is None:
+        return {}
+
+    columns = [[] for field in fieldnames]
+    column_appenders = [column.append for column in columns]
+    for row in rows:
+        for append, value in zip(column_appenders, row):
+            append(value)
+
+    original_fieldnames = {translated: original for original, translated in schema.fieldname_translation.items()}
+    columns_by_fieldname = {}
+    for field, column in zip(fieldnames, columns):
+        original_field = original_fieldnames.get(field, field)
+        if original_field in schema.float_fields:
+            column = array.array('d', (math.nan if value is None else value for value in column))
+        elif original_field in schema.int_fields and None not in column:
+            try:
+                column = array.array('q', column)
+            except OverflowError as e:
+                pass
+        columns_by_fieldname[field] = column
+
+    return columns_by_fieldname
+
+
+def parse_generic_csv(csv_path: Path, delimiter=',', fieldname_translation=None, int_fields=None, float_fields=None):
     """
     Parse a csv file to a list of dicts. Optionally cast int and float fields to those types.
     Optionally translate fieldnames via a lookup table. Translation is done after casting, so
@@ -13,31 +171,13 @@ def parse_generic_csv(csv_path: Path, delimiter=',', fieldname_translation={}, i
     in the original file (pre-translation, if applicable).
 
     `fieldname_translation` is a dict from original fieldname to translated fieldname.
+
+    For large files, build a `CsvSchema` once and use `iter_csv` or `parse_csv_columns` instead.
     """
-    parsed_rows = []
-    with open(csv_path, 'r') as f:
-        reader = csv.DictReader(f, delimiter=delimiter)
-        for row in reader:
-            parsed_row = {}
-            for field, value in row.items():
-                if field in int_fields:
-                    try:
-                        parsed_row[field] = int(value)
-                    except ValueError as e:
-                        parsed_row[field] = None
-                elif field in float_fields:
-                    try:
-                        parsed_row[field] = float(value)
-                    except ValueError as e:
-                        parsed_row[field] = None
-                else:
-                    parsed_row[field] = value
-
-            for original_fieldname, translated_fieldname in fieldname_translation.items():
-                if original_fieldname in parsed_row:
-                    value = parsed_row.pop(original_fieldname)
-                    parsed_row[translated_fieldname] = value
-
-            parsed_rows.append(parsed_row)
-
-    return parsed_rows
+    schema = CsvSchema(
+        int_fields=int_fields or (),
+        float_fields=float_fields or (),
+        fieldname_translation=fieldname_translation,
+    )
+
+    return list(iter_csv(csv_path, schema, delimiter=delimiter))
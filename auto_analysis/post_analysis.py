@@ -1,12 +1,15 @@
 import csv
 import datetime
-import glob
 import json
 import logging
 import os
-import shutil
+import sqlite3
 
 from . import parsers
+from . import profiling
+from . import trace_history
+from . import warehouse
+from .janitor import delete_work_dir
 
 
 def post_analysis_pipeline_1(config, pipeline, run):
@@ -79,7 +82,7 @@ def post_analysis_pipeline_2(config, pipeline, run):
     return None
 
 
-def post_analysis(config, pipeline, run, analysis_mode):
+def post_analysis(config, pipeline, run, janitor=None):
     """
     Perform post-analysis tasks for a pipeline.
 
@@ -89,52 +92,57 @@ def post_analysis(config, pipeline, run, analysis_mode):
     :type pipeline: dict
     :param run: The run dictionary
     :type run: dict
-    :param analysis_mode: The analysis mode
-    :type analysis_mode: str
+    :param janitor: Janitor that deletes the work dir in the background. If None, the work dir is deleted before returning.
+    :type janitor: Optional[auto_analysis.janitor.WorkDirJanitor]
     :return: None
     """
     pipeline_name = pipeline['name']
-    pipeline_short_name = pipeline_name.split('/')[1]
-    pipeline_version = pipeline['version']
     delete_pipeline_work_dir = pipeline.get('delete_work_dir', True)
     sequencing_run_id = run['sequencing_run_id']
-    base_analysis_work_dir = config['analysis_work_dir']
+    work_dir = pipeline['parameters'].get('work_dir', None)
 
-    # The work_dir includes a timestamp, so we need to glob to find the most recent one
-    work_dir_glob = os.path.join(base_analysis_work_dir, 'work-' + sequencing_run_id + '_' + pipeline_short_name + '_' + '*')
-    work_dirs = glob.glob(work_dir_glob)
-    if len(work_dirs) > 0:
-        work_dir = work_dirs[-1]
-    else:
-        work_dir = None
-
-    if work_dir and delete_pipeline_work_dir:
-        try:
-            shutil.rmtree(work_dir, ignore_errors=True)
-            logging.info(json.dumps({
-                "event_type": "analysis_work_dir_deleted",
-                "sequencing_run_id": sequencing_run_id,
-                "analysis_work_dir_path": work_dir
-            }))
-        except OSError as e:
-            logging.error(json.dumps({
-                "event_type": "delete_analysis_work_dir_failed",
-                "sequencing_run_id": analysis_run_id,
-                "analysis_work_dir_path": analysis_work_dir
-            }))
+    if not work_dir or not os.path.exists(work_dir):
+        logging.warning(json.dumps({
+            "event_type": "analysis_work_dir_not_found",
+            "sequencing_run_id": sequencing_run_id,
+            "analysis_work_dir_path": work_dir
+        }))
+    elif not delete_pipeline_work_dir:
+        logging.info(json.dumps({
+            "event_type": "skipped_deletion_of_analysis_work_dir",
+            "sequencing_run_id": sequencing_run_id,
+            "analysis_work_dir_path": work_dir
+        }))
+    elif janitor is not None:
+        janitor.delete_work_dir(work_dir, sequencing_run_id)
     else:
-        if not work_dir or not os.path.exists(work_dir):
-            logging.warning(json.dumps({
-                "event_type": "analysis_work_dir_not_found",
-                "sequencing_run_id": sequencing_run_id,
-                "analysis_work_dir_glob": work_dir_glob
-            }))
-        elif not delete_pipeline_work_dir:
-            logging.info(json.dumps({
-                "event_type": "skipped_deletion_of_analysis_work_dir",
-                "sequencing_run_id": sequencing_run_id,
-                "analysis_work_dir_path": work_dir
-            }))
+        with profiling.span('delete_work_dir'):
+            delete_work_dir(work_dir, sequencing_run_id)
+    if janitor is not None:
+        janitor.check_free_space()
+
+    try:
+        with profiling.span('ingest_trace'):
+            trace_history.ingest_trace(config, pipeline, run)
+    except (OSError, sqlite3.Error) as e:
+        logging.error(json.dumps({
+            "event_type": "trace_ingestion_failed",
+            "sequencing_run_id": sequencing_run_id,
+            "pipeline_name": pipeline_name,
+            "error": str(e),
+        }))
+
+    try:
+        with profiling.span('load_results_warehouse'):
+            warehouse.load_input_fastq_qc_results(config, run)
+            warehouse.load_pipeline_results(config, pipeline, run)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        logging.error(json.dumps({
+            "event_type": "results_warehouse_load_failed",
+            "sequencing_run_id": sequencing_run_id,
+            "pipeline_name": pipeline_name,
+            "error": str(e),
+        }))
 
     if pipeline_name == 'BCCDC-PHL/pipeline-1':
         return post_analysis_pipeline_1(config, pipeline, run)
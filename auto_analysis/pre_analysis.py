@@ -8,13 +8,18 @@ import shutil
 import subprocess
 
 from . import fastq
+from . import input_qc
+from . import ledger
+from . import manifest
+from . import profiling
 
 
 def check_analysis_dependencies_complete(config, pipeline: dict[str, object], run):
     """
     Check that all of the entries in the pipeline's `dependencies` config have completed. If so, return True. Return False otherwise.
 
-    Pipeline completion is determined by the presence of an `analysis_complete.json` file in the analysis output directory.
+    Pipeline completion is determined by the analysis ledger if it is configured and records the dependency as complete.
+    Otherwise, it is determined by the presence of an `analysis_complete.json` file in the analysis output directory.
 
     :param config: The config dictionary
     :type config: dict
@@ -34,11 +39,24 @@ def check_analysis_dependencies_complete(config, pipeline: dict[str, object], ru
     base_analysis_output_dir = config['analysis_output_dir']
     analysis_run_output_dir = os.path.join(base_analysis_output_dir, run['sequencing_run_id'])
     for dependency in dependencies:
+        ledger_dependency = ledger.get_analysis(config, run['sequencing_run_id'], dependency['pipeline_name'], dependency['pipeline_version'])
+        if ledger_dependency is not None and ledger_dependency['state'] == 'complete':
+            dependency_infos.append({
+                'pipeline_name': dependency['pipeline_name'],
+                'pipeline_version': dependency['pipeline_version'],
+                'analysis_complete': True,
+            })
+            continue
         dependency_pipeline_short_name = dependency['pipeline_name'].split('/')[1]
         dependency_pipeline_minor_version = ''.join(dependency['pipeline_version'].rsplit('.', 1)[0])
         dependency_analysis_output_dir_name = '-'.join([dependency_pipeline_short_name, dependency_pipeline_minor_version, 'output'])
         dependency_analysis_complete_path = os.path.join(analysis_run_output_dir, dependency_analysis_output_dir_name, 'analysis_complete.json')
         dependency_analysis_complete = os.path.exists(dependency_analysis_complete_path)
+        if dependency_analysis_complete:
+            ledger.set_analysis_state(
+                config, run['sequencing_run_id'], dependency['pipeline_name'], dependency['pipeline_version'], 'complete',
+                outdir=os.path.dirname(dependency_analysis_complete_path),
+            )
         dependency_info = {
             'pipeline_name': dependency['pipeline_name'],
             'pipeline_version': dependency['pipeline_version'],
@@ -160,7 +178,8 @@ def prepare_analysis(config, pipeline, run):
     log_path = os.path.abspath(os.path.join(pipeline_output_dir, sequencing_run_id + '_' + pipeline_short_name + '_nextflow.log'))
     pipeline['parameters']['log_path'] = log_path
 
-    analysis_dependencies_complete = check_analysis_dependencies_complete(pipeline, run, run_analysis_outdir)
+    with profiling.span('check_analysis_dependencies'):
+        analysis_dependencies_complete = check_analysis_dependencies_complete(config, pipeline, run)
     if not analysis_dependencies_complete:
         logging.info(json.dumps({"event_type": "analysis_dependencies_incomplete", "pipeline_name": pipeline_name, "sequencing_run_id": sequencing_run_id}))
         return None
@@ -176,3 +195,45 @@ def prepare_analysis(config, pipeline, run):
             "sequencing_run_id": sequencing_run_id
         }))
         return None
+
+
+def prepare_analysis_inputs(config, pipeline, run):
+    """
+    Prepare the pipeline's inputs, once we know that the analysis will be run.
+
+    Libraries that fail input QC are excluded (or flagged) before the pipeline's inputs are built
+    (see `input_qc.run_input_fastq_qc`), and pipelines that take a samplesheet are given one built
+    from the run's fastq manifest. Both read the run's input files and write to its analysis output
+    directory, so this is kept out of `prepare_analysis`, which is run for every analysis that is considered.
+
+    :param config: The config dictionary
+    :type config: dict
+    :param pipeline: The prepared pipeline dictionary (see `prepare_analysis`).
+    :type pipeline: dict
+    :param run: The run dictionary
+    :type run: dict
+    :return: The pipeline dictionary, with its inputs prepared. None if all of the run's libraries failed input QC.
+    :rtype: dict
+    """
+    sequencing_run_id = run['sequencing_run_id']
+    pipeline_name = pipeline['name']
+
+    with profiling.span('input_fastq_qc'):
+        libraries = input_qc.run_input_fastq_qc(config, run)
+    if libraries is not None:
+        run['libraries'] = libraries
+        if not libraries:
+            logging.error(json.dumps({"event_type": "all_libraries_failed_input_fastq_qc", "pipeline_name": pipeline_name, "sequencing_run_id": sequencing_run_id}))
+            return None
+        if 'fastq_input' in pipeline['parameters']:
+            pipeline['parameters']['fastq_input'] = input_qc.get_fastq_input_dir(config, run)
+
+    if 'samplesheet_input' in pipeline['parameters']:
+        with profiling.span('write_samplesheet'):
+            run_manifest = manifest.get_run_manifest(config, run)
+            run_analysis_outdir = os.path.join(config['analysis_output_dir'], sequencing_run_id)
+            samplesheet_path = os.path.abspath(os.path.join(run_analysis_outdir, manifest.SAMPLESHEET_FILENAME))
+            library_ids = list(run['libraries']) if run.get('libraries', None) is not None else None
+            pipeline['parameters']['samplesheet_input'] = manifest.write_samplesheet(run_manifest, samplesheet_path, library_ids)
+
+    return pipeline
@@ -0,0 +1,195 @@
+import contextlib
+import contextvars
+import cProfile
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+from typing import Iterator, Optional
+
+
+DEFAULT_MAX_PROFILES = 20
+
+PROFILE_FILENAME_SUFFIX = '.prof'
+
+_current_span = contextvars.ContextVar('auto_analysis_current_span', default=None)
+
+
+class _Span:
+    """
+    Accumulated timings for all spans with the same name (and attributes) under the same parent.
+    """
+
+    def __init__(self, name: str, attributes: Optional[dict[str, object]], lock: threading.Lock):
+        self.name = name
+        self.attributes = attributes
+        self.lock = lock
+        self.count = 0
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.children = {}
+
+    def get_child(self, name: str, attributes: Optional[dict[str, object]]) -> '_Span':
+        key = (name, tuple(sorted(attributes.items()))) if attributes else (name, ())
+        with self.lock:
+            child = self.children.get(key, None)
+            if child is None:
+                child = _Span(name, attributes, self.lock)
+                self.children[key] = child
+
+        return child
+
+    def to_dict(self) -> dict[str, object]:
+        span = {"name": self.name}
+        if self.attributes:
+            span.update(self.attributes)
+        span["count"] = self.count
+        span["wall_seconds"] = round(self.wall_seconds, 6)
+        span["cpu_seconds"] = round(self.cpu_seconds, 6)
+        if self.children:
+            span["spans"] = [child.to_dict() for child in list(self.children.values())]
+
+        return span
+
+
+@contextlib.contextmanager
+def _time_span(span: _Span) -> Iterator[None]:
+    token = _current_span.set(span)
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield
+    finally:
+        cpu_seconds = time.thread_time() - cpu_start
+        wall_seconds = time.perf_counter() - wall_start
+        _current_span.reset(token)
+        with span.lock:
+            span.count += 1
+            span.wall_seconds += wall_seconds
+            span.cpu_seconds += cpu_seconds
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes) -> Iterator[None]:
+    """
+    Time a stage of the work being traced (see `trace`). Spans can be nested. Wall time and the CPU time of the
+    current thread are recorded; repeated spans with the same name and attributes under the same parent are
+    added together. Outside of a trace, this does nothing.
+
+    :param name: Name of the stage.
+    :type name: str
+    :param attributes: Extra fields to include with the span's timings (eg. `pipeline_name`).
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield
+        return
+
+    with _time_span(parent.get_child(name, attributes)):
+        yield
+
+
+@contextlib.contextmanager
+def trace(name: str, **fields) -> Iterator[None]:
+    """
+    Time the `with` block, and any spans opened within it (see `span`), then log the timings in a single 'timing' event.
+
+    Spans are only recorded from threads that run in a copy of the tracing thread's context (see `run_in_context`).
+
+    :param name: Name of the work being traced. Included in the 'timing' event as 'trace_name'.
+    :type name: str
+    :param fields: Extra fields to include in the 'timing' event (eg. `sequencing_run_id`).
+    """
+    root = _Span(name, None, threading.Lock())
+    try:
+        with _time_span(root):
+            yield
+    finally:
+        timing = root.to_dict()
+        logging.info(json.dumps({
+            "event_type": "timing",
+            "trace_name": name,
+            **fields,
+            "wall_seconds": timing["wall_seconds"],
+            "cpu_seconds": timing["cpu_seconds"],
+            "spans": timing.get("spans", []),
+        }))
+
+
+def run_in_context(func):
+    """
+    Wrap a function so that it runs in a copy of the current context, so that spans opened by it are recorded
+    in the current trace. For use with executors and threads, eg: `executor.submit(run_in_context(func), ...)`.
+
+    :param func: Function to wrap.
+    :type func: Callable
+    :return: Wrapped function.
+    :rtype: Callable
+    """
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # A context can only be entered by one thread at a time, so each call gets its own copy.
+        return context.copy().run(func, *args, **kwargs)
+
+    return run
+
+
+class ScanProfiler:
+    """
+    Profile each scan cycle with cProfile, keeping the most recent `max_profiles` profiles in `profile_dir`.
+    Profiles can be read with `python -m pstats <profile>`, or tools like snakeviz.
+
+    Only the thread that runs the scan cycle is profiled. Time spent in analyses and notifications
+    (which run in other threads) is recorded by the `timing` events instead.
+    """
+
+    def __init__(self, profile_dir: str, max_profiles: int=DEFAULT_MAX_PROFILES):
+        self.profile_dir = profile_dir
+        self.max_profiles = max(1, max_profiles)
+        os.makedirs(self.profile_dir, exist_ok=True)
+
+
+    @contextlib.contextmanager
+    def profile(self, name: str='scan') -> Iterator[None]:
+        """
+        Profile the `with` block, and save the profile as `<name>-<timestamp>.prof` in the profile dir.
+
+        :param name: Prefix for the profile's filename.
+        :type name: str
+        """
+        profiler = cProfile.Profile()
+        timestamp = datetime.datetime.now().strftime('%Y%m%dT%H%M%S.%f')
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profile_path = os.path.join(self.profile_dir, name + '-' + timestamp + PROFILE_FILENAME_SUFFIX)
+            try:
+                profiler.dump_stats(profile_path)
+                self._remove_old_profiles()
+            except OSError as e:
+                logging.error(json.dumps({
+                    "event_type": "profile_write_failed",
+                    "profile_path": profile_path,
+                    "error": str(e),
+                }))
+            else:
+                logging.info(json.dumps({
+                    "event_type": "profile_written",
+                    "profile_path": profile_path,
+                }))
+
+
+    def _remove_old_profiles(self):
+        profile_paths = []
+        for entry in os.scandir(self.profile_dir):
+            if entry.name.endswith(PROFILE_FILENAME_SUFFIX) and entry.is_file():
+                profile_paths.append((entry.stat().st_mtime_ns, entry.name, entry.path))
+        profile_paths.sort()
+        for _, _, profile_path in profile_paths[:-self.max_profiles]:
+            os.remove(profile_path)
@@ -0,0 +1,508 @@
+import contextlib
+import itertools
+import json
+import logging
+import threading
+import time
+
+from typing import Iterator, Optional
+
+import auto_analysis.claims
+import auto_analysis.core as core
+import auto_analysis.ledger as ledger
+import auto_analysis.metrics as metrics
+import auto_analysis.profiling as profiling
+
+
+DEFAULT_MAX_CONCURRENT_ANALYSES = 1
+
+# Preparing an analysis reads the run's input files (to size them, and for input QC), so only a few are prepared at once.
+DEFAULT_MAX_CONCURRENT_PREPARATIONS = 1
+
+SCHEDULING_POLICIES = ['fifo', 'shortest_expected_first', 'oldest_first']
+
+DEFAULT_SCHEDULING = {
+    "policy": "fifo",
+    # Seconds of expected run time forgiven for each second spent waiting (shortest_expected_first only).
+    "aging_factor": 1.0,
+    # Lower values are started first. Instrument types that aren't listed have priority 0.
+    "instrument_type_priority": {},
+}
+
+# Used to estimate analysis time for pipelines with no history in the ledger (roughly 1 hour per GB).
+DEFAULT_SECONDS_PER_INPUT_BYTE = 3600 / 1024 ** 3
+
+
+def estimate_analysis_seconds(config: dict[str, object], pipeline: dict[str, object], run: dict[str, object]) -> Optional[float]:
+    """
+    Estimate how long an analysis will take, from the size of the run's input files and the
+    pipeline's recent analysis times per input byte (see `ledger.get_seconds_per_input_byte`).
+    Falls back to the history of other versions of the pipeline, then to `DEFAULT_SECONDS_PER_INPUT_BYTE`.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param pipeline: The pipeline about to be run.
+    :type pipeline: dict[str, object]
+    :param run: The run being analyzed.
+    :type run: dict[str, object]
+    :return: Estimated analysis time in seconds, or None if the input size of the run is unknown.
+    :rtype: Optional[float]
+    """
+    input_bytes = run.get('input_bytes', None)
+    if input_bytes is None:
+        return None
+
+    seconds_per_input_byte = ledger.get_seconds_per_input_byte(config, pipeline['name'], pipeline['version'])
+    if seconds_per_input_byte is None:
+        seconds_per_input_byte = ledger.get_seconds_per_input_byte(config, pipeline['name'])
+    if seconds_per_input_byte is None:
+        seconds_per_input_byte = DEFAULT_SECONDS_PER_INPUT_BYTE
+
+    return input_bytes * seconds_per_input_byte
+
+
+def get_max_concurrent_analyses(config: dict[str, object]) -> int:
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: The configured `max_concurrent_analyses`, or `DEFAULT_MAX_CONCURRENT_ANALYSES` if it isn't valid.
+    :rtype: int
+    """
+    try:
+        max_concurrent_analyses = int(config.get('max_concurrent_analyses', DEFAULT_MAX_CONCURRENT_ANALYSES))
+    except (TypeError, ValueError) as e:
+        max_concurrent_analyses = DEFAULT_MAX_CONCURRENT_ANALYSES
+
+    return max(1, max_concurrent_analyses)
+
+
+def get_max_concurrent_preparations(config: dict[str, object]) -> int:
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: The configured `max_concurrent_preparations`, or `DEFAULT_MAX_CONCURRENT_PREPARATIONS` if it isn't valid.
+    :rtype: int
+    """
+    try:
+        max_concurrent_preparations = int(config.get('max_concurrent_preparations', DEFAULT_MAX_CONCURRENT_PREPARATIONS))
+    except (TypeError, ValueError) as e:
+        max_concurrent_preparations = DEFAULT_MAX_CONCURRENT_PREPARATIONS
+
+    return max(1, max_concurrent_preparations)
+
+
+def get_scheduling_config(config: dict[str, object]) -> dict[str, object]:
+    """
+    Get the 'scheduling' section of the config, with defaults filled in for missing or invalid values.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Scheduling config. Keys: ['policy', 'aging_factor', 'instrument_type_priority']
+    :rtype: dict[str, object]
+    """
+    scheduling = dict(DEFAULT_SCHEDULING)
+    scheduling.update(config.get('scheduling', None) or {})
+    if scheduling['policy'] not in SCHEDULING_POLICIES:
+        logging.error(json.dumps({
+            "event_type": "unknown_scheduling_policy",
+            "scheduling_policy": scheduling['policy'],
+            "supported_scheduling_policies": SCHEDULING_POLICIES,
+        }))
+        scheduling['policy'] = DEFAULT_SCHEDULING['policy']
+    try:
+        scheduling['aging_factor'] = float(scheduling['aging_factor'])
+    except (TypeError, ValueError) as e:
+        scheduling['aging_factor'] = DEFAULT_SCHEDULING['aging_factor']
+
+    return scheduling
+
+
+def get_priority_key(scheduling: dict[str, object], waiter: dict[str, object], now: float) -> tuple:
+    """
+    Get the sort key that orders analyses waiting for a slot (lowest first). See `AnalysisScheduler`.
+
+    :param scheduling: Scheduling config, with defaults filled in (see `DEFAULT_SCHEDULING`).
+    :type scheduling: dict[str, object]
+    :param waiter: The waiting analysis. Keys: ['ticket', 'instrument_type', 'expected_seconds', 'time_requested', 'time_run_submitted']
+    :type waiter: dict[str, object]
+    :param now: Current time, on the same clock as the waiter's times.
+    :type now: float
+    :return: Sort key
+    :rtype: tuple
+    """
+    instrument_type_priority = scheduling['instrument_type_priority'].get(waiter['instrument_type'], 0)
+    policy = scheduling['policy']
+    if policy == 'shortest_expected_first':
+        aging_credit_seconds = scheduling['aging_factor'] * (now - waiter['time_requested'])
+        policy_key = (waiter['expected_seconds'] or 0.0) - aging_credit_seconds
+    elif policy == 'oldest_first':
+        policy_key = waiter['time_run_submitted']
+    else:
+        policy_key = 0
+
+    return (instrument_type_priority, policy_key, waiter['ticket'])
+
+
+class AnalysisScheduler:
+    """
+    Analyze runs concurrently, each in its own thread, while limiting the number of
+    pipelines that are executing at any one time.
+
+    Two limits are applied when a pipeline is about to start:
+
+    - The global `max_concurrent_analyses` from the config.
+    - An optional per-pipeline `max_concurrent`, from the pipeline's entry in `config['pipelines']`.
+
+    Analyses waiting for a slot are ordered by the `scheduling` config. Waiting analyses are
+    first ordered by the `instrument_type_priority` of their run (lower first), then by `policy`:
+
+    - 'fifo' (default): in the order that they asked for a slot.
+    - 'shortest_expected_first': by estimated analysis time (see `estimate_analysis_seconds`). To
+      prevent large runs from waiting indefinitely, each second spent waiting reduces the
+      estimate by `aging_factor` seconds.
+    - 'oldest_first': in the order that their runs were submitted, so that the remaining
+      pipelines of older runs are started before those of newer runs.
+
+    An analysis may be passed over while its own pipeline is at its limit.
+
+    Before they ask for an analysis slot, analyses are prepared in a `preparation_slot`. Preparation
+    reads the run's input files, so at most `max_concurrent_preparations` analyses are prepared at once,
+    however many runs have been submitted.
+    Once the scheduler starts draining, analyses that are still waiting are not started, and `draining` is set,
+    so that analyses running as batch jobs are cancelled (see `executors.run_batch`) rather than waited for.
+
+    If a `janitor` is given, it is used to delete the work dirs of finished analyses.
+    If an `outbox` is given, it is used to send the notifications of finished runs.
+    If `claims` are given, each run is only analyzed once it has been claimed from other instances
+    (see `auto_analysis.claims.RunClaims`), and the claim is released when its analysis finishes.
+    If a `warmer` is given, analyses wait for their pipeline to be warmed up before they ask for a slot.
+    """
+
+    def __init__(self, config: dict[str, object], janitor=None, outbox=None, claims=None, warmer=None):
+        self.janitor = janitor
+        self.outbox = outbox
+        self.claims = claims
+        self.warmer = warmer
+        self._condition = threading.Condition()
+        self._max_concurrent_analyses = DEFAULT_MAX_CONCURRENT_ANALYSES
+        self._scheduling = dict(DEFAULT_SCHEDULING)
+        self._num_running = 0
+        self._num_running_by_pipeline = {}
+        self._max_concurrent_preparations = DEFAULT_MAX_CONCURRENT_PREPARATIONS
+        self._num_preparing = 0
+        self._waiting = []
+        self._tickets = itertools.count()
+        self._run_threads = {}
+        self._run_submission_times = {}
+        self._accepting_runs = True
+        self.draining = threading.Event()
+        self.update_config(config)
+
+
+    def update_config(self, config: dict[str, object]):
+        """
+        Update the global concurrency limits and scheduling policy from a (re)loaded config.
+        Analyses that are already running (or being prepared) are unaffected if a limit is lowered.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :return: None
+        :rtype: NoneType
+        """
+        max_concurrent_analyses = get_max_concurrent_analyses(config)
+        max_concurrent_preparations = get_max_concurrent_preparations(config)
+        scheduling = get_scheduling_config(config)
+
+        with self._condition:
+            self._config = config
+            self._max_concurrent_analyses = max_concurrent_analyses
+            self._max_concurrent_preparations = max_concurrent_preparations
+            self._scheduling = scheduling
+            self._condition.notify_all()
+
+
+    def submit(self, config: dict[str, object], run: dict[str, object]) -> bool:
+        """
+        Start analyzing a run in the background. Runs that are already being analyzed are not resubmitted.
+
+        :param config: Application config. Should not be modified after it is submitted.
+        :type config: dict[str, object]
+        :param run: The run to analyze.
+        :type run: dict[str, object]
+        :return: Whether the run was accepted.
+        :rtype: bool
+        """
+        sequencing_run_id = run['sequencing_run_id']
+        with self._condition:
+            if not self._accepting_runs:
+                return False
+            existing_thread = self._run_threads.get(sequencing_run_id, None)
+            if existing_thread is not None and existing_thread.is_alive():
+                logging.debug(json.dumps({
+                    "event_type": "run_submission_skipped",
+                    "sequencing_run_id": sequencing_run_id,
+                    "reason": "run_analysis_in_progress",
+                }))
+                return False
+
+        # Claiming a run may take a moment on a shared filesystem, so it is done without holding the lock.
+        # Only this thread submits runs, so the run can't have been submitted again in the meantime.
+        if self.claims is not None:
+            claim_outcome = self.claims.acquire(run)
+            if claim_outcome not in auto_analysis.claims.ACQUIRED_OUTCOMES:
+                logging.debug(json.dumps({
+                    "event_type": "run_submission_skipped",
+                    "sequencing_run_id": sequencing_run_id,
+                    "reason": claim_outcome,
+                }))
+                return False
+
+        with self._condition:
+            if not self._accepting_runs:
+                if self.claims is not None:
+                    self.claims.release(sequencing_run_id)
+                return False
+            run_thread = threading.Thread(
+                target=self._analyze_run,
+                args=(config, run),
+                name='analyze-' + sequencing_run_id,
+                daemon=True,
+            )
+            self._run_threads[sequencing_run_id] = run_thread
+            self._run_submission_times[sequencing_run_id] = time.monotonic()
+            run_thread.start()
+
+        logging.info(json.dumps({"event_type": "run_submitted", "sequencing_run_id": sequencing_run_id}))
+
+        return True
+
+
+    def _analyze_run(self, config: dict[str, object], run: dict[str, object]):
+        sequencing_run_id = run['sequencing_run_id']
+        analysis_outcomes = None
+        try:
+            analysis_outcomes = core.analyze_run(config, run, scheduler=self, janitor=self.janitor, outbox=self.outbox, warmer=self.warmer)
+        except Exception as e:
+            logging.error(json.dumps({
+                "event_type": "analyze_run_failed",
+                "sequencing_run_id": sequencing_run_id,
+                "error": str(e),
+            }))
+        finally:
+            if self.claims is not None:
+                self.claims.release(sequencing_run_id, analysis_outcomes)
+            with self._condition:
+                if self._run_threads.get(sequencing_run_id, None) is threading.current_thread():
+                    self._run_threads.pop(sequencing_run_id)
+                    self._run_submission_times.pop(sequencing_run_id, None)
+                self._condition.notify_all()
+
+
+    def _priority_key(self, waiter: dict[str, object], now: float) -> tuple:
+        return get_priority_key(self._scheduling, waiter, now)
+
+
+    def _can_start(self, waiter: dict[str, object]) -> bool:
+        # When draining, waiters are released so that they can give up on their analysis.
+        if not self._accepting_runs:
+            return True
+        if self._num_running >= self._max_concurrent_analyses:
+            return False
+        if waiter['max_concurrent'] is not None and self._num_running_by_pipeline.get(waiter['pipeline_name'], 0) >= waiter['max_concurrent']:
+            return False
+        # Give higher-priority waiters first claim on the free slots, unless they are held back by their own pipeline's limit.
+        now = time.monotonic()
+        for waiting in sorted(self._waiting, key=lambda w: self._priority_key(w, now)):
+            if waiting is waiter:
+                return True
+            waiting_pipeline_at_limit = (
+                waiting['max_concurrent'] is not None and
+                self._num_running_by_pipeline.get(waiting['pipeline_name'], 0) >= waiting['max_concurrent']
+            )
+            if not waiting_pipeline_at_limit:
+                return False
+
+        return True
+
+
+    @contextlib.contextmanager
+    def analysis_slot(self, pipeline: dict[str, object], run: dict[str, object]) -> Iterator[bool]:
+        """
+        Wait for a free analysis slot, and hold it for the duration of the `with` block.
+        The `with` block's target is True if the slot was granted, or False if the scheduler
+        started draining while waiting, in which case the analysis should not be started.
+
+        :param pipeline: The pipeline about to be run.
+        :type pipeline: dict[str, object]
+        :param run: The run being analyzed.
+        :type run: dict[str, object]
+        """
+        pipeline_name = pipeline['name']
+        max_concurrent = pipeline.get('max_concurrent', None)
+        if max_concurrent is not None:
+            max_concurrent = max(1, int(max_concurrent))
+        expected_seconds = None
+        if self._scheduling['policy'] == 'shortest_expected_first':
+            expected_seconds = estimate_analysis_seconds(self._config, pipeline, run)
+
+        with self._condition:
+            now = time.monotonic()
+            waiter = {
+                'ticket': next(self._tickets),
+                'pipeline_name': pipeline_name,
+                'max_concurrent': max_concurrent,
+                'instrument_type': run.get('instrument_type', None),
+                'expected_seconds': expected_seconds,
+                'time_requested': now,
+                'time_run_submitted': self._run_submission_times.get(run['sequencing_run_id'], now),
+            }
+            self._waiting.append(waiter)
+            if not self._can_start(waiter):
+                logging.info(json.dumps({
+                    "event_type": "analysis_waiting_for_slot",
+                    "sequencing_run_id": run['sequencing_run_id'],
+                    "pipeline_name": pipeline_name,
+                    "scheduling_policy": self._scheduling['policy'],
+                    "expected_analysis_seconds": expected_seconds,
+                    "num_analyses_running": self._num_running,
+                    "num_analyses_waiting": len(self._waiting),
+                }))
+            try:
+                with profiling.span('wait_for_analysis_slot', pipeline_name=pipeline_name):
+                    while not self._can_start(waiter):
+                        self._condition.wait()
+            finally:
+                self._waiting.remove(waiter)
+            if not self._accepting_runs:
+                logging.info(json.dumps({
+                    "event_type": "analysis_cancelled",
+                    "sequencing_run_id": run['sequencing_run_id'],
+                    "pipeline_name": pipeline_name,
+                    "reason": "scheduler_draining",
+                }))
+                granted = False
+            else:
+                granted = True
+                metrics.observe("auto_analysis_stage_duration_seconds", time.monotonic() - now, {"stage": "queued", "pipeline": pipeline_name})
+                self._num_running += 1
+                self._num_running_by_pipeline[pipeline_name] = self._num_running_by_pipeline.get(pipeline_name, 0) + 1
+
+        if not granted:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            with self._condition:
+                self._num_running -= 1
+                self._num_running_by_pipeline[pipeline_name] -= 1
+                self._condition.notify_all()
+
+
+    @contextlib.contextmanager
+    def preparation_slot(self, run: dict[str, object]) -> Iterator[bool]:
+        """
+        Wait for a free preparation slot, and hold it for the duration of the `with` block.
+        Preparation slots are granted in no particular order. The `with` block's target is True if
+        the slot was granted, or False if the scheduler started draining while waiting.
+
+        :param run: The run being analyzed.
+        :type run: dict[str, object]
+        """
+        with self._condition:
+            with profiling.span('wait_for_preparation_slot'):
+                while self._accepting_runs and self._num_preparing >= self._max_concurrent_preparations:
+                    self._condition.wait()
+            if not self._accepting_runs:
+                logging.info(json.dumps({
+                    "event_type": "analysis_cancelled",
+                    "sequencing_run_id": run['sequencing_run_id'],
+                    "reason": "scheduler_draining",
+                }))
+                granted = False
+            else:
+                granted = True
+                self._num_preparing += 1
+
+        if not granted:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            with self._condition:
+                self._num_preparing -= 1
+                self._condition.notify_all()
+
+
+    def sleep_unless_draining(self, seconds: float) -> bool:
+        """
+        Sleep for up to `seconds`, waking early if the scheduler starts draining.
+
+        :param seconds: How long to sleep.
+        :type seconds: float
+        :return: False if the scheduler is draining, True otherwise.
+        :rtype: bool
+        """
+        deadline = time.monotonic() + seconds
+        with self._condition:
+            while self._accepting_runs:
+                remaining_seconds = deadline - time.monotonic()
+                if remaining_seconds <= 0:
+                    break
+                self._condition.wait(timeout=remaining_seconds)
+
+            return self._accepting_runs
+
+
+    def num_runs_in_progress(self) -> int:
+        """
+        :return: The number of runs currently being analyzed.
+        :rtype: int
+        """
+        with self._condition:
+            return sum(1 for t in self._run_threads.values() if t.is_alive())
+
+
+    def stats(self) -> dict[str, object]:
+        """
+        :return: Current state of the scheduler. Keys: ['num_runs_in_progress', 'num_running_by_pipeline', 'num_waiting_by_pipeline']
+        :rtype: dict[str, object]
+        """
+        with self._condition:
+            num_waiting_by_pipeline = {}
+            for waiter in self._waiting:
+                num_waiting_by_pipeline[waiter['pipeline_name']] = num_waiting_by_pipeline.get(waiter['pipeline_name'], 0) + 1
+            scheduler_stats = {
+                'num_runs_in_progress': sum(1 for t in self._run_threads.values() if t.is_alive()),
+                'num_running_by_pipeline': dict(self._num_running_by_pipeline),
+                'num_waiting_by_pipeline': num_waiting_by_pipeline,
+            }
+
+        return scheduler_stats
+
+
+    def drain(self, poll_interval_seconds: float=1.0):
+        """
+        Stop accepting new runs, and wait for all running analyses to finish. Analyses
+        that are still waiting for a slot are not started, and batch jobs are cancelled.
+
+        :param poll_interval_seconds: How often to check on in-progress runs.
+        :type poll_interval_seconds: float
+        :return: None
+        :rtype: NoneType
+        """
+        with self._condition:
+            self._accepting_runs = False
+            self.draining.set()
+            num_runs_in_progress = sum(1 for t in self._run_threads.values() if t.is_alive())
+            self._condition.notify_all()
+        logging.info(json.dumps({"event_type": "scheduler_draining", "num_runs_in_progress": num_runs_in_progress}))
+
+        with self._condition:
+            while any(t.is_alive() for t in self._run_threads.values()):
+                self._condition.wait(timeout=poll_interval_seconds)
+
+        logging.info(json.dumps({"event_type": "scheduler_drained"}))
@@ -0,0 +1,372 @@
+import heapq
+import itertools
+import json
+import logging
+import math
+import random
+import statistics
+
+from typing import Optional
+
+import auto_analysis.config
+import auto_analysis.core as core
+import auto_analysis.ledger as ledger
+import auto_analysis.scheduler as scheduler
+
+from auto_analysis.trace_history import percentile
+
+
+DEFAULT_SIMULATION_CONFIG = {
+    "duration_days": 7,
+    "seed": 0,
+    # Runs arrive (become ready to analyze) as a Poisson process for each instrument model, with
+    # input sizes drawn from a lognormal distribution around `input_gigabytes`.
+    "arrivals": [
+        {"instrument_model": "miseq", "runs_per_day": 2, "input_gigabytes": 5},
+    ],
+    # Analysis times by pipeline name, drawn from a lognormal distribution: {"median_seconds": ..., "sigma": ...}.
+    # Pipelines that aren't listed are modelled from their history in the analysis ledger (see `_draw_analysis_seconds`).
+    "pipeline_runtimes": {},
+    # Time taken by the stages around each analysis.
+    "stage_seconds": {
+        "prepare": 60,
+        "post_analysis": 60,
+        "notification": 5,
+    },
+    # Fraction of analyses that fail. Pipelines that depend on a failed analysis are skipped.
+    "failure_rate": 0.0,
+}
+
+INPUT_SIZE_SIGMA = 0.3
+
+REPORTED_PERCENTILES = [50, 90, 99]
+
+
+def get_simulation_config(config: dict[str, object]) -> dict[str, object]:
+    """
+    Get the 'simulation' section of the config, with defaults filled in.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Simulation config (see `DEFAULT_SIMULATION_CONFIG`)
+    :rtype: dict[str, object]
+    """
+    simulation_config = dict(DEFAULT_SIMULATION_CONFIG)
+    simulation_config.update(config.get('simulation', None) or {})
+    stage_seconds = dict(DEFAULT_SIMULATION_CONFIG['stage_seconds'])
+    stage_seconds.update(simulation_config['stage_seconds'] or {})
+    simulation_config['stage_seconds'] = stage_seconds
+
+    return simulation_config
+
+
+def _summarize(values: list[float]) -> dict[str, Optional[float]]:
+    sorted_values = sorted(values)
+    summary = {"count": len(sorted_values)}
+    summary["mean"] = round(statistics.fmean(sorted_values), 1) if sorted_values else None
+    for reported_percentile in REPORTED_PERCENTILES:
+        value = percentile(sorted_values, reported_percentile)
+        summary["p" + str(reported_percentile)] = round(value, 1) if value is not None else None
+    summary["max"] = round(sorted_values[-1], 1) if sorted_values else None
+
+    return summary
+
+
+class Simulation:
+    """
+    Discrete-event simulation of auto-analysis on a virtual clock: runs arrive, are found by a scan (or
+    immediately, in watch mode), and each of their pipelines is prepared, waits for an analysis slot,
+    is analyzed, and is post-processed, with downstream pipelines started as their dependencies finish.
+    A notification is sent once all of a run's pipelines have finished.
+
+    Analysis slots are allocated as the `AnalysisScheduler` would, with the same `max_concurrent_analyses`,
+    per-pipeline `max_concurrent` limits and `scheduling` policy.
+
+    This is a model of auto-analysis, rather than a run of its code. Scans, preparation, post-analysis and
+    notification take the fixed `stage_seconds`. The ledger, manifests, input QC, run claims and the filesystem
+    aren't touched. So it shows where the scan interval, concurrency limits and pipeline dependencies limit
+    throughput, but not the cost of the stages themselves. Those are measured with `--profile` and `benchmarks/`.
+
+    Analysis times come from `pipeline_runtimes`, or from the ledger's history of analysis times per input byte.
+    The trace history isn't used: it records the time of each task, but not the pipeline's wall-clock time.
+    """
+
+    def __init__(self, config: dict[str, object], scan_interval_seconds: float, watch: bool=False):
+        """
+        :param config: Application config, with an optional 'simulation' section (see `DEFAULT_SIMULATION_CONFIG`).
+        :type config: dict[str, object]
+        :param scan_interval_seconds: Time between scans.
+        :type scan_interval_seconds: float
+        :param watch: Whether runs are found as soon as they are ready (`--watch`), rather than by the next scan.
+        :type watch: bool
+        """
+        self.config = config
+        self.simulation_config = get_simulation_config(config)
+        self.scan_interval_seconds = max(1.0, scan_interval_seconds)
+        self.watch = watch
+        self.pipelines = [pipeline for pipeline in config['pipelines'] if pipeline is not None]
+        self.upstream_pipeline_indexes = auto_analysis.config.build_pipeline_dependency_graph(self.pipelines)
+        self.max_concurrent_analyses = scheduler.get_max_concurrent_analyses(config)
+        self.scheduling = scheduler.get_scheduling_config(config)
+        self.duration_seconds = float(self.simulation_config['duration_days']) * 86400
+        self.rng = random.Random(self.simulation_config['seed'])
+
+        self.now = 0.0
+        self._events = []
+        self._event_sequence = itertools.count()
+        self._tickets = itertools.count()
+        self.runs = []
+        self.waiting = []
+        self.num_running = 0
+        self.num_running_by_pipeline = {}
+        self.max_num_waiting = 0
+        self._slot_seconds_used = 0.0
+        self._slot_seconds_used_by_pipeline = {}
+        self._last_slot_change = 0.0
+        self._seconds_per_input_byte_history = {}
+        self.analyses = []
+
+
+    def _schedule(self, delay_seconds: float, handler, *args):
+        heapq.heappush(self._events, (self.now + delay_seconds, next(self._event_sequence), handler, args))
+
+
+    def _generate_arrivals(self):
+        run_numbers = itertools.count(1)
+        for arrival in self.simulation_config['arrivals']:
+            instrument_model = arrival['instrument_model']
+            instrument_type = core.INSTRUMENT_TYPES_BY_INSTRUMENT_MODEL.get(instrument_model, instrument_model)
+            runs_per_second = float(arrival['runs_per_day']) / 86400
+            if runs_per_second <= 0:
+                continue
+            input_bytes_median = float(arrival.get('input_gigabytes', 1)) * 1024 ** 3
+            arrival_time = self.rng.expovariate(runs_per_second)
+            while arrival_time < self.duration_seconds:
+                run = {
+                    'sequencing_run_id': 'simulated-' + instrument_model + '-' + str(next(run_numbers)),
+                    'instrument_type': instrument_type,
+                    'input_bytes': int(self.rng.lognormvariate(math.log(input_bytes_median), INPUT_SIZE_SIGMA)),
+                    'time_arrived': arrival_time,
+                    'time_discovered': None,
+                    'time_notified': None,
+                    'pipelines_started': set(),
+                    'analysis_outcomes': {},
+                }
+                self.runs.append(run)
+                if self.watch:
+                    discovery_time = arrival_time
+                else:
+                    discovery_time = math.ceil(arrival_time / self.scan_interval_seconds) * self.scan_interval_seconds
+                heapq.heappush(self._events, (discovery_time, next(self._event_sequence), self._run_discovered, (run,)))
+                arrival_time += self.rng.expovariate(runs_per_second)
+
+
+    def _get_runtime_model(self, pipeline: dict[str, object]) -> str:
+        if pipeline['name'] in self.simulation_config['pipeline_runtimes']:
+            return 'config'
+        if self._get_seconds_per_input_byte_history(pipeline):
+            return 'ledger_history'
+
+        return 'default_seconds_per_input_byte'
+
+
+    def _get_seconds_per_input_byte_history(self, pipeline: dict[str, object]) -> list[float]:
+        # As in `scheduler.estimate_analysis_seconds`, the history of other versions of the pipeline is used if this version has none.
+        pipeline_key = (pipeline['name'], pipeline['version'])
+        if pipeline_key not in self._seconds_per_input_byte_history:
+            history = ledger.get_seconds_per_input_byte_history(self.config, pipeline['name'], pipeline['version'])
+            if not history:
+                history = ledger.get_seconds_per_input_byte_history(self.config, pipeline['name'])
+            self._seconds_per_input_byte_history[pipeline_key] = history
+
+        return self._seconds_per_input_byte_history[pipeline_key]
+
+
+    def _draw_analysis_seconds(self, pipeline: dict[str, object], run: dict[str, object]) -> float:
+        """
+        Draw an analysis time from the pipeline's configured runtime distribution if it has one. Otherwise, one of
+        the pipeline's recent analysis times per input byte is drawn from the ledger and scaled to the run's input size,
+        falling back to `scheduler.DEFAULT_SECONDS_PER_INPUT_BYTE` if there is no history.
+        """
+        runtime = self.simulation_config['pipeline_runtimes'].get(pipeline['name'], None)
+        if runtime is not None:
+            return self.rng.lognormvariate(math.log(float(runtime['median_seconds'])), float(runtime.get('sigma', 0.5)))
+        history = self._get_seconds_per_input_byte_history(pipeline)
+        if history:
+            return self.rng.choice(history) * run['input_bytes']
+
+        return scheduler.DEFAULT_SECONDS_PER_INPUT_BYTE * run['input_bytes']
+
+
+    def _update_slot_usage(self):
+        elapsed_seconds = self.now - self._last_slot_change
+        self._slot_seconds_used += self.num_running * elapsed_seconds
+        for pipeline_name, num_running in self.num_running_by_pipeline.items():
+            self._slot_seconds_used_by_pipeline[pipeline_name] = self._slot_seconds_used_by_pipeline.get(pipeline_name, 0.0) + num_running * elapsed_seconds
+        self._last_slot_change = self.now
+
+
+    def _run_discovered(self, run: dict[str, object]):
+        run['time_discovered'] = self.now
+        self._start_ready_pipelines(run)
+
+
+    def _start_ready_pipelines(self, run: dict[str, object]):
+        for pipeline_index, upstream in self.upstream_pipeline_indexes.items():
+            if pipeline_index in run['pipelines_started'] or not upstream.issubset(run['analysis_outcomes']):
+                continue
+            run['pipelines_started'].add(pipeline_index)
+            self._schedule(float(self.simulation_config['stage_seconds']['prepare']), self._pipeline_prepared, run, pipeline_index)
+
+
+    def _pipeline_prepared(self, run: dict[str, object], pipeline_index: int):
+        pipeline = self.pipelines[pipeline_index]
+        upstream_outcomes = [run['analysis_outcomes'][upstream_index] for upstream_index in self.upstream_pipeline_indexes[pipeline_index]]
+        if any(outcome != 'complete' for outcome in upstream_outcomes):
+            self._pipeline_finished(run, pipeline_index, 'skipped')
+            return
+
+        max_concurrent = pipeline.get('max_concurrent', None)
+        expected_seconds = None
+        if self.scheduling['policy'] == 'shortest_expected_first':
+            expected_seconds = scheduler.estimate_analysis_seconds(self.config, pipeline, run)
+        self.waiting.append({
+            'ticket': next(self._tickets),
+            'pipeline_index': pipeline_index,
+            'pipeline_name': pipeline['name'],
+            'max_concurrent': max(1, int(max_concurrent)) if max_concurrent is not None else None,
+            'instrument_type': run['instrument_type'],
+            'expected_seconds': expected_seconds,
+            'time_requested': self.now,
+            'time_run_submitted': run['time_discovered'],
+            'run': run,
+        })
+        self.max_num_waiting = max(self.max_num_waiting, len(self.waiting))
+        self._start_waiting_analyses()
+
+
+    def _pipeline_at_limit(self, waiter: dict[str, object]) -> bool:
+        return waiter['max_concurrent'] is not None and self.num_running_by_pipeline.get(waiter['pipeline_name'], 0) >= waiter['max_concurrent']
+
+
+    def _start_waiting_analyses(self):
+        # As in `AnalysisScheduler._can_start`: waiters take free slots in priority order,
+        # except those held back by their own pipeline's limit.
+        for waiter in sorted(self.waiting, key=lambda w: scheduler.get_priority_key(self.scheduling, w, self.now)):
+            if self.num_running >= self.max_concurrent_analyses:
+                break
+            if self._pipeline_at_limit(waiter):
+                continue
+            self.waiting.remove(waiter)
+            self._update_slot_usage()
+            self.num_running += 1
+            self.num_running_by_pipeline[waiter['pipeline_name']] = self.num_running_by_pipeline.get(waiter['pipeline_name'], 0) + 1
+            pipeline = self.pipelines[waiter['pipeline_index']]
+            analysis = {
+                'pipeline_name': waiter['pipeline_name'],
+                'queue_wait_seconds': self.now - waiter['time_requested'],
+                'analysis_seconds': self._draw_analysis_seconds(pipeline, waiter['run']),
+            }
+            self.analyses.append(analysis)
+            outcome = 'failed' if self.rng.random() < float(self.simulation_config['failure_rate']) else 'complete'
+            self._schedule(analysis['analysis_seconds'], self._analysis_finished, waiter['run'], waiter['pipeline_index'], outcome)
+
+
+    def _analysis_finished(self, run: dict[str, object], pipeline_index: int, outcome: str):
+        pipeline_name = self.pipelines[pipeline_index]['name']
+        self._update_slot_usage()
+        self.num_running -= 1
+        self.num_running_by_pipeline[pipeline_name] -= 1
+        self._schedule(float(self.simulation_config['stage_seconds']['post_analysis']), self._pipeline_finished, run, pipeline_index, outcome)
+        self._start_waiting_analyses()
+
+
+    def _pipeline_finished(self, run: dict[str, object], pipeline_index: int, outcome: str):
+        run['analysis_outcomes'][pipeline_index] = outcome
+        if len(run['analysis_outcomes']) == len(self.pipelines):
+            self._schedule(float(self.simulation_config['stage_seconds']['notification']), self._run_notified, run)
+        else:
+            self._start_ready_pipelines(run)
+
+
+    def _run_notified(self, run: dict[str, object]):
+        run['time_notified'] = self.now
+
+
+    def run(self) -> dict[str, object]:
+        """
+        Simulate `duration_days` of arrivals. Analyses that are still in progress at the end are left unfinished.
+
+        :return: Report of throughput, queue waits, slot utilization and turnaround times.
+        :rtype: dict[str, object]
+        """
+        self._generate_arrivals()
+        while self._events and self._events[0][0] <= self.duration_seconds:
+            event_time, _, handler, args = heapq.heappop(self._events)
+            self.now = event_time
+            handler(*args)
+        self.now = self.duration_seconds
+        self._update_slot_usage()
+
+        return self.report()
+
+
+    def report(self) -> dict[str, object]:
+        """
+        :return: Report of throughput, queue waits, slot utilization and turnaround times.
+        :rtype: dict[str, object]
+        """
+        simulated_days = self.duration_seconds / 86400
+        notified_runs = [run for run in self.runs if run['time_notified'] is not None]
+        discovered_runs = [run for run in self.runs if run['time_discovered'] is not None]
+        pipelines_report = {}
+        for pipeline in self.pipelines:
+            pipeline_analyses = [analysis for analysis in self.analyses if analysis['pipeline_name'] == pipeline['name']]
+            pipeline_report = {
+                "runtime_model": self._get_runtime_model(pipeline),
+                "max_concurrent": pipeline.get('max_concurrent', None),
+                "num_analyses_started": len(pipeline_analyses),
+                "queue_wait_seconds": _summarize([analysis['queue_wait_seconds'] for analysis in pipeline_analyses]),
+                "analysis_seconds": _summarize([analysis['analysis_seconds'] for analysis in pipeline_analyses]),
+                "mean_slots_used": round(self._slot_seconds_used_by_pipeline.get(pipeline['name'], 0.0) / self.duration_seconds, 3),
+            }
+            pipelines_report[pipeline['name']] = pipeline_report
+
+        return {
+            "simulated_days": simulated_days,
+            "scan_interval_seconds": None if self.watch else self.scan_interval_seconds,
+            "watch": self.watch,
+            "max_concurrent_analyses": self.max_concurrent_analyses,
+            "scheduling_policy": self.scheduling['policy'],
+            "num_runs_arrived": len(self.runs),
+            "num_runs_completed": len(notified_runs),
+            "num_runs_unfinished": len(self.runs) - len(notified_runs),
+            "throughput_runs_per_day": round(len(notified_runs) / simulated_days, 2),
+            "num_analyses_waiting_at_end": len(self.waiting),
+            "max_num_analyses_waiting": self.max_num_waiting,
+            "slot_utilization": round(self._slot_seconds_used / (self.duration_seconds * self.max_concurrent_analyses), 3),
+            "discovery_delay_seconds": _summarize([run['time_discovered'] - run['time_arrived'] for run in discovered_runs]),
+            "queue_wait_seconds": _summarize([analysis['queue_wait_seconds'] for analysis in self.analyses]),
+            "turnaround_seconds": _summarize([run['time_notified'] - run['time_arrived'] for run in notified_runs]),
+            "pipelines": pipelines_report,
+        }
+
+
+def simulate(config: dict[str, object], scan_interval_seconds: float, watch: bool=False) -> dict[str, object]:
+    """
+    Simulate auto-analysis with the given config (see `Simulation`), and log the report in a 'simulation_complete' event.
+
+    :param config: Application config, with an optional 'simulation' section (see `DEFAULT_SIMULATION_CONFIG`).
+    :type config: dict[str, object]
+    :param scan_interval_seconds: Time between scans.
+    :type scan_interval_seconds: float
+    :param watch: Whether runs are found as soon as they are ready (`--watch`), rather than by the next scan.
+    :type watch: bool
+    :return: Report of throughput, queue waits, slot utilization and turnaround times.
+    :rtype: dict[str, object]
+    """
+    simulation = Simulation(config, scan_interval_seconds, watch)
+    report = simulation.run()
+    logging.info(json.dumps({"event_type": "simulation_complete", **report}))
+
+    return report
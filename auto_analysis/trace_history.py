@@ -0,0 +1,337 @@
+import argparse
+import datetime
+import json
+import logging
+import math
+import os
+import re
+import sqlite3
+
+from contextlib import closing
+from pathlib import Path
+from typing import Optional
+
+import auto_analysis.parsers as parsers
+from auto_analysis.config import load_config
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS process_executions (
+    pipeline_name TEXT NOT NULL,
+    pipeline_version TEXT NOT NULL,
+    sequencing_run_id TEXT NOT NULL,
+    task_id INTEGER NOT NULL,
+    process_name TEXT NOT NULL,
+    task_tag TEXT,
+    status TEXT,
+    exit_status INTEGER,
+    realtime_seconds REAL,
+    percent_cpu REAL,
+    peak_rss_bytes INTEGER,
+    rchar_bytes INTEGER,
+    wchar_bytes INTEGER,
+    timestamp_ingested TEXT NOT NULL,
+    PRIMARY KEY (pipeline_name, pipeline_version, sequencing_run_id, task_id)
+);
+CREATE INDEX IF NOT EXISTS idx_process_executions_process
+    ON process_executions (pipeline_name, pipeline_version, process_name);
+"""
+
+_DURATION_UNITS_SECONDS = {
+    'ms': 0.001,
+    's': 1,
+    'm': 60,
+    'h': 3600,
+    'd': 86400,
+}
+
+_MEMORY_UNITS_BYTES = {
+    'B': 1,
+    'KB': 1024,
+    'MB': 1024 ** 2,
+    'GB': 1024 ** 3,
+    'TB': 1024 ** 4,
+    'PB': 1024 ** 5,
+}
+
+_DURATION_PART_REGEX = re.compile(r'([\d.]+)(ms|s|m|h|d)')
+
+_TRACE_SCHEMA = parsers.CsvSchema(int_fields=['task_id', 'exit'])
+
+
+def parse_duration_seconds(value: str) -> Optional[float]:
+    """
+    Parse a duration from a nextflow trace file. Human-readable values look like '1h 2m 3s' or '350ms'.
+    Raw values (when `trace.raw = true`) are in milliseconds.
+
+    :param value: Duration from the trace file
+    :type value: str
+    :return: Duration in seconds, or None if the value is missing.
+    :rtype: Optional[float]
+    """
+    value = value.strip()
+    if value in ('', '-'):
+        return None
+    if value.isdigit():
+        return int(value) / 1000
+
+    duration_seconds = 0.0
+    for amount, unit in _DURATION_PART_REGEX.findall(value):
+        duration_seconds += float(amount) * _DURATION_UNITS_SECONDS[unit]
+
+    return duration_seconds
+
+
+def parse_memory_bytes(value: str) -> Optional[int]:
+    """
+    Parse a memory or I/O size from a nextflow trace file. Human-readable values look like '1.2 GB'.
+    Raw values are in bytes.
+
+    :param value: Size from the trace file
+    :type value: str
+    :return: Size in bytes, or None if the value is missing.
+    :rtype: Optional[int]
+    """
+    value = value.strip()
+    if value in ('', '-'):
+        return None
+    if value.isdigit():
+        return int(value)
+
+    parts = value.split()
+    if len(parts) != 2 or parts[1] not in _MEMORY_UNITS_BYTES:
+        return None
+    try:
+        return int(float(parts[0]) * _MEMORY_UNITS_BYTES[parts[1]])
+    except ValueError as e:
+        return None
+
+
+def parse_percent(value: str) -> Optional[float]:
+    """
+    Parse a percentage (eg. '195.3%') from a nextflow trace file.
+
+    :param value: Percentage from the trace file
+    :type value: str
+    :return: The percentage, or None if the value is missing.
+    :rtype: Optional[float]
+    """
+    value = value.strip().rstrip('%')
+    try:
+        return float(value)
+    except ValueError as e:
+        return None
+
+
+def parse_trace(trace_path: Path) -> list[dict[str, object]]:
+    """
+    Parse a nextflow trace file into one record per task.
+
+    :param trace_path: Path to the trace file (`-with-trace` output).
+    :type trace_path: Path
+    :return: Parsed tasks. Keys: ['task_id', 'process_name', 'task_tag', 'status', 'exit_status', 'realtime_seconds',
+             'percent_cpu', 'peak_rss_bytes', 'rchar_bytes', 'wchar_bytes']
+    :rtype: list[dict[str, object]]
+    """
+    tasks = []
+    trace_rows = parsers.iter_csv(trace_path, _TRACE_SCHEMA, delimiter='\t')
+    for row in trace_rows:
+        if row.get('task_id', None) is None:
+            continue
+        # Task names look like 'PROCESS_NAME (tag)'
+        task_name = row.get('name', '')
+        process_name, _, task_tag = task_name.partition(' (')
+        task = {
+            'task_id': row['task_id'],
+            'process_name': process_name,
+            'task_tag': task_tag.rstrip(')') or None,
+            'status': row.get('status', None),
+            'exit_status': row.get('exit', None),
+            'realtime_seconds': parse_duration_seconds(row.get('realtime', '') or ''),
+            'percent_cpu': parse_percent(row.get('%cpu', '') or ''),
+            'peak_rss_bytes': parse_memory_bytes(row.get('peak_rss', '') or ''),
+            'rchar_bytes': parse_memory_bytes(row.get('rchar', '') or ''),
+            'wchar_bytes': parse_memory_bytes(row.get('wchar', '') or ''),
+        }
+        tasks.append(task)
+
+    return tasks
+
+
+def connect(trace_history_db: str) -> sqlite3.Connection:
+    """
+    Open a connection to the trace history database, creating it if needed.
+
+    :param trace_history_db: Path to the trace history database.
+    :type trace_history_db: str
+    :return: Connection to the database
+    :rtype: sqlite3.Connection
+    """
+    conn = sqlite3.connect(trace_history_db, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(_SCHEMA)
+
+    return conn
+
+
+def ingest_trace(config: dict[str, object], pipeline: dict[str, object], run: dict[str, object]) -> int:
+    """
+    Load the trace file of a finished analysis into the trace history database.
+    Does nothing if `trace_history_db` is not configured.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param pipeline: The pipeline dictionary, as prepared by `pre_analysis.prepare_analysis`.
+    :type pipeline: dict[str, object]
+    :param run: The run dictionary
+    :type run: dict[str, object]
+    :return: Number of tasks ingested
+    :rtype: int
+    """
+    trace_history_db = config.get('trace_history_db', None)
+    if not trace_history_db:
+        return 0
+
+    sequencing_run_id = run['sequencing_run_id']
+    trace_path = pipeline.get('parameters', {}).get('trace_path', None)
+    if not trace_path or not os.path.exists(trace_path):
+        logging.warning(json.dumps({
+            "event_type": "trace_file_not_found",
+            "sequencing_run_id": sequencing_run_id,
+            "pipeline_name": pipeline['name'],
+            "trace_path": trace_path,
+        }))
+        return 0
+
+    tasks = parse_trace(trace_path)
+    timestamp = datetime.datetime.now().isoformat()
+    rows = [
+        (
+            pipeline['name'], pipeline['version'], sequencing_run_id, task['task_id'], task['process_name'], task['task_tag'],
+            task['status'], task['exit_status'], task['realtime_seconds'], task['percent_cpu'], task['peak_rss_bytes'],
+            task['rchar_bytes'], task['wchar_bytes'], timestamp,
+        )
+        for task in tasks
+    ]
+    with closing(connect(trace_history_db)) as conn, conn:
+        conn.executemany("INSERT OR REPLACE INTO process_executions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    logging.info(json.dumps({
+        "event_type": "trace_ingested",
+        "sequencing_run_id": sequencing_run_id,
+        "pipeline_name": pipeline['name'],
+        "pipeline_version": pipeline['version'],
+        "trace_path": trace_path,
+        "num_tasks": len(rows),
+    }))
+
+    return len(rows)
+
+
+def percentile(sorted_values: list[float], percentile: float) -> Optional[float]:
+    """
+    Nearest-rank percentile of an already-sorted list.
+
+    :param sorted_values: Values, sorted in ascending order.
+    :type sorted_values: list[float]
+    :param percentile: Percentile, from 0 to 100.
+    :type percentile: float
+    :return: The percentile, or None if there are no values.
+    :rtype: Optional[float]
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(percentile / 100 * len(sorted_values)))
+
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def get_process_statistics(trace_history_db: str, pipeline_name: str, pipeline_version: Optional[str]=None) -> list[dict[str, object]]:
+    """
+    Summarize runtime and memory use per process, across all ingested runs of a pipeline.
+    Only successfully-completed (or cached) tasks are included.
+
+    :param trace_history_db: Path to the trace history database.
+    :type trace_history_db: str
+    :param pipeline_name: Pipeline name (eg. 'BCCDC-PHL/routine-assembly')
+    :type pipeline_name: str
+    :param pipeline_version: Pipeline version. If None, statistics are given for each version.
+    :type pipeline_version: Optional[str]
+    :return: One record per (pipeline_version, process_name). Keys: ['pipeline_name', 'pipeline_version', 'process_name',
+             'num_tasks', 'num_runs', 'realtime_seconds_p50', 'realtime_seconds_p95', 'peak_rss_bytes_p50', 'peak_rss_bytes_p95']
+    :rtype: list[dict[str, object]]
+    """
+    query = (
+        "SELECT pipeline_version, process_name, sequencing_run_id, realtime_seconds, peak_rss_bytes "
+        "FROM process_executions WHERE pipeline_name = ? AND status IN ('COMPLETED', 'CACHED')"
+    )
+    query_params = [pipeline_name]
+    if pipeline_version is not None:
+        query += " AND pipeline_version = ?"
+        query_params.append(pipeline_version)
+
+    executions_by_process = {}
+    with closing(connect(trace_history_db)) as conn:
+        for version, process_name, sequencing_run_id, realtime_seconds, peak_rss_bytes in conn.execute(query, query_params):
+            executions = executions_by_process.setdefault((version, process_name), {'runs': set(), 'realtime_seconds': [], 'peak_rss_bytes': []})
+            executions['runs'].add(sequencing_run_id)
+            if realtime_seconds is not None:
+                executions['realtime_seconds'].append(realtime_seconds)
+            if peak_rss_bytes is not None:
+                executions['peak_rss_bytes'].append(peak_rss_bytes)
+
+    process_statistics = []
+    for (version, process_name), executions in sorted(executions_by_process.items()):
+        realtime_seconds = sorted(executions['realtime_seconds'])
+        peak_rss_bytes = sorted(executions['peak_rss_bytes'])
+        process_statistics.append({
+            'pipeline_name': pipeline_name,
+            'pipeline_version': version,
+            'process_name': process_name,
+            'num_tasks': max(len(realtime_seconds), len(peak_rss_bytes)),
+            'num_runs': len(executions['runs']),
+            'realtime_seconds_p50': percentile(realtime_seconds, 50),
+            'realtime_seconds_p95': percentile(realtime_seconds, 95),
+            'peak_rss_bytes_p50': percentile(peak_rss_bytes, 50),
+            'peak_rss_bytes_p95': percentile(peak_rss_bytes, 95),
+        })
+
+    return process_statistics
+
+
+def main(args):
+    config = load_config(args.config)
+    trace_history_db = config.get('trace_history_db', None)
+    if not trace_history_db or not os.path.exists(trace_history_db):
+        print("No trace history found. Set 'trace_history_db' in the config.")
+        exit(1)
+
+    process_statistics = get_process_statistics(trace_history_db, args.pipeline, args.pipeline_version)
+    if args.json:
+        print(json.dumps(process_statistics, indent=2))
+        return
+
+    header = ['pipeline_version', 'process_name', 'num_runs', 'num_tasks', 'realtime_p50', 'realtime_p95', 'peak_rss_p50_mb', 'peak_rss_p95_mb']
+    print('\t'.join(header))
+    for stats in process_statistics:
+        row = [
+            stats['pipeline_version'],
+            stats['process_name'],
+            stats['num_runs'],
+            stats['num_tasks'],
+        ]
+        for key in ['realtime_seconds_p50', 'realtime_seconds_p95']:
+            row.append('' if stats[key] is None else f"{stats[key]:.1f}s")
+        for key in ['peak_rss_bytes_p50', 'peak_rss_bytes_p95']:
+            row.append('' if stats[key] is None else f"{stats[key] / 1024 ** 2:.0f}")
+        print('\t'.join(map(str, row)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Show per-process runtime and memory statistics from ingested nextflow traces.")
+    parser.add_argument('-c', '--config', required=True)
+    parser.add_argument('--pipeline', required=True, help="Pipeline name (eg. BCCDC-PHL/routine-assembly)")
+    parser.add_argument('--pipeline-version', help="Only show statistics for this pipeline version")
+    parser.add_argument('--json', action='store_true', help="Output JSON instead of a table")
+    args = parser.parse_args()
+    main(args)
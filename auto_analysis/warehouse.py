@@ -0,0 +1,341 @@
+import argparse
+import datetime
+import glob
+import json
+import logging
+import os
+import re
+import sqlite3
+
+from contextlib import closing
+from typing import Optional
+
+import auto_analysis.input_qc as input_qc
+import auto_analysis.parsers as parsers
+from auto_analysis.config import load_config
+
+
+# Results loaded from each run's `input_fastq_qc.json` are recorded under this pipeline name.
+INPUT_FASTQ_QC_PIPELINE_NAME = 'auto-analysis/input-fastq-qc'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS result_loads (
+    load_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sequencing_run_id TEXT NOT NULL,
+    pipeline_name TEXT NOT NULL,
+    pipeline_version TEXT NOT NULL,
+    source_path TEXT NOT NULL,
+    source_fingerprint TEXT NOT NULL,
+    num_rows INTEGER NOT NULL,
+    timestamp_loaded TEXT NOT NULL,
+    UNIQUE (sequencing_run_id, pipeline_name, pipeline_version, source_path, source_fingerprint)
+);
+CREATE TABLE IF NOT EXISTS library_results (
+    load_id INTEGER NOT NULL REFERENCES result_loads (load_id),
+    sequencing_run_id TEXT NOT NULL,
+    run_date TEXT,
+    library_id TEXT NOT NULL,
+    pipeline_name TEXT NOT NULL,
+    pipeline_version TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value
+);
+CREATE INDEX IF NOT EXISTS idx_library_results_library_id ON library_results (library_id);
+CREATE INDEX IF NOT EXISTS idx_library_results_run_date ON library_results (run_date);
+CREATE INDEX IF NOT EXISTS idx_library_results_run ON library_results (sequencing_run_id, pipeline_name, pipeline_version);
+CREATE VIEW IF NOT EXISTS latest_library_results AS
+    SELECT library_results.* FROM library_results
+    JOIN result_loads USING (load_id)
+    WHERE load_id = (
+        SELECT MAX(latest.load_id) FROM result_loads AS latest
+        WHERE latest.sequencing_run_id = result_loads.sequencing_run_id
+          AND latest.pipeline_name = result_loads.pipeline_name
+          AND latest.pipeline_version = result_loads.pipeline_version
+          AND latest.source_path = result_loads.source_path
+    );
+"""
+
+_SUMMARY_OUTPUT_SCHEMA = parsers.CsvSchema(null_values=['', 'NA', 'N/A', '-'])
+
+_ILLUMINA_RUN_DATE_REGEX = re.compile(r'^(\d{2})(\d{2})(\d{2})_')
+_NANOPORE_RUN_DATE_REGEX = re.compile(r'^(\d{4})(\d{2})(\d{2})_')
+
+_initialized_warehouse_paths = set()
+
+
+def get_warehouse_path(config: dict[str, object]) -> Optional[str]:
+    """
+    Get the path to the results warehouse database from the config.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Path to the warehouse database, or None if the warehouse is not configured.
+    :rtype: Optional[str]
+    """
+    warehouse_path = config.get('results_warehouse_db', None)
+    if not warehouse_path:
+        return None
+
+    return os.path.abspath(warehouse_path)
+
+
+def connect(warehouse_path: str) -> sqlite3.Connection:
+    """
+    Open a connection to the results warehouse, creating the database if needed.
+
+    :param warehouse_path: Path to the warehouse database.
+    :type warehouse_path: str
+    :return: Connection to the warehouse database
+    :rtype: sqlite3.Connection
+    """
+    conn = sqlite3.connect(warehouse_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    if warehouse_path not in _initialized_warehouse_paths:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        _initialized_warehouse_paths.add(warehouse_path)
+
+    return conn
+
+
+def get_run_date(sequencing_run_id: str) -> Optional[str]:
+    """
+    Get the date a run was started from its ID. Illumina run IDs start with 'YYMMDD_', and nanopore run IDs with 'YYYYMMDD_'.
+
+    :param sequencing_run_id: Sequencing run ID
+    :type sequencing_run_id: str
+    :return: Run date, in ISO format (YYYY-MM-DD), or None if the run ID doesn't start with a date.
+    :rtype: Optional[str]
+    """
+    nanopore_match = _NANOPORE_RUN_DATE_REGEX.match(sequencing_run_id)
+    if nanopore_match:
+        year, month, day = nanopore_match.groups()
+    else:
+        illumina_match = _ILLUMINA_RUN_DATE_REGEX.match(sequencing_run_id)
+        if not illumina_match:
+            return None
+        year, month, day = illumina_match.groups()
+        year = '20' + year
+    try:
+        return datetime.date(int(year), int(month), int(day)).isoformat()
+    except ValueError as e:
+        return None
+
+
+def _to_number(value: object) -> object:
+    """
+    Store numeric-looking values as numbers, so that they can be compared and aggregated in queries.
+    """
+    if not isinstance(value, str):
+        return value
+    try:
+        return int(value)
+    except ValueError as e:
+        pass
+    try:
+        return float(value)
+    except ValueError as e:
+        return value
+
+
+def load_library_results(warehouse_path: str, sequencing_run_id: str, pipeline_name: str, pipeline_version: str, source_path: str, library_results: dict[str, dict[str, object]]) -> int:
+    """
+    Append one set of per-library results to the warehouse. Nothing is loaded if this exact version of the source
+    file (by size and mtime) has been loaded before. If the source file has changed, its new results are loaded
+    alongside the old ones, and take their place in the `latest_library_results` view.
+
+    :param warehouse_path: Path to the warehouse database.
+    :type warehouse_path: str
+    :param sequencing_run_id: Sequencing run ID
+    :type sequencing_run_id: str
+    :param pipeline_name: Name of the pipeline that produced the results.
+    :type pipeline_name: str
+    :param pipeline_version: Version of the pipeline that produced the results.
+    :type pipeline_version: str
+    :param source_path: Path to the file the results were read from.
+    :type source_path: str
+    :param library_results: Metrics, indexed by library ID and then by metric name.
+    :type library_results: dict[str, dict[str, object]]
+    :return: Number of values loaded
+    :rtype: int
+    """
+    source_path = os.path.abspath(source_path)
+    source_stat = os.stat(source_path)
+    source_fingerprint = f"{source_stat.st_size}:{source_stat.st_mtime_ns}"
+    run_date = get_run_date(sequencing_run_id)
+    rows = [
+        (sequencing_run_id, run_date, library_id, pipeline_name, pipeline_version, metric, _to_number(value))
+        for library_id, metrics in library_results.items()
+        for metric, value in metrics.items()
+    ]
+    timestamp = datetime.datetime.now().isoformat()
+    with closing(connect(warehouse_path)) as conn, conn:
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO result_loads (sequencing_run_id, pipeline_name, pipeline_version, source_path, source_fingerprint, num_rows, timestamp_loaded) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (sequencing_run_id, pipeline_name, pipeline_version, source_path, source_fingerprint, len(rows), timestamp),
+        )
+        if cursor.rowcount == 0:
+            return 0
+        load_id = cursor.lastrowid
+        conn.executemany(
+            "INSERT INTO library_results (load_id, sequencing_run_id, run_date, library_id, pipeline_name, pipeline_version, metric, value) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(load_id,) + row for row in rows],
+        )
+
+    logging.info(json.dumps({
+        "event_type": "library_results_loaded",
+        "sequencing_run_id": sequencing_run_id,
+        "pipeline_name": pipeline_name,
+        "pipeline_version": pipeline_version,
+        "source_path": source_path,
+        "num_libraries": len(library_results),
+        "num_values": len(rows),
+    }))
+
+    return len(rows)
+
+
+def load_pipeline_results(config: dict[str, object], pipeline: dict[str, object], run: dict[str, object]) -> int:
+    """
+    Load a finished analysis' per-library summary outputs into the results warehouse. Summary outputs are listed in
+    the pipeline's `summary_outputs` config. Each entry has keys: ['path', 'library_id_field'] and optionally 'delimiter'.
+    The path is a glob, relative to the analysis output dir. Does nothing if `results_warehouse_db` is not configured.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param pipeline: The pipeline dictionary, as prepared by `pre_analysis.prepare_analysis`.
+    :type pipeline: dict[str, object]
+    :param run: The run dictionary
+    :type run: dict[str, object]
+    :return: Number of values loaded
+    :rtype: int
+    """
+    warehouse_path = get_warehouse_path(config)
+    if warehouse_path is None:
+        return 0
+
+    outdir = pipeline['parameters']['outdir']
+    num_values_loaded = 0
+    for summary_output in pipeline.get('summary_outputs', None) or []:
+        library_id_field = summary_output['library_id_field']
+        delimiter = summary_output.get('delimiter', ',')
+        for summary_output_path in sorted(glob.glob(os.path.join(outdir, summary_output['path']))):
+            library_results = {}
+            for row in parsers.iter_csv(summary_output_path, _SUMMARY_OUTPUT_SCHEMA, delimiter=delimiter):
+                library_id = row.pop(library_id_field, None)
+                if library_id is None:
+                    continue
+                library_results.setdefault(library_id, {}).update(row)
+            num_values_loaded += load_library_results(
+                warehouse_path, run['sequencing_run_id'], pipeline['name'], pipeline['version'], summary_output_path, library_results,
+            )
+
+    return num_values_loaded
+
+
+def load_input_fastq_qc_results(config: dict[str, object], run: dict[str, object]) -> int:
+    """
+    Load a run's input fastq QC results (see `input_qc.run_input_fastq_qc`) into the results warehouse.
+    Does nothing if `results_warehouse_db` is not configured, or input QC wasn't run.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run: The run dictionary
+    :type run: dict[str, object]
+    :return: Number of values loaded
+    :rtype: int
+    """
+    warehouse_path = get_warehouse_path(config)
+    if warehouse_path is None:
+        return 0
+    input_fastq_qc_path = os.path.abspath(os.path.join(config['analysis_output_dir'], run['sequencing_run_id'], input_qc.INPUT_FASTQ_QC_FILENAME))
+    if not os.path.exists(input_fastq_qc_path):
+        return 0
+
+    with open(input_fastq_qc_path, 'r') as f:
+        input_fastq_qc = json.load(f)
+    library_results = {}
+    for library_id, library in input_fastq_qc.get('libraries', {}).items():
+        library_results[library_id] = {
+            'qc_status': library['qc_status'],
+            'num_reads': library['qc']['num_reads'],
+            'num_bases': library['qc']['num_bases'],
+            'percent_bases_above_q30': library['qc']['percent_bases_above_q30'],
+        }
+
+    return load_library_results(warehouse_path, run['sequencing_run_id'], INPUT_FASTQ_QC_PIPELINE_NAME, '', input_fastq_qc_path, library_results)
+
+
+def _group_results(rows: list[sqlite3.Row], key_field: str) -> dict[str, dict[str, dict[str, object]]]:
+    results = {}
+    for row in rows:
+        pipeline_results = results.setdefault(row[key_field], {})
+        pipeline_results.setdefault(row['pipeline_name'], {})[row['metric']] = row['value']
+
+    return results
+
+
+def get_run_library_results(warehouse_path: str, sequencing_run_id: str) -> dict[str, dict[str, dict[str, object]]]:
+    """
+    Get the latest results for every library in a run.
+
+    :param warehouse_path: Path to the warehouse database.
+    :type warehouse_path: str
+    :param sequencing_run_id: Sequencing run ID
+    :type sequencing_run_id: str
+    :return: Metrics, indexed by library ID, then pipeline name, then metric name.
+    :rtype: dict[str, dict[str, dict[str, object]]]
+    """
+    with closing(connect(warehouse_path)) as conn:
+        rows = conn.execute(
+            "SELECT library_id, pipeline_name, metric, value FROM latest_library_results WHERE sequencing_run_id = ? ORDER BY library_id",
+            (sequencing_run_id,),
+        ).fetchall()
+
+    return _group_results(rows, 'library_id')
+
+
+def get_library_results(warehouse_path: str, library_id: str) -> dict[str, dict[str, dict[str, object]]]:
+    """
+    Get the latest results for a library, across all of the runs it was sequenced on.
+
+    :param warehouse_path: Path to the warehouse database.
+    :type warehouse_path: str
+    :param library_id: Library ID
+    :type library_id: str
+    :return: Metrics, indexed by sequencing run ID, then pipeline name, then metric name.
+    :rtype: dict[str, dict[str, dict[str, object]]]
+    """
+    with closing(connect(warehouse_path)) as conn:
+        rows = conn.execute(
+            "SELECT sequencing_run_id, pipeline_name, metric, value FROM latest_library_results WHERE library_id = ? ORDER BY run_date",
+            (library_id,),
+        ).fetchall()
+
+    return _group_results(rows, 'sequencing_run_id')
+
+
+def main(args):
+    config = load_config(args.config)
+    warehouse_path = get_warehouse_path(config)
+    if warehouse_path is None or not os.path.exists(warehouse_path):
+        print("No results warehouse found. Set 'results_warehouse_db' in the config.")
+        exit(1)
+
+    if args.run_id:
+        results = get_run_library_results(warehouse_path, args.run_id)
+    else:
+        results = get_library_results(warehouse_path, args.library_id)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Show results from the results warehouse, for a run or for a library.")
+    parser.add_argument('-c', '--config', required=True)
+    query_group = parser.add_mutually_exclusive_group(required=True)
+    query_group.add_argument('--run-id', help="Show results for every library in this run")
+    query_group.add_argument('--library-id', help="Show results for this library, across runs")
+    args = parser.parse_args()
+    main(args)
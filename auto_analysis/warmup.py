@@ -0,0 +1,368 @@
+import collections
+import datetime
+import fcntl
+import json
+import logging
+import os
+import re
+import shutil
+import signal
+import subprocess
+import threading
+import time
+
+from typing import Optional
+
+import auto_analysis.analysis as analysis
+import auto_analysis.metrics as metrics
+import auto_analysis.profiling as profiling
+
+
+DEFAULT_WARMUP_CONFIG = {
+    "enabled": True,
+    # Commands are templates: each argument is formatted with `str.format` using the fields
+    # ['name', 'version', 'profile', 'conda_cache_dir', 'work_dir', 'outdir'].
+    "pull_command": ["nextflow", "pull", "{name}", "-r", "{version}"],
+    # Builds the pipeline's environments into `conda_cache_dir`, eg. a `-stub-run` of the pipeline with its test profile.
+    # A pipeline's own `warmup_command` takes precedence. If neither is set, pipelines are only pulled.
+    "env_command": None,
+    "timeout_seconds": 7200,
+    # Failed warm-ups are tried again after this long (on the next config reload, or when an analysis needs the pipeline).
+    "retry_seconds": 3600,
+    # Shared by all instances that use the same `conda_cache_dir`. Defaults to `<conda_cache_dir>/.auto-analysis-warmup.json`
+    "readiness_cache_path": None,
+}
+
+WARMUP_OUTPUT_TAIL_LINES = 20
+
+LOCK_POLL_INTERVAL_SECONDS = 5
+
+
+def get_warmup_config(config: dict[str, object]) -> dict[str, object]:
+    """
+    Get the 'warmup' section of the config, with defaults filled in.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Warm-up config (see `DEFAULT_WARMUP_CONFIG`)
+    :rtype: dict[str, object]
+    """
+    warmup_config = dict(DEFAULT_WARMUP_CONFIG)
+    warmup_config.update(config.get('warmup', None) or {})
+    if not warmup_config['readiness_cache_path']:
+        warmup_config['readiness_cache_path'] = os.path.join(config['conda_cache_dir'], '.auto-analysis-warmup.json')
+    warmup_config['readiness_cache_path'] = os.path.abspath(warmup_config['readiness_cache_path'])
+    for key in ['timeout_seconds', 'retry_seconds']:
+        warmup_config[key] = float(warmup_config[key])
+
+    return warmup_config
+
+
+def get_warmup_key(config: dict[str, object], pipeline: dict[str, object]) -> str:
+    """
+    :return: Key of a pipeline in the readiness cache. Pipelines are warmed up separately for each nextflow profile.
+    :rtype: str
+    """
+    return pipeline['name'] + ' ' + pipeline['version'] + ' ' + analysis.get_nextflow_profile(config, pipeline)
+
+
+def read_readiness_cache(readiness_cache_path: str) -> dict[str, dict[str, object]]:
+    """
+    :return: Warm-up records by key (see `get_warmup_key`), or an empty dict if the cache doesn't exist yet.
+    :rtype: dict[str, dict[str, object]]
+    """
+    try:
+        with open(readiness_cache_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        return {}
+
+
+class PipelineWarmer:
+    """
+    Warm up each configured pipeline version in a background thread, before it is needed by an analysis: pull
+    it with `pull_command`, then build its environments with its `env_command` (if any). Pipelines that are
+    added by a config reload are warmed up as they're seen.
+
+    Warm-ups are run one at a time, under an fcntl lock on `<readiness_cache_path>.lock`, so that instances
+    sharing a `conda_cache_dir` don't build the same environments at the same time. Pipelines that have been
+    warmed up are recorded in the readiness cache, and aren't warmed up again by any instance.
+
+    Analyses wait for their pipeline to be warmed up before they start (see `wait_until_warm`). If the warm-up
+    fails, they are cancelled, and picked up again by later scans. The warm-up is tried again `retry_seconds`
+    after it failed. To run pipelines without warming them up, set `enabled` to false.
+    """
+
+    def __init__(self, config: dict[str, object]):
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._config = None
+        self._states = {}
+        self._failure_times = {}
+        self._pipelines = {}
+        self._queue = collections.deque()
+        self._process = None
+        self.update_config(config)
+        self._thread = threading.Thread(target=self._run, name='pipeline-warmer', daemon=True)
+        self._thread.start()
+
+
+    def update_config(self, config: dict[str, object]):
+        """
+        Queue warm-ups for any pipelines in a (re)loaded config that haven't been warmed up yet.
+        Pipelines that are already recorded in the readiness cache are marked as warm straight away.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :return: None
+        :rtype: NoneType
+        """
+        with self._condition:
+            if config is self._config:
+                return
+        warmup_config = get_warmup_config(config)
+        readiness_cache = read_readiness_cache(warmup_config['readiness_cache_path']) if warmup_config['enabled'] else {}
+        with self._condition:
+            self._config = config
+            self._warmup_config = warmup_config
+            for pipeline in config['pipelines']:
+                if pipeline is None:
+                    continue
+                warmup_key = get_warmup_key(config, pipeline)
+                if (readiness_cache.get(warmup_key, None) or {}).get('state', None) == 'warm':
+                    self._states[warmup_key] = 'warm'
+                self._request(config, pipeline, warmup_key)
+            self._condition.notify_all()
+
+
+    def _request(self, config: dict[str, object], pipeline: dict[str, object], warmup_key: str):
+        """
+        Queue a warm-up, unless the pipeline is warm, already queued, or failed less than `retry_seconds` ago.
+        Must be called with the condition held.
+        """
+        if not self._warmup_config['enabled']:
+            return
+        state = self._states.get(warmup_key, None)
+        if state in ['warm', 'pending', 'warming']:
+            return
+        if state == 'failed' and time.monotonic() - self._failure_times[warmup_key] < self._warmup_config['retry_seconds']:
+            return
+        self._states[warmup_key] = 'pending'
+        self._pipelines[warmup_key] = (config, pipeline)
+        self._queue.append(warmup_key)
+        self._condition.notify_all()
+
+
+    def wait_until_warm(self, config: dict[str, object], pipeline: dict[str, object]) -> bool:
+        """
+        Wait for a pipeline to be warmed up, queueing its warm-up if needed. Returns early if the warmer is closed.
+
+        :param config: Application config.
+        :type config: dict[str, object]
+        :param pipeline: The pipeline about to be run.
+        :type pipeline: dict[str, object]
+        :return: Whether the pipeline is warm (or warm-ups are disabled). False if its warm-up failed.
+        :rtype: bool
+        """
+        warmup_key = get_warmup_key(config, pipeline)
+        with self._condition:
+            if not self._warmup_config['enabled']:
+                return True
+            if not self._stopping:
+                self._request(config, pipeline, warmup_key)
+            while self._states.get(warmup_key, None) in ['pending', 'warming'] and not self._stopping:
+                self._condition.wait()
+
+            return self._states.get(warmup_key, None) == 'warm'
+
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                warmup_key = self._queue.popleft()
+                config, pipeline = self._pipelines.pop(warmup_key)
+                warmup_config = self._warmup_config
+                self._states[warmup_key] = 'warming'
+
+            try:
+                warm = self._warm_up(config, warmup_config, pipeline, warmup_key)
+            except InterruptedError as e:
+                warm = False
+            except Exception as e:
+                logging.error(json.dumps({
+                    "event_type": "pipeline_warm_up_failed",
+                    "warmup_key": warmup_key,
+                    "error": str(e),
+                }))
+                warm = False
+
+            with self._condition:
+                self._states[warmup_key] = 'warm' if warm else 'failed'
+                if not warm:
+                    self._failure_times[warmup_key] = time.monotonic()
+                self._condition.notify_all()
+
+
+    def _run_command(self, command: list[str], work_dir: str, timeout_seconds: float) -> tuple[int, list[str]]:
+        """
+        Run a warm-up command in its own session, so that it can be stopped (along with anything it started) on close.
+
+        :return: Exit code of the command, and the last few lines of its output.
+        :rtype: tuple[int, list[str]]
+        """
+        with self._condition:
+            if self._stopping:
+                raise InterruptedError("Pipeline warmer was closed")
+            self._process = subprocess.Popen(
+                command,
+                cwd=work_dir,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                errors='replace',
+                start_new_session=True,
+            )
+        try:
+            output, _ = self._process.communicate(timeout=timeout_seconds)
+        except subprocess.TimeoutExpired as e:
+            os.killpg(self._process.pid, signal.SIGKILL)
+            output, _ = self._process.communicate()
+        with self._condition:
+            exit_code = self._process.returncode
+            self._process = None
+            if self._stopping:
+                raise InterruptedError("Pipeline warmer was closed")
+
+        return exit_code, output.splitlines()[-WARMUP_OUTPUT_TAIL_LINES:]
+
+
+    def _lock_unless_stopping(self, lock_file):
+        """
+        Take the warm-up lock. Another instance may hold it for as long as it takes to build its environments,
+        so the lock is polled, rather than waited for, so that the warmer can still be closed in the meantime.
+        """
+        while True:
+            try:
+                fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except OSError as e:
+                pass
+            with self._condition:
+                if self._stopping:
+                    raise InterruptedError("Pipeline warmer was closed")
+                self._condition.wait(timeout=LOCK_POLL_INTERVAL_SECONDS)
+
+
+    def _warm_up(self, config: dict[str, object], warmup_config: dict[str, object], pipeline: dict[str, object], warmup_key: str) -> bool:
+        """
+        Pull a pipeline and build its environments, unless another instance has already done so.
+
+        :return: Whether the pipeline is warm.
+        :rtype: bool
+        """
+        readiness_cache_path = warmup_config['readiness_cache_path']
+        os.makedirs(os.path.dirname(readiness_cache_path), exist_ok=True)
+        work_dir = os.path.join(config['analysis_work_dir'], 'warmup-' + re.sub(r'[^A-Za-z0-9.-]+', '_', warmup_key))
+        fields = {
+            'name': pipeline['name'],
+            'version': pipeline['version'],
+            'profile': analysis.get_nextflow_profile(config, pipeline),
+            'conda_cache_dir': config['conda_cache_dir'],
+            'work_dir': work_dir,
+            'outdir': os.path.join(work_dir, 'output'),
+        }
+        commands = [('pull', warmup_config['pull_command'])]
+        env_command = pipeline.get('warmup_command', warmup_config['env_command'])
+        if env_command:
+            commands.append(('build_envs', env_command))
+
+        with profiling.trace('warm_up_pipeline', pipeline_name=pipeline['name'], pipeline_version=pipeline['version']), open(readiness_cache_path + '.lock', 'a') as lock_file:
+            with profiling.span('wait_for_warm_up_lock'):
+                self._lock_unless_stopping(lock_file)
+            try:
+                # Checked again under the lock, in case another instance has warmed it up in the meantime.
+                readiness_cache = read_readiness_cache(readiness_cache_path)
+                if (readiness_cache.get(warmup_key, None) or {}).get('state', None) == 'warm':
+                    return True
+
+                logging.info(json.dumps({"event_type": "pipeline_warm_up_started", "warmup_key": warmup_key}))
+                warm_up_start = time.monotonic()
+                os.makedirs(work_dir, exist_ok=True)
+                try:
+                    for step, command_template in commands:
+                        command = [str(argument).format(**fields) for argument in command_template]
+                        with profiling.span(step):
+                            exit_code, output_tail = self._run_command(command, work_dir, warmup_config['timeout_seconds'])
+                        if exit_code != 0:
+                            logging.error(json.dumps({
+                                "event_type": "pipeline_warm_up_failed",
+                                "warmup_key": warmup_key,
+                                "step": step,
+                                "command": command,
+                                "exit_code": exit_code,
+                                "output_tail": output_tail,
+                            }))
+                            metrics.observe("auto_analysis_warm_up_duration_seconds", time.monotonic() - warm_up_start, {"pipeline": pipeline['name'], "outcome": "failed"})
+                            return False
+                finally:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+
+                warm_up_seconds = time.monotonic() - warm_up_start
+                readiness_cache = read_readiness_cache(readiness_cache_path)
+                readiness_cache[warmup_key] = {
+                    "state": "warm",
+                    "timestamp_warm": datetime.datetime.now().isoformat(),
+                    "warm_up_seconds": round(warm_up_seconds, 3),
+                }
+                tmp_readiness_cache_path = readiness_cache_path + '.' + str(os.getpid()) + '.tmp'
+                with open(tmp_readiness_cache_path, 'w') as f:
+                    json.dump(readiness_cache, f, indent=2)
+                    f.write('\n')
+                os.replace(tmp_readiness_cache_path, readiness_cache_path)
+            finally:
+                fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+        metrics.observe("auto_analysis_warm_up_duration_seconds", warm_up_seconds, {"pipeline": pipeline['name'], "outcome": "warm"})
+        logging.info(json.dumps({
+            "event_type": "pipeline_warm_up_complete",
+            "warmup_key": warmup_key,
+            "warm_up_seconds": round(warm_up_seconds, 3),
+        }))
+
+        return True
+
+
+    def stats(self) -> dict[str, int]:
+        """
+        :return: Number of pipelines in each warm-up state. Keys: ['pending', 'warming', 'warm', 'failed']
+        :rtype: dict[str, int]
+        """
+        with self._condition:
+            num_by_state = {state: 0 for state in ['pending', 'warming', 'warm', 'failed']}
+            for state in self._states.values():
+                num_by_state[state] += 1
+
+        return num_by_state
+
+
+    def close(self, timeout: Optional[float]=None):
+        """
+        Stop the background thread, stopping any warm-up in progress. Analyses waiting for a warm-up are released.
+        Interrupted warm-ups aren't recorded as warm, so they are started again by the next warmer.
+
+        :param timeout: Seconds to wait for the background thread to stop.
+        :type timeout: Optional[float]
+        :return: None
+        :rtype: NoneType
+        """
+        with self._condition:
+            self._stopping = True
+            if self._process is not None and self._process.poll() is None:
+                os.killpg(self._process.pid, signal.SIGTERM)
+            self._condition.notify_all()
+        self._thread.join(timeout)
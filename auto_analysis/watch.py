@@ -0,0 +1,234 @@
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+from typing import Iterator, Optional
+
+import auto_analysis.core as core
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+_FASTQ_BY_RUN_DIR_WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_ONLYDIR
+_RUN_DIR_WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_DELETE_SELF | IN_ONLYDIR
+
+
+def _load_libc():
+    """
+    Load the C library, if it provides the inotify API.
+
+    :return: The C library, or None if inotify is not available on this platform.
+    :rtype: Optional[ctypes.CDLL]
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+    except (OSError, AttributeError) as e:
+        return None
+
+    return libc
+
+
+class RunDirWatcher:
+    """
+    Watch the `fastq_by_run_dir` for new run directories, and for `symlinks_complete.json` files
+    being written into them.
+
+    Uses inotify where available. On other platforms (or if inotify can't be initialized),
+    `wait_for_runs` simply sleeps, leaving discovery to the regular scan. Note that inotify
+    only sees changes made from this host, so on network filesystems the regular scan is
+    still needed to reconcile runs written by other hosts.
+    """
+
+    def __init__(self, config: dict[str, object]):
+        self.fastq_by_run_dir = os.path.abspath(config['fastq_by_run_dir'])
+        self.inotify_fd = None
+        self.run_dirs_by_watch_descriptor = {}
+        self.fastq_by_run_dir_watch_descriptor = None
+        self.runs_yielded = set()
+        self.libc = _load_libc()
+        if self.libc is None:
+            logging.warning(json.dumps({"event_type": "run_dir_watch_unavailable", "reason": "inotify_not_supported"}))
+            return
+
+        inotify_fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if inotify_fd < 0:
+            logging.warning(json.dumps({
+                "event_type": "run_dir_watch_unavailable",
+                "reason": "inotify_init_failed",
+                "error": os.strerror(ctypes.get_errno()),
+            }))
+            return
+        self.inotify_fd = inotify_fd
+
+        self.fastq_by_run_dir_watch_descriptor = self._add_watch(self.fastq_by_run_dir, _FASTQ_BY_RUN_DIR_WATCH_MASK)
+        if self.fastq_by_run_dir_watch_descriptor is None:
+            self.close()
+            return
+
+        # Runs that were already waiting on their `symlinks_complete.json` file when we started
+        # won't produce a directory creation event, so start watching them now.
+        with os.scandir(self.fastq_by_run_dir) as subdirs:
+            for subdir in subdirs:
+                if subdir.is_dir() and core.get_instrument_type(subdir.name) is not None:
+                    if not os.path.exists(os.path.join(subdir.path, "symlinks_complete.json")):
+                        self._watch_run_dir(subdir.path)
+
+        logging.info(json.dumps({
+            "event_type": "run_dir_watch_started",
+            "fastq_by_run_dir": self.fastq_by_run_dir,
+            "num_run_dirs_watched": len(self.run_dirs_by_watch_descriptor),
+        }))
+
+
+    def is_active(self) -> bool:
+        """
+        :return: Whether inotify is being used to watch for runs.
+        :rtype: bool
+        """
+        return self.inotify_fd is not None
+
+
+    def close(self):
+        """
+        Stop watching, and release the inotify file descriptor.
+
+        :return: None
+        :rtype: NoneType
+        """
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+        self.run_dirs_by_watch_descriptor = {}
+
+
+    def _add_watch(self, path: str, mask: int) -> Optional[int]:
+        watch_descriptor = self.libc.inotify_add_watch(self.inotify_fd, os.fsencode(path), mask)
+        if watch_descriptor < 0:
+            logging.warning(json.dumps({
+                "event_type": "add_run_dir_watch_failed",
+                "path": path,
+                "error": os.strerror(ctypes.get_errno()),
+            }))
+            return None
+
+        return watch_descriptor
+
+
+    def _watch_run_dir(self, run_dir: str):
+        watch_descriptor = self._add_watch(run_dir, _RUN_DIR_WATCH_MASK)
+        if watch_descriptor is not None:
+            self.run_dirs_by_watch_descriptor[watch_descriptor] = run_dir
+
+
+    def _unwatch_run_dir(self, watch_descriptor: int):
+        self.run_dirs_by_watch_descriptor.pop(watch_descriptor, None)
+        self.libc.inotify_rm_watch(self.inotify_fd, watch_descriptor)
+
+
+    def _ready_run(self, run_dir: str) -> Optional[dict[str, object]]:
+        run_id = os.path.basename(run_dir)
+        instrument_type = core.get_instrument_type(run_id)
+        if instrument_type is None or run_id in self.runs_yielded:
+            return None
+
+        logging.info(json.dumps({
+            "event_type": "fastq_directory_found",
+            "sequencing_run_id": run_id,
+            "fastq_directory_path": run_dir,
+            "discovered_by": "run_dir_watch",
+        }))
+        self.runs_yielded.add(run_id)
+
+        return core.build_run(run_id, run_dir, instrument_type)
+
+
+    def _read_events(self) -> Iterator[tuple[int, int, str]]:
+        try:
+            buf = os.read(self.inotify_fd, 65536)
+        except BlockingIOError as e:
+            return
+        offset = 0
+        while offset < len(buf):
+            watch_descriptor, mask, cookie, name_len = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = buf[offset:offset + name_len].rstrip(b'\0').decode('utf-8', errors='replace')
+            offset += name_len
+            yield watch_descriptor, mask, name
+
+
+    def wait_for_runs(self, timeout_seconds: float) -> Iterator[dict[str, object]]:
+        """
+        Wait up to `timeout_seconds`, yielding runs as soon as they become ready to analyze.
+
+        Returns early if the kernel event queue overflows, so that the caller can fall back
+        to a full scan to reconcile any events that were missed.
+
+        :param timeout_seconds: How long to wait for runs before returning.
+        :type timeout_seconds: float
+        :return: Runs that are ready to analyze.
+        :rtype: Iterator[dict[str, object]]
+        """
+        deadline = time.monotonic() + timeout_seconds
+        if not self.is_active():
+            time.sleep(max(0.0, timeout_seconds))
+            return
+
+        while True:
+            remaining_seconds = deadline - time.monotonic()
+            if remaining_seconds <= 0:
+                return
+            readable, _, _ = select.select([self.inotify_fd], [], [], remaining_seconds)
+            if not readable:
+                return
+
+            for watch_descriptor, mask, name in self._read_events():
+                if mask & IN_Q_OVERFLOW:
+                    logging.warning(json.dumps({"event_type": "run_dir_watch_overflow"}))
+                    return
+
+                if watch_descriptor == self.fastq_by_run_dir_watch_descriptor:
+                    if not (mask & IN_ISDIR) or core.get_instrument_type(name) is None:
+                        continue
+                    run_dir = os.path.join(self.fastq_by_run_dir, name)
+                    self._watch_run_dir(run_dir)
+                    # The file may have been written before the watch was in place.
+                    if os.path.exists(os.path.join(run_dir, "symlinks_complete.json")):
+                        run = self._ready_run(run_dir)
+                        if run is not None:
+                            yield run
+                    continue
+
+                run_dir = self.run_dirs_by_watch_descriptor.get(watch_descriptor, None)
+                if run_dir is None:
+                    continue
+                if mask & (IN_IGNORED | IN_DELETE_SELF):
+                    self.run_dirs_by_watch_descriptor.pop(watch_descriptor, None)
+                    continue
+                if name == "symlinks_complete.json":
+                    self._unwatch_run_dir(watch_descriptor)
+                    run = self._ready_run(run_dir)
+                    if run is not None:
+                        yield run
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Compare the csv parsers in `auto_analysis.parsers` against the original list-of-dicts implementation,
+on a synthetic nextflow-trace-like tsv file.
+
+    python benchmarks/bench_parsers.py --num-rows 200000
+"""
+
+import argparse
+import csv
+import os
+import tempfile
+import time
+import tracemalloc
+
+from auto_analysis import parsers
+
+from synthetic import write_synthetic_trace
+
+
+INT_FIELDS = ['task_id', 'exit', 'native_id']
+FLOAT_FIELDS = ['%cpu']
+FIELDNAME_TRANSLATION = {'%cpu': 'percent_cpu', 'exit': 'exit_status'}
+
+
+def parse_generic_csv_original(csv_path, delimiter=',', fieldname_translation={}, int_fields=[], float_fields=[]):
+    """
+    `parsers.parse_generic_csv` as it was before schemas were introduced, kept as a baseline.
+    """
+    parsed_rows = []
+    with open(csv_path, 'r') as f:
+        reader = csv.DictReader(f, delimiter=delimiter)
+        for row in reader:
+            parsed_row = {}
+            for field, value in row.items():
+                if field in int_fields:
+                    try:
+                        parsed_row[field] = int(value)
+                    except ValueError as e:
+                        parsed_row[field] = None
+                elif field in float_fields:
+                    try:
+                        parsed_row[field] = float(value)
+                    except ValueError as e:
+                        parsed_row[field] = None
+                else:
+                    parsed_row[field] = value
+
+            for original_fieldname, translated_fieldname in fieldname_translation.items():
+                if original_fieldname in parsed_row:
+                    value = parsed_row.pop(original_fieldname)
+                    parsed_row[translated_fieldname] = value
+
+            parsed_rows.append(parsed_row)
+
+    return parsed_rows
+
+
+def measure_peak_memory_bytes(parse):
+    tracemalloc.start()
+    parse()
+    current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return peak_bytes
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        trace_path = os.path.join(tmpdir, 'trace.tsv')
+        write_synthetic_trace(trace_path, args.num_rows)
+        schema = parsers.CsvSchema(int_fields=INT_FIELDS, float_fields=FLOAT_FIELDS, fieldname_translation=FIELDNAME_TRANSLATION)
+
+        benchmarks = [
+            ('original parse_generic_csv', lambda: len(parse_generic_csv_original(trace_path, '\t', FIELDNAME_TRANSLATION, INT_FIELDS, FLOAT_FIELDS))),
+            ('parse_generic_csv', lambda: len(parsers.parse_generic_csv(trace_path, '\t', FIELDNAME_TRANSLATION, INT_FIELDS, FLOAT_FIELDS))),
+            ('iter_csv', lambda: sum(1 for row in parsers.iter_csv(trace_path, schema, delimiter='\t'))),
+            ('parse_csv_columns', lambda: len(parsers.parse_csv_columns(trace_path, schema, delimiter='\t')['task_id'])),
+        ]
+        # Tracing allocations slows everything down, so timings are taken from a separate, untraced run.
+        results = []
+        for label, parse in benchmarks:
+            timings = []
+            for repeat in range(args.repeats):
+                start = time.perf_counter()
+                parse()
+                timings.append(time.perf_counter() - start)
+            results.append((label, parse(), min(timings), measure_peak_memory_bytes(parse)))
+
+    print('\t'.join(['parser', 'num_rows', 'best_seconds', 'rows_per_second', 'peak_memory_mb']))
+    for label, num_rows, elapsed_seconds, peak_bytes in results:
+        print('\t'.join([label, str(num_rows), f"{elapsed_seconds:.3f}", f"{num_rows / elapsed_seconds:.0f}", f"{peak_bytes / 1024 ** 2:.1f}"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the csv parsers on a synthetic trace file.")
+    parser.add_argument('--num-rows', type=int, default=200000)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""
+Check that run claims (see `auto_analysis.claims`) never let two instances analyze the same run at once.
+
+Several worker processes share a synthetic `fastq_by_run_dir` and claims dir, and repeatedly try to claim
+each ready run, as `AnalysisScheduler.submit` does. A claimed run is "analyzed" by sleeping for a while, then its
+claim is released with a complete outcome. Some workers crash (without releasing their claims) partway through
+an analysis, so that their claims have to be taken over once their leases expire.
+
+Every analysis start and end is appended to a shared event log. Afterwards, the harness checks that:
+
+- no two analyses of the same run overlapped (a crashed analysis ends when its worker crashed),
+- every ready run was analyzed to completion exactly once.
+
+    python benchmarks/claims_harness.py --num-workers 8 --num-runs 200
+
+Exits with status 1 if either check fails.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+from auto_analysis import claims
+from auto_analysis import core
+
+import synthetic
+
+
+PIPELINE = {'name': 'BCCDC-PHL/pipeline-1', 'version': 'v0.1.0', 'dependencies': None, 'parameters': {}}
+
+
+def log_event(event_log_path, event):
+    # Each event is a single write to a file opened with O_APPEND, so events from different processes don't interleave.
+    fd = os.open(event_log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(event) + '\n').encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+def worker(worker_index, args, fastq_by_run_dir, claims_dir, event_log_path):
+    logging.disable(logging.CRITICAL)
+    rng = random.Random(args.seed + worker_index)
+    instance_id = 'worker-%d' % worker_index
+    config = {
+        'pipelines': [PIPELINE],
+        'claims': {
+            'claims_dir': claims_dir,
+            'instance_id': instance_id,
+            'lease_seconds': args.lease_seconds,
+            'heartbeat_interval_seconds': args.lease_seconds / 4,
+            'instances': ['worker-%d' % i for i in range(args.num_workers)] if args.partition else [],
+            'partition_grace_seconds': args.lease_seconds,
+        },
+    }
+    run_claims = claims.RunClaims(config)
+    crash_after_analyses = rng.randrange(1, 6) if rng.random() < args.crash_fraction else None
+    num_analyses = 0
+    deadline = time.monotonic() + args.timeout_seconds
+    while time.monotonic() < deadline:
+        runs = [run for run in core.find_fastq_dirs({'fastq_by_run_dir': fastq_by_run_dir, 'pipelines': [PIPELINE]}) if run is not None]
+        rng.shuffle(runs)
+        num_unfinished = 0
+        for run in runs:
+            outcome = run_claims.acquire(run)
+            if outcome == 'analyzed_by_another_instance':
+                continue
+            num_unfinished += 1
+            if outcome not in claims.ACQUIRED_OUTCOMES:
+                continue
+            sequencing_run_id = run['sequencing_run_id']
+            log_event(event_log_path, {'event': 'start', 'sequencing_run_id': sequencing_run_id, 'instance_id': instance_id, 'claim_outcome': outcome, 'time': time.time()})
+            num_analyses += 1
+            if crash_after_analyses is not None and num_analyses >= crash_after_analyses:
+                time.sleep(rng.uniform(0, args.max_analysis_seconds))
+                log_event(event_log_path, {'event': 'crash', 'sequencing_run_id': sequencing_run_id, 'instance_id': instance_id, 'time': time.time()})
+                os._exit(0)
+            time.sleep(rng.uniform(0, args.max_analysis_seconds))
+            log_event(event_log_path, {'event': 'end', 'sequencing_run_id': sequencing_run_id, 'instance_id': instance_id, 'time': time.time()})
+            run_claims.release(sequencing_run_id, [{'pipeline_name': PIPELINE['name'], 'pipeline_version': PIPELINE['version'], 'outcome': 'complete'}])
+        if num_unfinished == 0:
+            break
+        time.sleep(rng.uniform(0, args.lease_seconds / 4))
+    run_claims.close()
+
+
+def check_events(events, ready_run_ids):
+    """
+    :return: Problems found.
+    :rtype: list[str]
+    """
+    problems = []
+    intervals_by_run = {}
+    open_analyses = {}
+    for event in sorted(events, key=lambda e: e['time']):
+        key = (event['sequencing_run_id'], event['instance_id'])
+        if event['event'] == 'start':
+            open_analyses[key] = event
+        else:
+            start = open_analyses.pop(key)
+            intervals_by_run.setdefault(event['sequencing_run_id'], []).append((start['time'], event['time'], event['event'], event['instance_id']))
+    for (sequencing_run_id, instance_id) in open_analyses:
+        problems.append(f"{sequencing_run_id}: analysis by {instance_id} never ended")
+
+    for sequencing_run_id in ready_run_ids:
+        intervals = sorted(intervals_by_run.get(sequencing_run_id, []))
+        num_completed = sum(1 for interval in intervals if interval[2] == 'end')
+        if num_completed != 1:
+            problems.append(f"{sequencing_run_id}: completed {num_completed} times")
+        for previous, current in zip(intervals, intervals[1:]):
+            if current[0] < previous[1]:
+                problems.append(f"{sequencing_run_id}: analysis by {current[3]} started while {previous[3]} was still analyzing it")
+
+    return problems
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fastq_by_run_dir = os.path.join(tmpdir, 'fastq_symlinks_by_run')
+        claims_dir = os.path.join(tmpdir, 'claims')
+        event_log_path = os.path.join(tmpdir, 'events.jsonl')
+        ready_run_ids = synthetic.make_run_tree(fastq_by_run_dir, args.num_runs, seed=args.seed)
+
+        start = time.monotonic()
+        processes = [
+            multiprocessing.Process(target=worker, args=(worker_index, args, fastq_by_run_dir, claims_dir, event_log_path))
+            for worker_index in range(args.num_workers)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        elapsed_seconds = time.monotonic() - start
+
+        with open(event_log_path, 'r') as f:
+            events = [json.loads(line) for line in f]
+
+    problems = check_events(events, ready_run_ids)
+    starts = [event for event in events if event['event'] == 'start']
+    print(json.dumps({
+        'num_workers': args.num_workers,
+        'num_ready_runs': len(ready_run_ids),
+        'num_analyses_started': len(starts),
+        'num_claims_taken_over': sum(1 for event in starts if event['claim_outcome'] == 'taken_over'),
+        'num_workers_crashed': sum(1 for event in events if event['event'] == 'crash'),
+        'elapsed_seconds': round(elapsed_seconds, 2),
+        'problems': problems,
+    }, indent=2))
+
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check that concurrent instances never analyze the same run at once.")
+    parser.add_argument('--num-workers', type=int, default=8)
+    parser.add_argument('--num-runs', type=int, default=200, help="Number of run directories, about half of which are ready to analyze (default: %(default)s)")
+    parser.add_argument('--lease-seconds', type=float, default=2.0)
+    parser.add_argument('--max-analysis-seconds', type=float, default=0.05)
+    parser.add_argument('--crash-fraction', type=float, default=0.25, help="Fraction of workers that crash partway through an analysis (default: %(default)s)")
+    parser.add_argument('--partition', action='store_true', help="Assign runs to workers by rendezvous hashing.")
+    parser.add_argument('--timeout-seconds', type=float, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    sys.exit(main(args))
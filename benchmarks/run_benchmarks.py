@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Benchmark the parts of auto-analysis that scale with the size of the sequencing archive: scanning
+`fastq_by_run_dir`, building fastq manifests, reading fastq files, parsing csv files, and analyzing
+a run end-to-end (with `benchmarks/bin/nextflow` standing in for nextflow).
+
+Each benchmark records its best time over `--repeats` runs, and its peak (python) memory use. Results are
+compared against a baseline saved by an earlier run with `--save-baseline`, and any benchmark that is more
+than `--tolerance` slower, or uses more than `--tolerance` more memory, is reported as a regression.
+
+    python benchmarks/run_benchmarks.py --save-baseline
+    # ...make changes...
+    python benchmarks/run_benchmarks.py
+
+Baselines are only comparable when they were recorded on the same machine, with the same size options.
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from auto_analysis import core
+from auto_analysis import fastq
+from auto_analysis import manifest
+from auto_analysis import parsers
+
+import synthetic
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE_PATH = os.path.join(BENCHMARKS_DIR, 'baseline.json')
+STUB_NEXTFLOW_BIN_DIR = os.path.join(BENCHMARKS_DIR, 'bin')
+
+# Options that change the size of the benchmarks. Results are only compared with a baseline recorded with the same values.
+SIZE_OPTIONS = ['num_runs', 'num_libraries', 'num_reads', 'num_rows']
+
+# Differences smaller than these are within the noise of a timer or an allocator, so they are never regressions.
+MIN_REGRESSION_SECONDS = 0.005
+MIN_REGRESSION_BYTES = 64 * 1024
+
+
+def measure(func, repeats):
+    """
+    Run a benchmark `repeats` times for timing, then once more with allocations traced.
+    Tracing allocations slows everything down, so timings are taken from the untraced runs.
+
+    :return: Keys: ['best_seconds', 'peak_memory_bytes', 'result']
+    :rtype: dict[str, object]
+    """
+    timings = []
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'best_seconds': min(timings), 'peak_memory_bytes': peak_bytes, 'result': result}
+
+
+def build_benchmarks(args, tmpdir):
+    """
+    Generate the synthetic inputs, and build the benchmarks that use them. Inputs are only generated
+    for the benchmarks selected by `--only`.
+
+    :return: (name, function) for each benchmark
+    :rtype: list[tuple[str, Callable]]
+    """
+    def selected(*names):
+        return not args.only or any(re.search(args.only, name) for name in names)
+
+    benchmarks = []
+
+    if selected('find_fastq_dirs'):
+        fastq_by_run_dir = os.path.join(tmpdir, 'fastq_symlinks_by_run')
+        synthetic.make_run_tree(fastq_by_run_dir, args.num_runs)
+        scan_config = {'fastq_by_run_dir': fastq_by_run_dir, 'pipelines': []}
+        benchmarks.append(('find_fastq_dirs', lambda: sum(1 for run in core.find_fastq_dirs(scan_config) if run is not None)))
+
+    if selected('manifest.get_manifest', 'fastq.get_fastq_stats_for_files', 'fastq.get_fastq_qc_stats'):
+        fastq_dir = os.path.join(tmpdir, 'fastq')
+        synthetic.write_synthetic_library_fastqs(fastq_dir, args.num_libraries, args.num_reads)
+        fastq_paths = sorted(os.path.join(fastq_dir, filename) for filename in os.listdir(fastq_dir))
+
+        def get_manifest_uncached():
+            with manifest._manifests_lock:
+                manifest._manifests.clear()
+            return len(manifest.get_manifest(fastq_dir)['libraries'])
+
+        benchmarks.append(('manifest.get_manifest', get_manifest_uncached))
+        benchmarks.append(('fastq.get_fastq_stats_for_files', lambda: len(fastq.get_fastq_stats_for_files(fastq_paths, max_workers=1))))
+        benchmarks.append(('fastq.get_fastq_qc_stats', lambda: fastq.get_fastq_qc_stats(fastq_paths[0])['num_reads']))
+
+    if selected('parsers.parse_generic_csv', 'parsers.iter_csv'):
+        trace_path = os.path.join(tmpdir, 'trace.tsv')
+        synthetic.write_synthetic_trace(trace_path, args.num_rows)
+        benchmarks.append(('parsers.parse_generic_csv', lambda: len(parsers.parse_generic_csv(trace_path, '\t', int_fields=['task_id', 'exit'], float_fields=['native_id']))))
+        trace_schema = parsers.CsvSchema(int_fields=['task_id', 'exit'], float_fields=['native_id'])
+        benchmarks.append(('parsers.iter_csv', lambda: sum(1 for row in parsers.iter_csv(trace_path, trace_schema, delimiter='\t'))))
+
+    if not selected('core.analyze_run'):
+        return benchmarks
+    analysis_run_id = '240101_M00123_0001_000000001-ABCDE'
+    analysis_fastq_dir = os.path.join(tmpdir, 'analysis_fastq_symlinks_by_run', analysis_run_id)
+    synthetic.write_synthetic_library_fastqs(analysis_fastq_dir, args.num_libraries, 100)
+    analysis_runs = iter(range(10 ** 6))
+
+    def analyze_run():
+        # Each analysis needs its own output dir, or it would be skipped as already started.
+        analysis_dir = os.path.join(tmpdir, 'analysis-%d' % next(analysis_runs))
+        config = {
+            'analysis_output_dir': os.path.join(analysis_dir, 'output'),
+            'analysis_work_dir': os.path.join(analysis_dir, 'work'),
+            'conda_cache_dir': os.path.join(analysis_dir, 'conda'),
+            'notification': {'send_notification_emails': False},
+            'pipelines': [
+                {'name': 'BCCDC-PHL/pipeline-1', 'version': 'v0.1.0', 'dependencies': None, 'parameters': {'fastq_input': None, 'prefix': None, 'outdir': None}},
+                {'name': 'BCCDC-PHL/pipeline-2', 'version': 'v0.1.0', 'dependencies': [{'pipeline_name': 'BCCDC-PHL/pipeline-1', 'pipeline_version': 'v0.1.0'}], 'parameters': {'fastq_input': None, 'prefix': None, 'outdir': None}},
+            ],
+        }
+        run = core.build_run(analysis_run_id, analysis_fastq_dir, 'illumina')
+        core.analyze_run(config, run)
+        return sum(1 for pipeline_outdir in os.listdir(os.path.join(config['analysis_output_dir'], analysis_run_id)) if pipeline_outdir.endswith('-output'))
+
+    benchmarks.append(('core.analyze_run', analyze_run))
+
+    return benchmarks
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    :return: Names of the benchmarks that regressed.
+    :rtype: list[str]
+    """
+    regressions = []
+    for name, result in results.items():
+        baseline_result = baseline.get(name, None)
+        if baseline_result is None:
+            result['status'] = 'new'
+            continue
+        regressed = []
+        for metric, min_regression in [('best_seconds', MIN_REGRESSION_SECONDS), ('peak_memory_bytes', MIN_REGRESSION_BYTES)]:
+            ratio = result[metric] / baseline_result[metric] if baseline_result[metric] else 1.0
+            result[metric + '_vs_baseline'] = ratio
+            if ratio > 1 + tolerance and result[metric] - baseline_result[metric] > min_regression:
+                regressed.append(metric)
+        result['status'] = 'REGRESSION (' + ', '.join(regressed) + ')' if regressed else 'ok'
+        if regressed:
+            regressions.append(name)
+
+    return regressions
+
+
+def main(args):
+    logging.disable(logging.CRITICAL)
+    # The stub is found first on the PATH, so that it is run instead of any real nextflow.
+    os.environ['PATH'] = STUB_NEXTFLOW_BIN_DIR + os.pathsep + os.environ.get('PATH', '')
+    size_options = {option: getattr(args, option) for option in SIZE_OPTIONS}
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, func in build_benchmarks(args, tmpdir):
+            if args.only and not re.search(args.only, name):
+                continue
+            measurement = measure(func, args.repeats)
+            if args.verbose:
+                print(f"{name}: {measurement['result']}", file=sys.stderr)
+            results[name] = {'best_seconds': measurement['best_seconds'], 'peak_memory_bytes': measurement['peak_memory_bytes']}
+
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline_data = json.load(f)
+        if baseline_data.get('size_options', None) != size_options:
+            print(f"Baseline was recorded with different size options ({baseline_data.get('size_options', None)}), not comparing.", file=sys.stderr)
+        else:
+            baseline = baseline_data['results']
+    regressions = compare_with_baseline(results, baseline, args.tolerance) if baseline is not None else []
+
+    print('\t'.join(['benchmark', 'best_seconds', 'peak_memory_mb', 'seconds_vs_baseline', 'memory_vs_baseline', 'status']))
+    for name, result in results.items():
+        print('\t'.join([
+            name,
+            f"{result['best_seconds']:.4f}",
+            f"{result['peak_memory_bytes'] / 1024 ** 2:.2f}",
+            f"{result['best_seconds_vs_baseline']:.2f}" if 'best_seconds_vs_baseline' in result else '-',
+            f"{result['peak_memory_bytes_vs_baseline']:.2f}" if 'peak_memory_bytes_vs_baseline' in result else '-',
+            result.get('status', '-'),
+        ]))
+
+    if args.save_baseline:
+        baseline_results = {}
+        if os.path.exists(args.baseline):
+            # Keep the results of benchmarks that weren't run this time (eg. with `--only`).
+            with open(args.baseline, 'r') as f:
+                baseline_data = json.load(f)
+            if baseline_data.get('size_options', None) == size_options:
+                baseline_results = baseline_data['results']
+        baseline_results.update(results)
+        tmp_baseline_path = args.baseline + '.tmp'
+        with open(tmp_baseline_path, 'w') as f:
+            json.dump({'size_options': size_options, 'results': baseline_results}, f, indent=2)
+            f.write('\n')
+        os.replace(tmp_baseline_path, args.baseline)
+        print(f"Saved baseline to {args.baseline}", file=sys.stderr)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark auto-analysis on synthetic run directories, fastq files and trace files.")
+    parser.add_argument('--num-runs', type=int, default=10000, help="Number of run directories in the synthetic fastq_by_run_dir (default: %(default)s)")
+    parser.add_argument('--num-libraries', type=int, default=96, help="Number of libraries in the synthetic fastq directories (default: %(default)s)")
+    parser.add_argument('--num-reads', type=int, default=20000, help="Number of reads in each synthetic fastq file (default: %(default)s)")
+    parser.add_argument('--num-rows', type=int, default=200000, help="Number of rows in the synthetic trace file (default: %(default)s)")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--verbose', action='store_true', help="Print what each benchmark returned (eg. the number of runs found), as a sanity check.")
+    parser.add_argument('--only', help="Only run benchmarks whose names match this regex.")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH, help="Baseline results file (default: %(default)s)")
+    parser.add_argument('--save-baseline', action='store_true', help="Save the results as the new baseline, rather than comparing against it.")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Fractional slowdown (or memory increase) that counts as a regression (default: %(default)s)")
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,122 @@
+"""
+Generators for synthetic inputs to the benchmarks: `fastq_by_run_dir` trees, gzipped fastq files and nextflow trace files.
+All generators are deterministic for a given seed.
+"""
+
+import csv
+import gzip
+import json
+import os
+import random
+
+
+TRACE_FIELDNAMES = ['task_id', 'hash', 'native_id', 'name', 'status', 'exit', 'submit', 'duration', 'realtime', '%cpu', 'peak_rss', 'peak_vmem', 'rchar', 'wchar']
+
+INSTRUMENT_MODELS = ['miseq', 'nextseq', 'gridion', 'promethion']
+
+_UPPER_ALPHANUMERIC = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+_LOWER_ALPHANUMERIC = 'abcdefghijklmnopqrstuvwxyz0123456789'
+
+
+def make_run_id(rng, instrument_model, run_number):
+    """
+    Make a sequencing run ID in the naming scheme of an instrument model (see `auto_analysis.core.SEQUENCING_RUN_ID_REGEXES`).
+    """
+    year = 20 + rng.randrange(6)
+    month = 1 + rng.randrange(12)
+    day = 1 + rng.randrange(28)
+    if instrument_model == 'miseq':
+        flowcell_id = ''.join(rng.choice(_UPPER_ALPHANUMERIC) for _ in range(5))
+        return '%02d%02d%02d_M%05d_%04d_%09d-%s' % (year, month, day, rng.randrange(100000), run_number % 10000, run_number, flowcell_id)
+    if instrument_model == 'nextseq':
+        flowcell_id = ''.join(rng.choice(_UPPER_ALPHANUMERIC) for _ in range(9))
+        return '%02d%02d%02d_VH%05d_%d_%s' % (year, month, day, rng.randrange(100000), run_number, flowcell_id)
+    suffix = ''.join(rng.choice(_LOWER_ALPHANUMERIC) for _ in range(8))
+    flowcell_id = 'PA' + ''.join(rng.choice(_UPPER_ALPHANUMERIC) for _ in range(6))
+    if instrument_model == 'gridion':
+        return '20%02d%02d%02d_%04d_X%d_%s_%s' % (year, month, day, rng.randrange(2400), 1 + rng.randrange(5), flowcell_id, suffix)
+    if instrument_model == 'promethion':
+        return '20%02d%02d%02d_%04d_P%dS_%05d-%d_%s_%s' % (year, month, day, rng.randrange(2400), 1 + rng.randrange(2), run_number % 100000, 1 + rng.randrange(4), flowcell_id, suffix)
+
+    raise ValueError("Unknown instrument model: " + instrument_model)
+
+
+def make_run_tree(fastq_by_run_dir, num_runs, ready_fraction=0.5, non_run_fraction=0.05, libraries_per_run=0, seed=0):
+    """
+    Make a `fastq_by_run_dir` with `num_runs` run directories, spread evenly across the instrument models.
+    A `ready_fraction` of them have a `symlinks_complete.json`, and a further `non_run_fraction` of
+    directories have names that aren't run IDs. Each run dir gets `libraries_per_run` pairs of empty fastq files.
+
+    :return: IDs of the runs that are ready to analyze
+    :rtype: list[str]
+    """
+    rng = random.Random(seed)
+    os.makedirs(fastq_by_run_dir, exist_ok=True)
+    ready_run_ids = []
+    for run_number in range(num_runs):
+        instrument_model = INSTRUMENT_MODELS[run_number % len(INSTRUMENT_MODELS)]
+        run_id = make_run_id(rng, instrument_model, run_number)
+        run_dir = os.path.join(fastq_by_run_dir, run_id)
+        os.makedirs(run_dir, exist_ok=True)
+        for library_number in range(libraries_per_run):
+            for read_number in [1, 2]:
+                open(os.path.join(run_dir, 'LIB-%05d_S%d_L001_R%d_001.fastq.gz' % (library_number, library_number + 1, read_number)), 'w').close()
+        if rng.random() < ready_fraction:
+            with open(os.path.join(run_dir, 'symlinks_complete.json'), 'w') as f:
+                json.dump({"timestamp_symlinking_complete": "2024-01-01T00:00:00"}, f)
+            ready_run_ids.append(run_id)
+    for dir_number in range(int(num_runs * non_run_fraction)):
+        os.makedirs(os.path.join(fastq_by_run_dir, 'not-a-run-%06d' % dir_number), exist_ok=True)
+
+    return ready_run_ids
+
+
+def write_synthetic_fastq(path, num_reads, read_length=150, seed=0):
+    """
+    Write a gzipped fastq file of random reads, with quality scores mostly above Q30.
+    """
+    rng = random.Random(seed)
+    with gzip.open(path, 'wt', compresslevel=1) as f:
+        for read_number in range(num_reads):
+            sequence = ''.join(rng.choices('ACGT', k=read_length))
+            qualities = ''.join(rng.choices('?FFFFF:,', k=read_length))
+            f.write('@read_%d\n%s\n+\n%s\n' % (read_number, sequence, qualities))
+
+
+def write_synthetic_library_fastqs(fastq_dir, num_libraries, num_reads, read_length=150, seed=0):
+    """
+    Write a pair of gzipped fastq files (see `write_synthetic_fastq`) for each of `num_libraries` libraries.
+    """
+    os.makedirs(fastq_dir, exist_ok=True)
+    for library_number in range(num_libraries):
+        for read_number in [1, 2]:
+            fastq_path = os.path.join(fastq_dir, 'LIB-%05d_S%d_L001_R%d_001.fastq.gz' % (library_number, library_number + 1, read_number))
+            write_synthetic_fastq(fastq_path, num_reads, read_length, seed=seed + 2 * library_number + read_number)
+
+
+def write_synthetic_trace(path, num_rows, seed=0):
+    """
+    Write a nextflow-trace-like tsv file.
+    """
+    rng = random.Random(seed)
+    processes = ['fastp', 'shovill', 'quast', 'mlst', 'abricate', 'bakta']
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(TRACE_FIELDNAMES)
+        for task_id in range(1, num_rows + 1):
+            writer.writerow([
+                task_id,
+                '%02x/%06x' % (rng.randrange(256), rng.randrange(16 ** 6)),
+                rng.randrange(10 ** 6),
+                '%s (LIB-%05d)' % (rng.choice(processes), rng.randrange(100000)),
+                'COMPLETED' if rng.random() > 0.01 else 'FAILED',
+                0 if rng.random() > 0.01 else '-',
+                '2024-01-01 00:00:00.000',
+                '%dm %ds' % (rng.randrange(60), rng.randrange(60)),
+                '%dm %ds' % (rng.randrange(60), rng.randrange(60)),
+                '%.1f%%' % (rng.random() * 800),
+                '%.1f MB' % (rng.random() * 4096),
+                '%.1f GB' % (rng.random() * 16),
+                '%.1f MB' % (rng.random() * 1024),
+                '%.1f MB' % (rng.random() * 1024),
+            ])